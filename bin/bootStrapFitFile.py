@@ -16,7 +16,7 @@ from joblib import Parallel, delayed
 from scikits.bootstrap import bootstrap
 import itertools
 import warnings
-from fittinglibs import fileio, processing
+from fittinglibs import fileio, processing, fitting, groupedseries
 
 ### MAIN ###
 
@@ -37,7 +37,10 @@ group.add_argument('-out', '--out_file',
 group.add_argument('--n_samples', default=1000, type=int, metavar="N",
                    help='number of times to bootstrap samples. default = 1000.')
 group.add_argument('-n', '--numCores', default=20, type=int, metavar="N",
-                   help='number of cores. default = 20')
+                   help='number of cores (scikits engine only). default = 20')
+group.add_argument('--engine', default='grouped', choices=['grouped', 'scikits'],
+                   help='bootstrap all variants at once, in chunks of variants of about the same number of '
+                   'clusters ("grouped"), or each variant with scikits.bootstrap ("scikits"). default = grouped')
  
 
 def filterFits(table):
@@ -63,31 +66,47 @@ def bootstrapErrors(params, group, name, n_samples):
         allbounds[param+'_ub'] = bounds[1]
     return pd.Series(allbounds, name=name)
 
+def findGroupedErrors(annotated_results, params, n_samples):
+    """ Bootstrap the medians of params of all variants at once.
+
+    Clusters are sorted by variant once, and variants are bootstrapped in chunks
+    (see fitting.findGroupedMedianIntervals). Returns the same bounds as
+    bootstrapErrors, one row per variant. """
+    grouped_results = groupedseries.GroupedSeries.from_labels(
+        annotated_results.loc[:, params].values, annotated_results.index.values,
+        annotated_results.variant_number.values, params)
+    lb, ub = fitting.findGroupedMedianIntervals(grouped_results.values, grouped_results.offsets,
+                                                n_samples=n_samples)
+    return pd.concat([pd.DataFrame(lb, index=grouped_results.variants, columns=[param+'_lb' for param in params]),
+                      pd.DataFrame(ub, index=grouped_results.variants, columns=[param+'_ub' for param in params])],
+                     axis=1)
+
 def findPerVariantInfo(annotated_results, param_name):
     """ Group results by variant number and find median param_name, fmin, and fmax. """
     variant_table = processing.findVariantTable(annotated_results,
-                                                  parameter=param_name,
+                                                  ['fmin', param_name, 'fmax'],
                                                   filterFunction=filterFits)    
     return variant_table
 
-def findBootstrappedVariantInfo(annotated_results, variant_table, param_name, n_samples=1000):
+def findBootstrappedVariantInfo(annotated_results, variant_table, param_name, n_samples=1000, engine='grouped',
+                                numCores=1):
     """ Group results by variant number and bootstrap param_name, fmin, and fmax. """
     # group by variant number
     grouped = annotated_results.groupby('variant_number')
-    groupDict = {}
-    for name, group in grouped:
-        groupDict[name] = group
     
     # save a couple params
     variant_table.loc[:, 'numIter'] = n_samples
     variant_table.loc[:, 'rsq'] = grouped.median().loc[:, 'rsq']
     
-    # parallelize bootstrapping
     params = ['fmin', param_name, 'fmax']
-    bounds = (Parallel(n_jobs=numCores, verbose=10)
-            (delayed(bootstrapErrors)(params, group, name, n_samples)
-             for name, group in groupDict.items()))
-    bounds = pd.concat(bounds, axis=1).transpose()
+    if engine == 'grouped':
+        bounds = findGroupedErrors(annotated_results, params, n_samples)
+    else:
+        # parallelize bootstrapping
+        bounds = (Parallel(n_jobs=numCores, verbose=10)
+                (delayed(bootstrapErrors)(params, group, name, n_samples)
+                 for name, group in grouped))
+        bounds = pd.concat(bounds, axis=1).transpose()
     variant_table.loc[bounds.index, bounds.columns] = bounds
     variant_table.loc[:, params] = variant_table.loc[:, ['%s_init'%param for param in params]].values
     
@@ -127,5 +146,6 @@ if __name__ == '__main__':
     
     # save
     variant_table = findPerVariantInfo(annotated_results, param)
-    variant_table = findBootstrappedVariantInfo(annotated_results, variant_table, param, n_samples=n_samples)
+    variant_table = findBootstrappedVariantInfo(annotated_results, variant_table, param, n_samples=n_samples,
+                                                engine=args.engine, numCores=numCores)
     variant_table.to_csv(outFile + '.CPvariant', sep='\t')
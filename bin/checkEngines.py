@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+""" Check that the fitting engines agree on synthetic curves.
+
+Fits the same noisy binding curves and off rate curves with lmfit using finite
+differences (the reference), lmfit using the analytic jacobians of
+objfunctions, the batched Levenberg-Marquardt solver, and variable projection
+(binding curves only), and reports how much the fit parameters of each differ
+from the reference. Fits with different params are only counted as worse if
+their rmse is also higher than that of the reference (i.e. lmfit with finite
+differences can get stuck at a bound, where the others find a better fit).
+Exits with status 1 if any engine has worse fits on more than --max_fraction
+of the curves. """
+
+##### IMPORT #####
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from fittinglibs import fitting, initfits, batchfitting, kineticfits
+
+### MAIN ###
+#set up command line argument parser
+parser = argparse.ArgumentParser(description='check that the fitting engines agree on synthetic curves')
+parser.add_argument('-n', '--num_curves', default=200, type=int,
+                   help='number of curves of each function to fit. default = 200')
+parser.add_argument('--seed', default=0, type=int,
+                   help='random seed of the synthetic curves. default = 0')
+parser.add_argument('--noise', default=0.02, type=float,
+                   help='standard deviation of the noise added to each curve. default = 0.02')
+parser.add_argument('--tolerance', default=1E-3, type=float,
+                   help='largest relative difference from the reference of a fit parameter. the fits stop at xtol and '
+                   'ftol 1E-6, so they agree to about this. default = 1E-3')
+parser.add_argument('--max_fraction', default=0.01, type=float,
+                   help='largest fraction of curves whose fits may be worse than the reference. default = 0.01')
+
+
+def makeBindingCurves(num_curves, noise=0.02, random_state=np.random, default_init=False):
+    """Return the FitParams and synthetic curves of binding_curve, with dGs within the concentrations.
+
+    If default_init, the initial fmax is left as the default of FitParams (NaN)."""
+    x = 2000./np.power(3, np.arange(8))[::-1]
+    fitParams = initfits.FitParams('binding_curve', x)
+    if not default_init:
+        fitParams.update_init_params(fmax={'initial':1.0})
+    params = pd.DataFrame({'fmax':random_state.uniform(0.5, 2, num_curves),
+                           'dG':random_state.uniform(-11, -8, num_curves),
+                           'fmin':random_state.uniform(0, 0.2, num_curves)})
+    ys = pd.DataFrame(fitParams.predict(params) + random_state.normal(0, noise, (num_curves, len(x))))
+    return fitParams, ys
+
+def makeOffRateCurves(num_curves, noise=0.02, random_state=np.random):
+    """Return the FitParams and synthetic curves of rates_off, as fit by fitRatesPerCluster."""
+    times = np.linspace(0, 3000, 15)
+    fitParameters = pd.DataFrame({'fmax':[0, np.nan, np.inf], 'koff':[1E-5, 5E-4, 1], 'fmin':[0, 0.1, np.inf]},
+                                 index=['lowerbound', 'initial', 'upperbound'], columns=['fmax', 'koff', 'fmin'])
+    design = kineticfits.getTileDesigns({0:times}, bleach_fraction=0.995)[0]
+    fitParams = kineticfits.getTileFitParams('rates_off', fitParameters, design)
+    params = pd.DataFrame({'fmax':random_state.uniform(0.5, 2, num_curves),
+                           'koff':np.power(10, random_state.uniform(-3.5, -2.5, num_curves)),
+                           'fmin':random_state.uniform(0, 0.2, num_curves)})
+    ys = pd.DataFrame(fitParams.predict(params) + random_state.normal(0, noise, (num_curves, len(times))))
+    return fitParams, ys
+
+def fitCurvesFiniteDifferences(fitParams, ys):
+    """Fit each curve with lmfit without the analytic jacobian, as fitting.fitSetClusters otherwise would."""
+    sink = fitting.ResultSink(ys.index, fitting.getResultColumns(fitParams.param_names))
+    for i in range(len(ys)):
+        fitting.fitSingleCurve(fitParams.x, ys.iloc[i], fitParams.get_curve_fit_spec(ys.iloc[i]), fitParams.func,
+                               kwargs=fitParams.fit_kws, min_kws={'xtol':1E-6, 'ftol':1E-6, 'maxfev':100},
+                               use_jacobian=False, sink=sink, row=i)
+    return sink.to_dataframe()
+
+def findDifferences(results, reference, param_names):
+    """Return the largest relative difference of the params of each curve from the reference fits."""
+    with np.errstate(all='ignore'):
+        diff = (np.abs(results.loc[:, param_names] - reference.loc[:, param_names])/
+                np.abs(reference.loc[:, param_names]).clip(lower=1E-3))
+    return diff.max(axis=1)
+
+def findWorseFits(results, reference, param_names, tolerance=1E-3):
+    """Return whether the fit of each curve has different params and a higher rmse than the reference."""
+    different = findDifferences(results, reference, param_names) > tolerance
+    worse = (results.rmse > reference.rmse*(1 + tolerance)) | (results.exit_flag <= 0)
+    return different & worse
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    random_state = np.random.RandomState(args.seed)
+
+    failed = False
+    for name, make_curves, engines in [('binding_curve', makeBindingCurves, ['jacobian', 'batched', 'varpro']),
+                                       ('binding_curve, default initial fmax',
+                                        lambda *args, **kwargs: makeBindingCurves(*args, default_init=True, **kwargs),
+                                        ['jacobian', 'batched', 'varpro']),
+                                       ('rates_off', makeOffRateCurves, ['jacobian', 'batched'])]:
+        fitParams, ys = make_curves(args.num_curves, noise=args.noise, random_state=random_state)
+        print '%s: %d curves'%(name, len(ys))
+        reference = fitCurvesFiniteDifferences(fitParams, ys)
+        for engine in engines:
+            if engine == 'jacobian':
+                results = fitting.fitSetClusters(fitParams, ys, print_bool=False)
+            else:
+                results = batchfitting.fitSetClusters(fitParams, ys, print_bool=False,
+                                                      method=('varpro' if engine == 'varpro' else 'leastsq'))
+            diff = findDifferences(results, reference, fitParams.param_names)
+            fraction = findWorseFits(results, reference, fitParams.param_names, tolerance=args.tolerance).mean()
+            print ('\t%-8s median diff %.1e, 99th percentile %.1e, %4.1f%% of curves above %.0e, %4.1f%% worse fits'
+                   %(engine, diff.median(), diff.quantile(0.99), 100*(diff > args.tolerance).mean(), args.tolerance,
+                     100*fraction))
+            if fraction > args.max_fraction:
+                failed = True
+    if failed:
+        print 'Some engines fit worse than lmfit'
+        sys.exit(1)
+    print 'All engines agree with lmfit'
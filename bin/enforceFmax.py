@@ -21,6 +21,8 @@ import pandas as pd
 import sys
 import os
 import argparse
+import shutil
+import tempfile
 import datetime
 import seaborn as sns
 import scipy.stats as st
@@ -28,7 +30,7 @@ from joblib import Parallel, delayed
 import lmfit
 import itertools
 #import ipdb
-from fittinglibs import fitting, plotting, fileio, distribution, variables, initfits, processing
+from fittinglibs import fitting, plotting, fileio, distribution, variables, initfits, processing, parallelfits, checkpoint, telemetry, groupedseries, singlesstore
 
 
 ### MAIN ###
@@ -55,7 +57,45 @@ group.add_argument('--variants',
 group.add_argument('--no_weights',action="store_true", default=False,
                     help="if flagged, won't weight the fit by error bars on median fluorescence")
 group.add_argument('--bs_dGs_path', default=False,
-                    help="if specified, all of the bootstrapped fits will be stored in the bs_dGs_path directory")
+                    help="if specified, all of the bootstrapped fits will be stored in the directory "
+                    "<bs_dGs_path>singles, which can be opened with fittinglibs.singlesstore.loadSingles")
+group.add_argument('--engine', default='lmfit', choices=['lmfit', 'batched', 'varpro'],
+                    help='fitting engine for the bootstrapped curves. "lmfit" fits each curve separately; '
+                    '"batched" fits all curves of a variant at once by a vectorized Levenberg-Marquardt; '
+                    '"varpro" fits all curves of a variant at once by variable projection '
+                    '(batched and varpro: binding_curve only). default="lmfit"')
+group.add_argument('--block_size', type=int,
+                    help='with engine "batched" or "varpro", fit the bootstrapped curves of this many '
+                    'variants at once (not allowed with engine "lmfit"). default is one variant at a time')
+group.add_argument('--checkpoint_dir',
+                    help='directory in which to save chunks of fit variants as they finish. '
+                    'default is the out file name with extension ".checkpoint"')
+group.add_argument('--tolerance', type=float,
+                    help='if given, bootstrap each variant in batches of --min_samples samples, up to n_samples, '
+                    'and stop once the median and 95%% bounds of each fit parameter change by less than this '
+                    'fraction of the width of its 95%% interval. default is to always use n_samples')
+group.add_argument('--min_samples', type=int, default=20,
+                    help='with --tolerance, the number of samples in each batch. default=20')
+group.add_argument('--tmp_dir',
+                    help='directory in which to put the memory-mapped binding series shared with the workers. '
+                    'default is the system temporary directory')
+group.add_argument('--chunks_per_core', type=int, default=8,
+                    help='number of chunks of variants of about equal estimated cost per core. Chunks '
+                    'are handed out to cores as they free up, most costly first. default=8')
+group.add_argument('--resume', action="store_true", default=False,
+                    help='if flagged, only fit the variants not already saved in the checkpoint '
+                    'directory by a previous, interrupted run with the same inputs')
+group.add_argument('--seed', type=int,
+                    help='if given, the random draws of each variant (bootstrap samples, fmaxes and '
+                    'weights) come from its own random state, derived from this seed and the variant id, '
+                    'so that results are reproducible whatever the number of cores or chunks. '
+                    'default is the global random state')
+group.add_argument('--incremental', nargs='?', const='', metavar='prev.CPvariant.gz',
+                    help='if flagged, only fit the variants whose inputs (cluster values, initial points, '
+                    'fmax distribution and fit options) changed since a previous run, and keep the '
+                    'previous results (and bootstrapped fits, if --bs_dGs_path is the same) of the others. '
+                    'The previous run is the out file, unless given. Use with --seed to get the same '
+                    'results as refitting everything')
 
 
 
@@ -69,13 +109,20 @@ group.add_argument('--params_vary', nargs='+', type=int, help='whether to vary v
 group.add_argument('--params_lb', nargs='+', type=float, help='new lowerbound val(s) of param(s) to edit.')
 group.add_argument('--params_ub', nargs='+', type=float, help='new upperbound val(s) of param(s) to edit.')
 ##### functions #####
+# estimated times (ms) to fit a variant, measured on binding curves: each lmfit fit of a
+# bootstrapped curve or each curve of a batched solve, finding the weights, and the rest
+fit_costs = {'lmfit':4., 'batched':0.05, 'varpro':0.05}
+weights_cost = 2.
+variant_cost = 10.
+
 def makeGroupDict(bindingSeries, annotatedClusters):
-    """ Return the fluorescence values, split by variant. """
+    """ Return the fluorescence values, grouped by variant (a groupedseries.GroupedSeries). """
     
     # load binding series information with variant numbers
     cols = bindingSeries.columns.tolist()
     fluorescenceMat = pd.concat([annotatedClusters, bindingSeries.astype(float)], axis=1)
-    return fluorescenceMat.dropna(subset=['variant_number']).dropna(subset=cols, thresh=4).set_index('variant_number', append=True).swaplevel(0, 1).sort_index()
+    fluorescenceMat = fluorescenceMat.dropna(subset=['variant_number']).dropna(subset=cols, thresh=4).set_index('variant_number', append=True).swaplevel(0, 1).sort_index()
+    return groupedseries.GroupedSeries.from_multiindex(fluorescenceMat.loc[:, cols])
 """
     # fit all labeled variants
     fluorescenceMat.dropna(subset=['variant_number'], inplace=True)
@@ -90,6 +137,93 @@ def makeGroupDict(bindingSeries, annotatedClusters):
     return bindingSeriesDict
 """
 
+def saveSharedVariants(shared_dir, bindingSeriesDict, initialPoints, variants, param_names):
+    """Save the binding series and initial points of variants, in order, to be memory mapped by the workers."""
+    bindingSeriesDict.subset(variants).save(shared_dir)
+    parallelfits.saveSharedArray(os.path.join(shared_dir, 'initial_points.npy'),
+                                 initialPoints.loc[variants, param_names].values.astype(float))
+    return shared_dir
+
+def loadSharedVariants(fitParams, fmaxDistObject, shared_dir, start, stop):
+    """Return a MoreFitParams with variants start to stop of those saved by saveSharedVariants, memory mapped read-only."""
+    binding_series_dict = groupedseries.GroupedSeries.load(shared_dir, start, stop)
+    initial_points = pd.DataFrame(parallelfits.loadSharedArray(os.path.join(shared_dir, 'initial_points.npy'))[start:stop],
+                                  index=binding_series_dict.variants, columns=fitParams.param_names)
+    return initfits.MoreFitParams(fitParams, initial_points=initial_points, binding_series_dict=binding_series_dict,
+                                  fmax_dist_obj=fmaxDistObject)
+
+def fitVariantRange(fitParams, fmaxDistObject, shared_dir, start, stop, variant_checkpoint=None, **kwargs):
+    """Fit variants start to stop with fitting.fitSetVariants, and save the results to the checkpoint.
+
+    The variants are memory mapped from shared_dir (see saveSharedVariants). Returns
+    the worker process id and the start and stop times of the fit."""
+    t0 = datetime.datetime.now()
+    variantParams = loadSharedVariants(fitParams, fmaxDistObject, shared_dir, start, stop)
+    results = fitting.fitSetVariants(variantParams, variants=variantParams.binding_series_dict.variants.tolist(), **kwargs)
+    if variant_checkpoint is not None:
+        variant_checkpoint.save_range(start, stop, results)
+    return {'worker':os.getpid(), 'start':t0, 'stop':datetime.datetime.now()}
+
+def estimateVariantCosts(bindingSeriesDict, fmaxDistObject, variants, n_samples=100, enforce_fmax=None,
+                         weighted_fit=True, engine='lmfit'):
+    """Return the estimated time (ms) to fit each variant.
+
+    The time is mostly set by the number of bootstrap fits (fitting.getNumBootstrapFits),
+    which depends on the number of clusters and whether fmax is enforced, and by
+    finding the weights, which is only done for variants with at least 5 clusters."""
+    num_tests = bindingSeriesDict.num_tests().reindex(variants).fillna(0).astype(int)
+    if enforce_fmax is None:
+        # same decision as fitting.enforceFmaxDistribution on the median curve
+        last_points = bindingSeriesDict.medians().iloc[:, -1].reindex(variants)
+        lowerbounds = {n:fmaxDistObject.getDist(n).ppf(0.01) for n in num_tests.unique() if n > 0}
+        enforced = (last_points < num_tests.map(lowerbounds)).values
+    else:
+        enforced = np.ones(len(variants), dtype=bool)*bool(enforce_fmax)
+    num_fits = np.array([fitting.getNumBootstrapFits(n, n_samples, enforce) for n, enforce in zip(num_tests, enforced)])
+    costs = variant_cost + fit_costs[engine]*num_fits + weights_cost*(weighted_fit & (num_tests.values >= 5))
+    return pd.Series(np.where(num_tests > 0, costs, 0), index=variants)
+
+def getFingerprint(filenames, fitParams, variants, **kwargs):
+    """Return the fingerprint of a run from its input files, fit parameters, variants, and options."""
+    file_digests = [checkpoint.hashFile(filename) for filename in filenames]
+    fit_spec = fitParams.get_fit_spec()
+    return checkpoint.fingerprint(file_digests, fitParams.func_name, fitParams.x, fit_spec.names,
+                                  fit_spec.init, fit_spec.lb, fit_spec.ub, fit_spec.vary,
+                                  '\n'.join([str(variant) for variant in variants]),
+                                  {key:str(val) for key, val in kwargs.items()})
+
+def getVariantFingerprints(bindingSeriesDict, initialPoints, variants, param_names, run_fingerprint):
+    """Return the fingerprint of the inputs of each variant.
+
+    The fingerprint of a variant is a hash of the values and ids of its clusters, its
+    initial points, and run_fingerprint, the fingerprint of the inputs shared by all
+    variants (see getFingerprint)."""
+    initial_points = initialPoints.loc[variants, param_names].values.astype(float)
+    return pd.Series([checkpoint.fingerprint(run_fingerprint, bindingSeriesDict.get_values(variant),
+                                             '\n'.join(bindingSeriesDict.get_cluster_ids(variant).astype(str)), points)
+                      for variant, points in zip(variants, initial_points)], index=variants)
+
+def getFingerprintFilename(variant_filename):
+    """Return the file of the variant fingerprints saved with a .CPvariant file."""
+    return fileio.stripExtension(variant_filename) + '.fingerprints.gz'
+
+def findUnchangedVariants(fingerprints, previous_filename):
+    """Return the variants with the same fingerprint as in a previous run, and the previous results of those.
+
+    The previous fingerprints are read from the file next to the previous results
+    (see getFingerprintFilename)."""
+    fingerprint_filename = getFingerprintFilename(previous_filename)
+    if not os.path.exists(previous_filename) or not os.path.exists(fingerprint_filename):
+        print 'Could not find previous results and fingerprints %s and %s. Fitting all variants'%(
+            previous_filename, fingerprint_filename)
+        return [], None
+    previous_results = fileio.loadFile(previous_filename)
+    previous_fingerprints = pd.read_csv(fingerprint_filename, sep='\t', index_col=0).fingerprint
+    unchanged = ((previous_fingerprints.reindex(fingerprints.index).values == fingerprints.values)&
+                 fingerprints.index.isin(previous_results.index))
+    unchanged_variants = fingerprints.index[unchanged].tolist()
+    return unchanged_variants, previous_results.loc[unchanged_variants]
+
 def findInitialPoints(variant_table, variants):
     """Return initial points from variant table."""
     # make sure initial points have all of keys that table does
@@ -148,6 +282,8 @@ def parseResults(variant_table, results):
 if __name__ == '__main__':
     # load files
     args = parser.parse_args()
+    if args.block_size is not None and args.block_size > 1 and args.engine == 'lmfit':
+        parser.error('--block_size > 1 needs --engine "batched" or "varpro"')
     
     variantFile = args.variant_file
     annotatedClusterFile  = args.annotated_clusters
@@ -173,6 +309,8 @@ if __name__ == '__main__':
             outFile = basename + '_subset.CPvariant.gz'
         else:
             outFile = basename + '.CPvariant.gz'
+    if args.checkpoint_dir is None:
+        args.checkpoint_dir = fileio.stripExtension(outFile) + '.checkpoint'
 
     # load data
     print "Loading binding fluorescence..."
@@ -191,7 +329,7 @@ if __name__ == '__main__':
 
     # process bindign series into per-variant dict
     bindingSeriesDict = makeGroupDict(bindingSeries, annotatedClusters)
-    medianBindingSeries = bindingSeriesDict.groupby(level=0).median()
+    medianBindingSeries = bindingSeriesDict.medians()
 
     # find initial points
     #initialPoints = findInitialPoints(variantTable, bindingSeriesDict.keys())
@@ -215,31 +353,74 @@ if __name__ == '__main__':
         
     # initiate fits
 
-    # actually split by cores
-    print '\tSplitting data into %d pieces...'%numCores
-    variantsSplit = [list(vec) for vec in np.array_split(variants, numCores)]
-    variantParamsSplit = [initfits.MoreFitParams(fitParams, initial_points=initialPoints.loc[variantSet],
-                                                 binding_series_dict=bindingSeriesDict.loc[variantSet],
-                                                 fmax_dist_obj=fmaxDistObject)
-                          for variantSet in variantsSplit]
-
-    printBools = [True] + [False]*(numCores-1)
+    # split into chunks of variants. Each chunk is saved to the checkpoint when it is done,
+    # and if resuming, only the variants not saved by a previous run are fit.
+    fit_kwargs = dict(n_samples=n_samples, enforce_fmax=enforce_fmax, weighted_fit=weighted_fit,
+                      bs_dGs_path=bs_dGs_path, engine=args.engine, block_size=args.block_size,
+                      tolerance=args.tolerance, min_samples=args.min_samples, seed=args.seed)
+
+    # fingerprint the inputs of each variant, and if incremental, only fit the variants
+    # whose fingerprint changed since the previous run
+    fingerprints = getVariantFingerprints(
+        bindingSeriesDict, initialPoints, variants, fitParams.param_names,
+        getFingerprint([fmaxDistFile], fitParams, [],
+                       **{key:val for key, val in fit_kwargs.items() if key != 'bs_dGs_path'}))
+    unchanged_variants, previous_results = [], None
+    if args.incremental is not None:
+        previous_filename = args.incremental if args.incremental else outFile
+        unchanged_variants, previous_results = findUnchangedVariants(fingerprints, previous_filename)
+        print '\t%d of %d variants are unchanged since %s'%(len(unchanged_variants), len(variants), previous_filename)
+        unchanged = set(unchanged_variants)
+        variants = [variant for variant in variants if variant not in unchanged]
+    variant_checkpoint = checkpoint.Checkpoint(args.checkpoint_dir,
+                                               getFingerprint([fmaxDistFile, variantFile, bindingCurveFilename, annotatedClusterFile],
+                                                              fitParams, variants, **fit_kwargs))
+    variant_checkpoint.start(resume=args.resume)
+    if bs_dGs_path and not args.resume:
+        singlesstore.clearSingles(bs_dGs_path)
+    # chunks have about equal estimated cost, and are handed out to workers as they
+    # free up, most costly first, so that no worker is left with a long chunk at the end
+    costs = estimateVariantCosts(bindingSeriesDict, fmaxDistObject, variants, n_samples=n_samples,
+                                 enforce_fmax=enforce_fmax, weighted_fit=weighted_fit, engine=args.engine).values
+    missing_ranges = variant_checkpoint.missing_ranges(len(variants))
+    num_chunks = numCores*args.chunks_per_core
+    total_cost = max(sum([costs[start:stop].sum() for start, stop in missing_ranges]), 1E-9)
+    ranges = [chunk for start, stop in missing_ranges
+              for chunk in parallelfits.getBalancedRanges(costs, start, stop,
+                                                          max(int(np.ceil(num_chunks*costs[start:stop].sum()/total_cost)), 1))]
+    ranges = sorted(ranges, key=lambda chunk: -costs[chunk[0]:chunk[1]].sum())
+    print '\tSplitting %d variants left to fit into %d pieces...'%(sum([stop - start for start, stop in ranges]), len(ranges))
+
+    printBools = [True] + [False]*(len(ranges)-1)
 
     print '\tMultiprocessing bootstrapping...'
 
-    # parallelize fitting
-    # John edits
-    results = (Parallel(n_jobs=numCores, verbose=10)
-                (delayed(fitting.fitSetVariants)(variantParams,
-                                        n_samples=n_samples,
-                                        enforce_fmax=enforce_fmax,
-                                        weighted_fit=weighted_fit,
-                                        bs_dGs_path=bs_dGs_path,
-                                        print_bool=printbool)
-                 for variantParams, printbool  in zip(variantParamsSplit, printBools)))      
-    # end John edits
+    # write binding series and initial points once, in the order of variants. Tasks
+    # only carry the range of variants to fit, and workers memory map the data
+    shared_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        saveSharedVariants(shared_dir, bindingSeriesDict, initialPoints, variants, fitParams.param_names)
+        # parallelize fitting
+        # John edits
+        chunk_times = (Parallel(n_jobs=numCores, verbose=10, batch_size=1)
+         (delayed(fitVariantRange)(fitParams, fmaxDistObject, shared_dir, start, stop,
+                                   variant_checkpoint=variant_checkpoint,
+                                   print_bool=printbool,
+                                   **fit_kwargs)
+          for (start, stop), printbool in zip(ranges, printBools)))
+        # end John edits
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    variant_checkpoint.write_manifest(num_rows=len(variants))
+    if len(chunk_times) > 0:
+        chunk_times = pd.DataFrame(chunk_times)
+        chunk_times.loc[:, 'num_rows'] = [stop - start for start, stop in ranges]
+        chunk_times.loc[:, 'cost'] = [costs[start:stop].sum() for start, stop in ranges]
+        print telemetry.getUtilizationReport(chunk_times)
      
-    results = pd.concat(results).sort_index()
+    results = pd.concat([variant_checkpoint.load_range(start, stop)
+                         for start, stop in variant_checkpoint.finished_ranges()] +
+                        ([previous_results] if previous_results is not None else [])).sort_index()
 
         
     # fit
@@ -247,8 +428,18 @@ if __name__ == '__main__':
 
     # save
     results.to_csv(outFile , sep='\t', index=True, compression='gzip')
+    fingerprints.reindex(results.index).to_frame('fingerprint').to_csv(getFingerprintFilename(outFile), sep='\t',
+                                                                      index=True, compression='gzip')
 
     variantParams = initfits.MoreFitParams(fitParams, initial_points=initialPoints, binding_series_dict=bindingSeriesDict, fmax_dist_obj=fmaxDistObject)
     
     variantParams.results_all = results
     fileio.saveFile(fileio.stripExtension(outFile) + '.variantParams.p', variantParams)
+
+    # the checkpoint is not needed once the results are saved
+    variant_checkpoint.remove()
+
+    # combine the singles saved by each worker
+    if bs_dGs_path:
+        print 'Saved bootstrapped fits to %s'%singlesstore.mergeSingles(
+            bs_dGs_path, keep=unchanged_variants if args.incremental is not None else None)
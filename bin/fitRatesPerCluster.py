@@ -15,7 +15,7 @@ import scipy.stats as st
 import matplotlib.pyplot as plt
 from joblib import Parallel, delayed
 import lmfit
-from fittinglibs import fitting, distribution, fileio
+from fittinglibs import fitting, distribution, fileio, kineticfits
 
 ### MAIN ###
 
@@ -43,6 +43,21 @@ group.add_argument('--pb_correct',default = 1, type=float, metavar="N",
                     help='use this value for photobleaching amount per image')
 group.add_argument('-id', '--image_n_dict', metavar="imageNDict.p",
                    help='file containining the per-tile image number to use for pb correction')
+group.add_argument('--engine', default='batched', choices=['lmfit', 'batched'],
+                   help='fit the clusters of each tile in vectorized blocks ("batched") or one at a time '
+                   'with lmfit ("lmfit"). default = batched')
+group.add_argument('--batch_size', default=2000, type=int, metavar="N",
+                   help='number of clusters per block of the batched engine. default = 2000')
+group.add_argument('--incremental', nargs='?', const='', metavar='prev.CPfitted.pkl',
+                   help='if flagged, update the fits of a previous run (default: the out file) given new time '
+                   'points: clusters with new values are refit starting from their previous fit, unless their '
+                   'fit already converged (see --tolerance). Clusters without new values are not refit.')
+group.add_argument('--tolerance', default=0.01, type=float, metavar="N",
+                   help='with --incremental, the fit of a cluster has converged once its rate changes by less '
+                   'than this fraction between two runs. default = 0.01')
+group.add_argument('--refit_fraction', default=0.5, type=float, metavar="N",
+                   help='with --incremental, clusters whose fit converged are refit anyway once they have more '
+                   'than this fraction more values than they were last fit on. default = 0.5')
 
 def getInitialParameters(times, fittype=None):
     """ Get standard set of fit parameters across all variants depending on fittype."""
@@ -95,51 +110,18 @@ def findDefaultImageNs(timeDict):
 
 def splitAndFit(bindingSeries, timeDict, tileSeries, fitParameters, numCores,
                 index=None, change_params=None, func=None, bleach_fraction=None,
-                imageNDict=None):
-    """ Given a table, split by tile and fit. """
-    if index is None:
-        index = bindingSeries.index
-    
-    if imageNDict is None:
-        imageNDict = findDefaultImageNs(timeDict)
-
-    # split into parts
-    print 'Splitting clusters into %d groups:'%numCores
-    tiles = timeDict.keys()
-    numTiles = len(tiles)
-    sizePerTile = tileSeries.loc[index].value_counts()
-    avgSplitPerTile = sizePerTile/sizePerTile.sum()*numCores
-    splitPerTile = np.around(avgSplitPerTile)
-    
-    # change number of splits per tile to make sure number of splits corresponds to number of cores
-    if splitPerTile.sum() > numCores:
-        diff = splitPerTile.sum() - numCores
-        index_to_subtract = avgSplitPerTile.loc[splitPerTile > 1].order().index[:diff]
-        splitPerTile.loc[index_to_subtract] -= 1
-    elif splitPerTile.sum() < numCores:
-        diff = numCores - splitPerTile.sum()
-        index_to_add = avgSplitPerTile.order(ascending=False).index[:diff]
-        splitPerTile.loc[index_to_add] += 1
-
-    # split CPseries    
-    bindingSeriesSplit = {}
-    for tile, numSplits in splitPerTile.iteritems():
-        mat = bindingSeries.loc[index].loc[tileSeries.loc[index]==tile].dropna(axis=0, thresh=5).copy()
-        indicesSplit = np.array_split(mat.index.tolist(), numSplits)
-        for i, indices in enumerate(indicesSplit):
-            bindingSeriesSplit[(tile, i)] = mat.loc[indices]
-            
-    printBools = [True] + [False]*(numCores-1)
-
-    print 'Fitting binding curves:'
-    fits = (Parallel(n_jobs=numCores, verbose=10)
-            (delayed(fitting.fitSetClusters)
-             (np.array(timeDict[tile]), bindingSeriesSplit[(tile, idx)], fitParameters,
-              printBools[i], change_params, func, kwargs={'bleach_fraction':bleach_fraction,
-                                                          'image_ns':imageNDict[tile]})
-             for i, (tile, idx) in enumerate(bindingSeriesSplit.keys())))
-
-    return pd.concat(fits)
+                imageNDict=None, engine='batched', batch_size=2000):
+    """ Given a table, split by tile and fit.
+
+    func is the name of the rate function ('rates_off' or 'rates_on'). The
+    clusters of each tile share its times and photobleaching, and are fit
+    together (see kineticfits.fitRatesPerTile). """
+    if bleach_fraction is None:
+        bleach_fraction = 1
+    return kineticfits.fitRatesPerTile(bindingSeries, tileSeries, timeDict, fitParameters, func,
+                                       numCores=numCores, index=index, imageNDict=imageNDict,
+                                       bleach_fraction=bleach_fraction, change_params=bool(change_params),
+                                       engine=engine, batch_size=batch_size)
 
 def getMeanTimes(timeDict):
     binwidth = np.min([(np.sort(times)[1:] - np.sort(times)[:-1]).min()
@@ -165,10 +147,8 @@ if __name__ == '__main__':
     if outFile is None:
         outFile = fileio.stripExtension(bindingSeriesFile)
         
-    if fittype == 'off':
-        func = fitting.objectiveFunctionOffRates
-    elif fittype == 'on':
-        func = fitting.objectiveFunctionOnRates
+    if fittype in kineticfits.rate_funcs:
+        func = kineticfits.rate_funcs[fittype]
     else:
         print ('Error: fittype "%s" not recognized. Valid options are '
                '"on" or "off".')%fittype
@@ -198,15 +178,28 @@ if __name__ == '__main__':
       
     # subset if option is given
     if args.subset:
-        num = 5E3
+        num = 5000
         index = bindingSeries.index[::num]
         outFile = outFile + '_subset'
     else:
         index = bindingSeries.index
     
-    # fit single clusters
-    cluster_data = splitAndFit(bindingSeries, timeDict, tileSeries, fitParameters, numCores,
-                index=index, change_params=True, func=func, bleach_fraction=bleach_fraction, imageNDict=imageNDict)
+    # fit single clusters. if incremental, only refit the clusters with new values that
+    # have not converged since the previous run
+    if args.incremental is None:
+        cluster_data = splitAndFit(bindingSeries, timeDict, tileSeries, fitParameters, numCores,
+                    index=index, change_params=True, func=func, bleach_fraction=bleach_fraction, imageNDict=imageNDict,
+                    engine=args.engine, batch_size=args.batch_size)
+        cluster_state = kineticfits.getClusterStates(bindingSeries, tileSeries, cluster_data, func,
+                                                     tolerance=args.tolerance)
+    else:
+        previous_filename = args.incremental if args.incremental else outFile+'.CPfitted.pkl'
+        cluster_data, cluster_state = kineticfits.fitRatesIncremental(
+            bindingSeries, tileSeries, timeDict, fitParameters, func, previous_filename=previous_filename,
+            tolerance=args.tolerance, refit_fraction=args.refit_fraction, numCores=numCores, index=index, imageNDict=imageNDict,
+            bleach_fraction=bleach_fraction, change_params=True, engine=args.engine, batch_size=args.batch_size)
     cluster_data.to_pickle(outFile+'.CPfitted.pkl')
+    kineticfits.saveClusterStates(cluster_state, kineticfits.getRunFingerprint(func, bleach_fraction=bleach_fraction),
+                                  kineticfits.getStateFilename(outFile+'.CPfitted.pkl'))
 
     sys.exit()
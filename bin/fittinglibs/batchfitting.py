@@ -0,0 +1,490 @@
+"""Fit many curves at once with a vectorized Levenberg-Marquardt solver.
+
+fitting.fitSingleCurve calls lmfit.minimize once per curve, which means almost
+all of the time is spent in python overhead. Here a block of curves is stacked
+into a matrix and every iteration of the solve is done on the whole block.
+
+Bounds are honored with the same Minuit-style transformation lmfit uses, and
+the output has the same columns as fitting.fitSingleCurve.
+"""
+import numpy as np
+import pandas as pd
+import sys
+import os
+import datetime
+from fittinglibs import fitting, objfunctions
+
+
+# models that can be fit with the batched solver (all with a batched form in objfunctions)
+batch_funcs = objfunctions.batch_funcs
+
+
+def _clean_bounds(lb, ub):
+    """Return float arrays of bounds with missing values set to +/- inf."""
+    lb = np.array(lb, dtype=float)
+    ub = np.array(ub, dtype=float)
+    lb[np.isnan(lb)] = -np.inf
+    ub[np.isnan(ub)] = np.inf
+    return lb, ub
+
+def _to_internal(p, lb, ub):
+    """Return Minuit-style internal values for bounded params (as in lmfit)."""
+    has_lb = np.isfinite(lb)
+    has_ub = np.isfinite(ub)
+    with np.errstate(all='ignore'):
+        both = np.arcsin(np.clip(2*(p - lb)/(ub - lb) - 1, -1, 1))
+        lower = np.sqrt(np.maximum((p - lb + 1)**2 - 1, 0))
+        upper = np.sqrt(np.maximum((ub - p + 1)**2 - 1, 0))
+    return np.where(has_lb&has_ub, both,
+                    np.where(has_lb, lower,
+                             np.where(has_ub, upper, p)))
+
+def _from_internal(u, lb, ub):
+    """Return external values and their derivative with respect to internal values."""
+    has_lb = np.isfinite(lb)
+    has_ub = np.isfinite(ub)
+    with np.errstate(all='ignore'):
+        root = np.sqrt(u*u + 1)
+        p = np.where(has_lb&has_ub, lb + (np.sin(u) + 1)*(ub - lb)/2.,
+                     np.where(has_lb, lb - 1 + root,
+                              np.where(has_ub, ub + 1 - root, u)))
+        grad = np.where(has_lb&has_ub, np.cos(u)*(ub - lb)/2.,
+                        np.where(has_lb, u/root,
+                                 np.where(has_ub, -u/root, 1.)))
+    return p, grad
+
+def _solve(a, b):
+    """Solve a batch of linear systems, giving nan for singular ones."""
+    try:
+        return np.linalg.solve(a, b[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        x = np.ones(b.shape)*np.nan
+        for i in range(len(a)):
+            try:
+                x[i] = np.linalg.solve(a[i], b[i])
+            except np.linalg.LinAlgError:
+                pass
+        return x
+
+def _invert(a):
+    """Invert a batch of matrices, giving nan for singular ones."""
+    try:
+        return np.linalg.inv(a)
+    except np.linalg.LinAlgError:
+        inv = np.ones(a.shape)*np.nan
+        for i in range(len(a)):
+            try:
+                inv[i] = np.linalg.inv(a[i])
+            except np.linalg.LinAlgError:
+                pass
+        return inv
+
+def levenbergMarquardt(model, x, y, init, lb, ub, vary, weights=None,
+                       xtol=1E-6, ftol=1E-6, gtol=1E-7, maxfev=100, kwargs={}):
+    """Fit a block of curves to a model with a vectorized Levenberg-Marquardt solve.
+
+    Parameters:
+    -----------
+    model : batched objective function (see objfunctions.batch_funcs), taking
+        (params, x, return_jacobian=True, **kwargs) with params (n_curves, n_params), and
+        returning model values (n_curves, n_x) and jacobian (n_curves, n_x, n_params).
+    x : x values shared by all curves.
+    y : (n_curves, n_x) matrix of data. NaN values are left out of the fit.
+    init, lb, ub : (n_curves, n_params) initial values and bounds.
+    vary : (n_params,) bool mask of parameters to fit.
+    weights : None, (n_x,) or (n_curves, n_x) weights on the residuals.
+
+    Returns:
+    --------
+    dict of arrays with keys 'params', 'stderr', 'residual', 'exit_flag', 'nfev'.
+    exit_flag follows the MINPACK convention of lmfit's 'ier' (5 if maxfev was reached).
+    """
+    y = np.asarray(y, dtype=float)
+    num_curves, num_x = y.shape
+    lb, ub = _clean_bounds(lb, ub)
+    lb = np.ones((num_curves, len(vary)))*lb
+    ub = np.ones((num_curves, len(vary)))*ub
+    vary = np.asarray(vary, dtype=bool)
+    params = np.clip(np.ones((num_curves, len(vary)))*np.asarray(init, dtype=float), lb, ub)
+
+    # NaN values are given zero weight
+    mask = np.isfinite(y)
+    y = np.where(mask, y, 0)
+    if weights is None:
+        weights = mask.astype(float)
+    else:
+        weights = np.where(mask, np.ones(y.shape)*weights, 0)
+
+    lb_v, ub_v = lb[:, vary], ub[:, vary]
+    u = _to_internal(params[:, vary], lb_v, ub_v)
+
+    def evaluate(rows, u_rows):
+        """Return weighted residuals and jacobian w.r.t. internal params."""
+        p = params[rows].copy()
+        p[:, vary], grad = _from_internal(u_rows, lb_v[rows], ub_v[rows])
+        with np.errstate(all='ignore'):
+            fit, jac = model(p, x, return_jacobian=True, **kwargs)
+        w = weights[rows]
+        resid = (fit - y[rows])*w
+        jac = jac[:, :, vary]*w[:, :, np.newaxis]*grad[:, np.newaxis, :]
+        return resid, jac, p
+
+    resid, jac, p = evaluate(np.arange(num_curves), u)
+    cost = (resid**2).sum(axis=1)
+    if not vary.any():
+        # nothing to fit, so curves are done at their initial params
+        return {'params':p, 'stderr':np.zeros(p.shape), 'residual':resid,
+                'exit_flag':np.where(np.isfinite(cost), 1, 0), 'nfev':np.ones(num_curves, dtype=int)}
+    lam = np.ones(num_curves)*1E-3
+    scale = np.zeros(u.shape)
+    nfev = np.ones(num_curves, dtype=int)
+    exit_flag = np.zeros(num_curves, dtype=int)
+    active = np.isfinite(cost)
+
+    while active.any():
+        rows = np.flatnonzero(active)
+        j = jac[rows]
+        r = resid[rows]
+        jtj = np.einsum('nij,nik->njk', j, j)
+        jtr = np.einsum('nij,ni->nj', j, r)
+
+        # check gradient (gtol) convergence before taking a step
+        with np.errstate(all='ignore'):
+            col_norms = np.sqrt(np.einsum('njj->nj', jtj))
+            gnorm = np.nanmax(np.abs(jtr)/(col_norms*np.sqrt(cost[rows])[:, np.newaxis]), axis=1)
+        done = (gnorm <= gtol)|(cost[rows] == 0)
+        exit_flag[rows[done]] = 4
+        active[rows[done]] = False
+        rows, jtj, jtr = rows[~done], jtj[~done], jtr[~done]
+        if len(rows) == 0:
+            break
+
+        # damped step. As in MINPACK, the scaling of each parameter never decreases,
+        # so parameters near their bounds don't take unbounded steps.
+        scale[rows] = np.maximum(scale[rows], np.einsum('njj->nj', jtj))
+        diag = np.maximum(scale[rows], 1E-12)
+        damped = jtj + lam[rows, np.newaxis, np.newaxis]*(diag[:, :, np.newaxis]*np.eye(diag.shape[1]))
+        step = _solve(damped, -jtr)
+        u_new = u[rows] + step
+
+        resid_new, jac_new, _ = evaluate(rows, u_new)
+        cost_new = (resid_new**2).sum(axis=1)
+        nfev[rows] += 1
+
+        # accept steps that decrease cost
+        accept = np.isfinite(cost_new)&(cost_new < cost[rows])
+        with np.errstate(all='ignore'):
+            rel_reduction = (cost[rows] - cost_new)/cost[rows]
+            step_size = np.sqrt((step**2).sum(axis=1))
+            u_size = np.sqrt((u[rows]**2).sum(axis=1))
+        conv_f = accept&(rel_reduction <= ftol)
+        conv_x = np.isfinite(step_size)&(step_size <= xtol*(u_size + xtol))
+
+        accepted = rows[accept]
+        u[accepted] = u_new[accept]
+        resid[accepted] = resid_new[accept]
+        jac[accepted] = jac_new[accept]
+        cost[accepted] = cost_new[accept]
+        lam[accepted] = np.maximum(lam[accepted]/10., 1E-12)
+        lam[rows[~accept]] *= 10
+
+        # update which curves are finished
+        flag = np.where(conv_f&conv_x, 3, np.where(conv_f, 1, np.where(conv_x, 2, 0)))
+        flag[(flag == 0)&(lam[rows] > 1E16)] = 2
+        flag[(flag == 0)&(nfev[rows] >= maxfev)] = 5
+        # curves with a non-finite step failed, and stop with exit flag 0
+        stop = (flag > 0)|~np.isfinite(step_size)
+        exit_flag[rows[stop]] = flag[stop]
+        active[rows[stop]] = False
+
+    # find final params and standard errors (external coordinates)
+    resid, jac, params = evaluate(np.arange(num_curves), u)
+    _, grad = _from_internal(u, lb_v, ub_v)
+    with np.errstate(all='ignore'):
+        jac_ext = jac/grad[:, np.newaxis, :]
+    stderr = _find_stderr(jac_ext, resid, mask, vary)
+
+    return {'params':params, 'stderr':stderr, 'residual':resid,
+            'exit_flag':exit_flag, 'nfev':nfev}
+
+def _find_stderr(jac, resid, mask, vary):
+    """Return standard errors of params from the (weighted) jacobian of the varying params.
+
+    As in lmfit, the covariance is scaled by the reduced chi square, and
+    stderr is zero for params that don't vary or if the covariance is singular."""
+    with np.errstate(all='ignore'):
+        covar = _invert(np.einsum('nij,nik->njk', jac, jac))
+        nfree = mask.sum(axis=1) - vary.sum()
+        redchi = (resid**2).sum(axis=1)/nfree
+        stderr_v = np.sqrt(np.einsum('njj->nj', covar)*redchi[:, np.newaxis])
+    stderr = np.zeros((len(resid), len(vary)))
+    stderr[:, vary] = np.where(np.isfinite(stderr_v), stderr_v, 0)
+    return stderr
+
+def _bounded_linear_solve(frac, y, w, init, lb, ub, vary):
+    """Return the bounded least squares fmax, fmin and cost of y ~ fmin + fmax*frac.
+
+    frac is (n_curves, n_points, n_x) and y, w are (n_curves, n_x); the solve is
+    done independently for each of the n_points. Params that don't vary are held
+    at init. The problem is convex, so if the unconstrained solution is outside the
+    bounds, the optimum is on an edge, where the 1D solution can be clipped."""
+    w2 = (w*w)[:, np.newaxis, :]
+    yy = y[:, np.newaxis, :]
+    s_ff = (w2*frac*frac).sum(axis=2)
+    s_f1 = (w2*frac).sum(axis=2)
+    s_11 = w2.sum(axis=2)*np.ones(s_ff.shape)
+    s_fy = (w2*frac*yy).sum(axis=2)
+    s_1y = (w2*yy).sum(axis=2)
+    s_yy = (w2*yy*yy).sum(axis=2)
+
+    (lb_a, lb_b), (ub_a, ub_b) = [(bound[:, [0]], bound[:, [1]]) for bound in [lb, ub]]
+    init_a, init_b = init[:, [0]]*np.ones(s_ff.shape), init[:, [1]]*np.ones(s_ff.shape)
+
+    def cost(a, b):
+        return s_yy - 2*a*s_fy - 2*b*s_1y + a*a*s_ff + 2*a*b*s_f1 + b*b*s_11
+    def solve_a(b):
+        return np.clip((s_fy - b*s_f1)/s_ff, lb_a, ub_a)
+    def solve_b(a):
+        return np.clip((s_1y - a*s_f1)/s_11, lb_b, ub_b)
+
+    with np.errstate(all='ignore'):
+        if vary[0] and vary[1]:
+            det = s_ff*s_11 - s_f1*s_f1
+            a_free = (s_fy*s_11 - s_1y*s_f1)/det
+            b_free = (s_1y*s_ff - s_fy*s_f1)/det
+            candidates = [(a_free, b_free, (a_free >= lb_a)&(a_free <= ub_a)&
+                                           (b_free >= lb_b)&(b_free <= ub_b))]
+            for bound in [lb_a, ub_a]:
+                a = bound*np.ones(s_ff.shape)
+                candidates.append((a, solve_b(a), np.isfinite(a)))
+            for bound in [lb_b, ub_b]:
+                b = bound*np.ones(s_ff.shape)
+                candidates.append((solve_a(b), b, np.isfinite(b)))
+            costs = np.array([np.where(valid&np.isfinite(a)&np.isfinite(b), cost(a, b), np.inf)
+                              for a, b, valid in candidates])
+            best = np.argmin(costs, axis=0)
+            a = np.choose(best, [candidate[0] for candidate in candidates])
+            b = np.choose(best, [candidate[1] for candidate in candidates])
+        elif vary[0]:
+            b = init_b
+            a = solve_a(b)
+        elif vary[1]:
+            a = init_a
+            b = solve_b(a)
+        else:
+            a, b = init_a, init_b
+        return a, b, cost(a, b)
+
+def variableProjection(x, y, init, lb, ub, vary, weights=None, num_grid=25, num_iter=40):
+    """Fit a block of binding curves by variable projection.
+
+    The binding curve is linear in fmax and fmin, so for any dG the best fmax and fmin
+    come from a bounded linear solve. The only nonlinear search is then over dG within
+    its bounds: a coarse grid followed by golden section search around the best grid point.
+
+    Inputs and outputs are the same as levenbergMarquardt, with params in the
+    order fmax, dG, fmin."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    num_curves = len(y)
+    vary = np.asarray(vary, dtype=bool)
+    lb, ub = _clean_bounds(lb, ub)
+    lb = np.ones((num_curves, 3))*lb
+    ub = np.ones((num_curves, 3))*ub
+    init = np.clip(np.ones((num_curves, 3))*np.asarray(init, dtype=float), lb, ub)
+
+    mask = np.isfinite(y)
+    y = np.where(mask, y, 0)
+    if weights is None:
+        weights = mask.astype(float)
+    else:
+        weights = np.where(mask, np.ones(y.shape)*weights, 0)
+    linear_index = [0, 2]
+
+    def profile(dGs):
+        """Return fmax, fmin, and cost at a (n_curves, n_points) matrix of dGs."""
+        kd = np.exp(dGs/objfunctions.RT)/objfunctions.concentration_units
+        frac = x/(x + kd[:, :, np.newaxis])
+        return _bounded_linear_solve(frac, y, weights, init[:, linear_index],
+                                     lb[:, linear_index], ub[:, linear_index], vary[linear_index])
+
+    if vary[1]:
+        if not (np.isfinite(lb[:, 1]).all() and np.isfinite(ub[:, 1]).all()):
+            raise ValueError('variable projection needs finite bounds on dG')
+        # coarse grid
+        grid = lb[:, [1]] + (ub[:, [1]] - lb[:, [1]])*np.linspace(0, 1, num_grid)
+        costs = profile(grid)[2]
+        costs[~np.isfinite(costs)] = np.inf
+        best = np.argmin(costs, axis=1)
+        rows = np.arange(num_curves)
+        low = grid[rows, np.maximum(best - 1, 0)]
+        high = grid[rows, np.minimum(best + 1, num_grid - 1)]
+
+        # golden section search within the bracket
+        ratio = (np.sqrt(5) - 1)/2.
+        for i in range(num_iter):
+            c = high - ratio*(high - low)
+            d = low + ratio*(high - low)
+            cost_c, cost_d = profile(np.column_stack([c, d]))[2].T
+            lower = cost_c < cost_d
+            high = np.where(lower, d, high)
+            low = np.where(lower, low, c)
+        dG = np.column_stack([(low + high)/2., grid[rows, best]])
+        nfev = (num_grid + 2*num_iter)*np.ones(num_curves, dtype=int)
+    else:
+        dG = init[:, [1]]
+        nfev = np.ones(num_curves, dtype=int)
+
+    # take the best of the refined and grid values
+    fmax, fmin, costs = profile(dG)
+    costs[~np.isfinite(costs)] = np.inf
+    best = np.argmin(costs, axis=1)
+    rows = np.arange(num_curves)
+    params = np.column_stack([vals[rows, best] for vals in [fmax, dG, fmin]])
+
+    with np.errstate(all='ignore'):
+        fit, jac = objfunctions.binding_curve_batch(params, x, return_jacobian=True)
+    resid = (fit - y)*weights
+    jac = jac[:, :, vary]*weights[:, :, np.newaxis]
+    stderr = _find_stderr(jac, resid, mask, vary)
+    exit_flag = np.where(np.isfinite(params).all(axis=1), 1, 0)
+
+    return {'params':params, 'stderr':stderr, 'residual':resid,
+            'exit_flag':exit_flag, 'nfev':nfev}
+
+
+def _apply_before_fit_ops(fit_spec, before_fit_ops, ys):
+    """Return a dict of per-curve initial values found by the before fit operations."""
+    inits = {}
+    for (param_name, key, operation) in before_fit_ops:
+        if not fit_spec.vary[fit_spec.index(param_name)] or key != 'initial':
+            continue
+        try:
+            vals = operation(ys, axis=1)
+        except TypeError:
+            vals = ys.apply(operation, axis=1)
+        inits[param_name] = np.asarray(vals, dtype=float)
+    return inits
+
+def getParamArrays(fitParams, ys, fit_parameters=None):
+    """Return per-curve initial values, bounds, and the vary mask in the order of the batched model.
+
+    Same as the params FitParams.fit_curve would use for each curve (row) of ys.
+    fit_parameters may be a dict or a compiled fitting.FitSpec."""
+    if fitParams.func_name not in batch_funcs:
+        raise ValueError('No batched form of function %s. Options are: %s'
+                         %(fitParams.func_name, ', '.join(batch_funcs.keys())))
+    model_param_names = batch_funcs[fitParams.func_name][0]
+    fit_spec = fitParams.get_fit_spec(fit_parameters)
+    order = [fit_spec.index(name) for name in model_param_names]
+    num_curves = len(ys)
+
+    init = np.tile(fit_spec.init[order], (num_curves, 1))
+    for param_name, vals in _apply_before_fit_ops(fit_spec, fitParams.before_fit_ops, ys).items():
+        init[:, model_param_names.index(param_name)] = vals
+    lb = np.tile(fit_spec.lb[order], (num_curves, 1))
+    ub = np.tile(fit_spec.ub[order], (num_curves, 1))
+    vary = fit_spec.vary[order]
+
+    # the solvers can't start from NaN (i.e. the default initial fmax). Without an
+    # initial value, fmax starts from the max of each curve, and other params from
+    # the nearest value to 0 within their bounds
+    if 'fmax' in model_param_names:
+        i = model_param_names.index('fmax')
+        y = np.asarray(ys, dtype=float)
+        y_max = np.where(np.isfinite(y), y, -np.inf).max(axis=1)
+        init[:, i] = np.where(np.isfinite(init[:, i]), init[:, i], np.clip(y_max, lb[:, i], ub[:, i]))
+    init = np.where(np.isfinite(init), init, np.clip(0, lb, ub))
+    return init, lb, ub, vary
+
+def fitCurves(fitParams, ys, init, lb, ub, vary, weights=None, method='leastsq',
+              min_kws={'xtol':1E-6, 'ftol':1E-6, 'maxfev':100}, sink=None, start=0, telemetry=False):
+    """Fit a block of curves given per-curve initial values and bounds (see getParamArrays).
+
+    method is 'leastsq' for the vectorized Levenberg-Marquardt solve or 'varpro'
+    for variable projection (binding_curve only). Returns a DataFrame of results
+    with the same columns as fitting.fitSingleCurve, or, if sink (a
+    fitting.ResultSink with those columns) is given, writes them into its rows
+    starting at start. If telemetry is True, the telemetry columns are added, with
+    the time of the block split evenly between its curves."""
+    t0 = datetime.datetime.now()
+    model_param_names, model = batch_funcs[fitParams.func_name]
+    ys = pd.DataFrame(ys).astype(float)
+    num_curves = len(ys)
+    x = np.asarray(fitParams.x, dtype=float)
+
+    # don't fit if there are not enough finite entries (as in fitting.fitSingleCurve,
+    # there must be more than the total number of params)
+    y = ys.values
+    to_fit = np.isfinite(y).sum(axis=1) > len(vary)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        if weights.ndim > 1:
+            weights = weights[to_fit]
+
+    if method == 'varpro':
+        if fitParams.func_name != 'binding_curve':
+            raise ValueError('variable projection is only implemented for binding_curve')
+        fit_results = variableProjection(x, y[to_fit], init[to_fit], lb[to_fit], ub[to_fit],
+                                         vary, weights=weights)
+    elif method == 'leastsq':
+        fit_results = levenbergMarquardt(model, x, y[to_fit], init[to_fit], lb[to_fit], ub[to_fit],
+                                         vary, weights=weights, kwargs=fitParams.fit_kws, **min_kws)
+    else:
+        raise ValueError('method %s not recognized. Options are "leastsq" or "varpro".'%method)
+
+    # save in same format as fitting.fitSingleCurve
+    param_names = sorted(model_param_names)
+    order = [model_param_names.index(name) for name in param_names]
+    columns = fitting.getResultColumns(param_names)
+    values = np.ones((num_curves, len(columns)))*np.nan
+    values[to_fit, :len(order)] = fit_results['params'][:, order]
+    values[to_fit, len(order):2*len(order)] = fit_results['stderr'][:, order]
+    with np.errstate(all='ignore'):
+        ss_total = np.nansum((y - np.nanmean(y, axis=1)[:, np.newaxis])**2, axis=1)
+        ss_error = (fit_results['residual']**2).sum(axis=1)
+        values[to_fit, -3] = 1 - ss_error/ss_total[to_fit]
+        values[to_fit, -1] = np.sqrt(ss_error)
+    values[to_fit, -2] = fit_results['exit_flag']
+    values[~to_fit, -2] = -1
+    if telemetry:
+        nfev = np.zeros(num_curves)
+        nfev[to_fit] = fit_results['nfev']
+        fit_time = (datetime.datetime.now() - t0).total_seconds()/max(num_curves, 1)
+        values = np.column_stack([values, nfev, fit_time*np.ones(num_curves), os.getpid()*np.ones(num_curves)])
+        columns = fitting.getResultColumns(param_names, telemetry=True)
+    if sink is not None:
+        sink.write_block(start, values)
+        return
+    return pd.DataFrame(values, index=ys.index, columns=columns)
+
+def fitBlock(fitParams, ys, fit_parameters=None, weights=None, method='leastsq',
+             min_kws={'xtol':1E-6, 'ftol':1E-6, 'maxfev':100}, sink=None, start=0, telemetry=False, init=None):
+    """Fit a block of curves in one vectorized solve.
+
+    Same inputs as FitParams.fit_curve, except ys is a DataFrame with one
+    curve per row, and init a DataFrame of params per curve. Returns a DataFrame
+    of results as from fitting.fitSingleCurve, or writes them into sink (see fitCurves)."""
+    ys = pd.DataFrame(ys).astype(float)
+    inits, lb, ub, vary = getParamArrays(fitParams, ys, fit_parameters=fit_parameters)
+    if init is not None:
+        warm = init.reindex(index=ys.index, columns=batch_funcs[fitParams.func_name][0]).values.astype(float)
+        inits = np.where(np.isfinite(warm), warm, inits)
+    return fitCurves(fitParams, ys, inits, lb, ub, vary, weights=weights, method=method, min_kws=min_kws,
+                     sink=sink, start=start, telemetry=telemetry)
+
+def fitSetClusters(fitParams, ySeries, batch_size=2000, print_bool=True, telemetry=False, init=None, **kwargs):
+    """Fit a set of curves in blocks of batch_size. Replaces fitting.fitSetClusters."""
+    if init is not None:
+        init = init.reindex(ySeries.index)
+    sink = fitting.ResultSink(ySeries.index, fitting.getResultColumns(sorted(fitParams.param_names), telemetry=telemetry))
+    num_blocks = int(np.ceil(len(ySeries)/float(batch_size)))
+    for i in range(num_blocks):
+        if print_bool:
+            print ('working on %d out of %d blocks (%d%%)'
+                   %(i+1, num_blocks, 100*(i+1)/float(num_blocks)))
+            sys.stdout.flush()
+        fitBlock(fitParams, ySeries.iloc[i*batch_size:(i+1)*batch_size], sink=sink, start=i*batch_size,
+                 telemetry=telemetry, init=(None if init is None else init.iloc[i*batch_size:(i+1)*batch_size]),
+                 **kwargs)
+    return sink.to_dataframe()
@@ -0,0 +1,122 @@
+"""Checkpoints of long fitting runs, so that an interrupted run can be resumed.
+
+Results are saved in chunks, each covering a contiguous range of rows (i.e.
+clusters or variants) of the run, in a checkpoint directory. A manifest in the
+same directory records the fingerprint of the run (a hash of its inputs) and the
+finished ranges. A resumed run with the same fingerprint only fits the rows not
+in any finished range.
+"""
+import os
+import re
+import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from fittinglibs import fitcache
+
+_chunk_format = 'rows_%d_%d.p'
+_chunk_regex = re.compile('rows_(\d+)_(\d+)\.p$')
+
+
+def fingerprint(*values):
+    """Return the fingerprint of a run given its inputs (arrays, numbers, strings, or dicts/lists of these)."""
+    return fitcache.hashValues(*values)
+
+def hashFile(filename, block_size=2**20):
+    """Return the hex digest of the contents of a file, read in blocks so it is never all in memory."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            h.update(block)
+    return h.hexdigest()
+
+def findMissingRanges(num_rows, finished_ranges):
+    """Return the contiguous (start, stop) ranges of rows not covered by the finished ranges."""
+    done = np.zeros(num_rows, dtype=bool)
+    for start, stop in finished_ranges:
+        done[start:stop] = True
+    # find where rows switch between done and not done
+    edges = np.diff(np.concatenate([[1], done.astype(int), [1]]))
+    return zip(np.where(edges == -1)[0].tolist(), np.where(edges == 1)[0].tolist())
+
+
+class Checkpoint(object):
+    """Directory of finished chunks of results and a manifest of the run.
+
+    Chunks are DataFrames, written by save_range (which can be called from the
+    worker processes). Each chunk is written to a temporary file and then renamed,
+    so a chunk file is either complete or absent."""
+    def __init__(self, directory, fingerprint):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.manifest_filename = os.path.join(directory, 'manifest.json')
+
+    def start(self, resume=False):
+        """Prepare the directory for a run.
+
+        If resume is True, finished chunks of a previous run are kept, as long as
+        that run had the same fingerprint. Otherwise they are removed."""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        manifest = self.read_manifest()
+        if resume and manifest is not None and manifest['fingerprint'] != self.fingerprint:
+            raise ValueError('checkpoint in %s is from a run with different inputs; '
+                             'remove it or run without resuming'%self.directory)
+        if not resume:
+            self.clear()
+        self.write_manifest()
+
+    def chunk_filename(self, start, stop):
+        """Return the file name of the chunk of rows start to stop."""
+        return os.path.join(self.directory, _chunk_format%(start, stop))
+
+    def save_range(self, start, stop, results):
+        """Save the results of rows start to stop."""
+        filename = self.chunk_filename(start, stop)
+        results.to_pickle(filename + '.tmp')
+        os.rename(filename + '.tmp', filename)
+
+    def load_range(self, start, stop):
+        """Return the saved results of rows start to stop."""
+        return pd.read_pickle(self.chunk_filename(start, stop))
+
+    def finished_ranges(self):
+        """Return the sorted (start, stop) ranges of rows with saved results."""
+        ranges = []
+        for filename in glob.glob(os.path.join(self.directory, 'rows_*.p')):
+            match = _chunk_regex.search(filename)
+            if match is not None:
+                ranges.append((int(match.group(1)), int(match.group(2))))
+        return sorted(ranges)
+
+    def missing_ranges(self, num_rows):
+        """Return the (start, stop) ranges of rows that still need to be fit."""
+        return findMissingRanges(num_rows, self.finished_ranges())
+
+    def read_manifest(self):
+        """Return the manifest as a dict, or None if there is none."""
+        if not os.path.exists(self.manifest_filename):
+            return None
+        with open(self.manifest_filename) as f:
+            return json.load(f)
+
+    def write_manifest(self, **info):
+        """Save the fingerprint and the finished ranges, with any additional info."""
+        manifest = {'fingerprint':self.fingerprint, 'finished':self.finished_ranges()}
+        manifest.update(info)
+        with open(self.manifest_filename + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.rename(self.manifest_filename + '.tmp', self.manifest_filename)
+
+    def clear(self):
+        """Remove the saved chunks and the manifest."""
+        for filename in (glob.glob(os.path.join(self.directory, 'rows_*.p*')) +
+                         glob.glob(self.manifest_filename + '*')):
+            os.remove(filename)
+
+    def remove(self):
+        """Remove the checkpoint, i.e. once the final results are saved."""
+        self.clear()
+        if os.path.exists(self.directory) and not os.listdir(self.directory):
+            os.rmdir(self.directory)
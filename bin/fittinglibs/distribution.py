@@ -32,20 +32,40 @@ class fmaxDistAny():
         else:
             return (y-fit)*weights
     
+    def __getstate__(self):
+        # the distributions of each n are found again after unpickling
+        state = self.__dict__.copy()
+        state.pop('_dists', None)
+        return state
+
     def getDist(self, n, do_gamma=None):
+        """Return the fmax distribution of variants with n clusters (a fmaxDistN).
 
+        Distributions are kept for each n, as long as params don't change."""
         if self.params is None:
             print 'Error: define popts'
             return
         params = self.params
+        key = (n, do_gamma, tuple(sorted(params.valuesdict().items())))
+        dists = self.__dict__.setdefault('_dists', {})
+        if key in dists:
+            return dists[key]
         
         sigma = self.sigma_by_n_fit(params, n)
         mean = params.valuesdict()['median']
         
-        return self.find_fmax_bounds(mean, sigma,
-                                     alpha=None,
-                                     return_dist=True,
-                                     do_gamma=do_gamma)
+        dists[key] = fmaxDistN(self.find_fmax_bounds(mean, sigma,
+                                                     alpha=None,
+                                                     return_dist=True,
+                                                     do_gamma=do_gamma))
+        return dists[key]
+
+    def getSampler(self, do_gamma=None):
+        """Return a fmaxSampler to draw the fmaxes of many variants at once."""
+        if do_gamma is None:
+            do_gamma = True
+        parvals = self.params.valuesdict()
+        return fmaxSampler(parvals['median'], parvals['sigma'], parvals['c'], do_gamma=do_gamma)
 
     def find_fmax_bounds(self, mean, sigma, alpha=None, return_dist=None, do_gamma=None):
         if alpha is None: alpha = 0.99
@@ -82,6 +102,75 @@ class fmaxDistAny():
             percentiles = self._get_percentiles_given_alpha(alpha)
             return dist.ppf(percentiles)
 
+class fmaxDistN(object):
+    """Fmax distribution of variants with a given number of clusters (see fmaxDistAny.getDist).
+
+    Has the methods of the frozen scipy distribution. Scalar ppf and interval
+    values (i.e. the ppf(0.01) and interval(0.99) enforceFmax uses for every
+    variant) are kept once found."""
+    __module__ = 'fittinglibs.%s'%os.path.splitext(os.path.basename(__file__))[0]
+    def __init__(self, dist):
+        self.dist = dist
+        self._ppfs = {}
+        self._intervals = {}
+
+    def ppf(self, q):
+        if np.ndim(q) > 0:
+            return self.dist.ppf(q)
+        if q not in self._ppfs:
+            self._ppfs[q] = self.dist.ppf(q)
+        return self._ppfs[q]
+
+    def interval(self, alpha):
+        if alpha not in self._intervals:
+            self._intervals[alpha] = self.dist.interval(alpha)
+        return self._intervals[alpha]
+
+    def __getattr__(self, name):
+        # everything else (rvs, pdf, stats, ...) is from the scipy distribution
+        if name.startswith('__') or name == 'dist':
+            raise AttributeError(name)
+        return getattr(self.dist, name)
+
+
+class fmaxSampler(object):
+    """Draws fmaxes of many variants at once from the fmax distributions of fmaxDistAny.
+
+    Only holds the fitted median, sigma and c (the stde of fmax with n clusters
+    is sigma/sqrt(n) + c), so it is small to pickle, i.e. to send to workers."""
+    __module__ = 'fittinglibs.%s'%os.path.splitext(os.path.basename(__file__))[0]
+    def __init__(self, median, sigma, c, do_gamma=True):
+        self.median = float(median)
+        self.sigma = float(sigma)
+        self.c = float(c)
+        self.do_gamma = do_gamma
+
+    def get_sigmas(self, ns):
+        """Return the stde of fmax of variants with ns clusters."""
+        return self.sigma/np.sqrt(np.asarray(ns, dtype=float)) + self.c
+
+    def ppf(self, q, ns):
+        """Return the q-th quantile of the fmax distribution of each n in ns."""
+        sigmas = self.get_sigmas(ns)
+        if self.do_gamma:
+            k, theta = returnGammaParams(self.median, sigmas)
+            return st.gamma.ppf(q, k, scale=theta)
+        return st.norm.ppf(q, loc=self.median, scale=sigmas)
+
+    def rvs(self, ns, n_samples, random_state=None):
+        """Return n_samples fmaxes (columns) of each variant (rows) with ns clusters.
+
+        Each row is the same as fmaxDistAny.getDist(n).rvs(n_samples) drawn in turn
+        from random_state (or the global random state if None)."""
+        if random_state is None:
+            random_state = np.random
+        sigmas = self.get_sigmas(ns)[:, np.newaxis]
+        size = (len(sigmas), n_samples)
+        if self.do_gamma:
+            k, theta = returnGammaParams(self.median, sigmas)
+            return random_state.standard_gamma(k, size=size)*theta
+        return self.median + sigmas*random_state.standard_normal(size)
+
 def getFractionOfData(n_test_counts, fraction_of_data):
     """Get a subset of the date? Don't actually remember."""
     for n in n_test_counts.index:
@@ -18,14 +18,7 @@ def loadFile(filename):
     if filename is None:
         print "Error: No filename given!"
         sys.exit()
-    ext = os.path.splitext(filename)[-1]
-    
-    # check compression status
-    if ext == '.gz':
-        compression = 'gzip'
-        ext = os.path.splitext(filename[:filename.find('.gz')])[-1]
-    else:
-        compression = None
+    ext, compression = _getExtension(filename)
     
     if ext == '.pkl':
         return pd.read_pickle(filename)
@@ -54,6 +47,40 @@ def loadFile(filename):
     else:
         print 'Extension %s not recognized. No file loaded.'%ext
         
+# tab separated indexed tables, which can be read a chunk of rows at a time
+_streamable_extensions = ['.CPvariant', '.CPseries', '.CPfitted', '.fitParameters', '.CPannot']
+
+def isStreamable(filename):
+    """ Return whether iterFile can read a file chunk by chunk (otherwise it loads all of it). """
+    return _getExtension(filename)[0] in _streamable_extensions
+
+def iterFile(filename, chunksize=100000):
+    """ Yield chunks of at most chunksize rows of a table.
+
+    Tab separated indexed tables (i.e. CPseries) are read chunk by chunk, without
+    loading all of it at once. Other formats (i.e. .pkl) are loaded whole with
+    loadFile and then split into chunks (see isStreamable). """
+    ext, compression = _getExtension(filename)
+    if ext in _streamable_extensions:
+        for chunk in pd.read_table(filename, index_col=0, compression=compression, chunksize=chunksize):
+            yield chunk
+    else:
+        data = loadFile(filename)
+        for i in range(0, len(data), chunksize):
+            yield data.iloc[i:i+chunksize]
+
+def _getExtension(filename):
+    """ Return the extension of a file, ignoring .gz, and its compression. """
+    ext = os.path.splitext(filename)[-1]
+    
+    # check compression status
+    if ext == '.gz':
+        compression = 'gzip'
+        ext = os.path.splitext(filename[:filename.find('.gz')])[-1]
+    else:
+        compression = None
+    return ext, compression
+
 def saveFile(filename, data, **kwargs):
     """Save data to a file according to extension."""
     if filename is None:
@@ -0,0 +1,132 @@
+"""Content-addressed cache of single curve fits.
+
+Fits are keyed by a hash of the (quantized) y values, the x values, the name of
+the objective function, the compiled fit parameters (fitting.FitSpec), and the
+other arguments to the objective function and minimizer. Identical curves are
+then only fit once, within a run or, if the cache is saved to disk, across runs.
+"""
+import os
+import hashlib
+import pickle
+import collections
+import numpy as np
+
+
+def _hashValue(h, val):
+    """Add a value (None, string, number, array, or a dict/list of these) to a hash."""
+    if val is None:
+        h.update('None')
+    elif isinstance(val, basestring):
+        h.update(val)
+    elif isinstance(val, dict):
+        for key in sorted(val.keys()):
+            h.update(str(key))
+            _hashValue(h, val[key])
+    else:
+        arr = np.asarray(val)
+        if arr.dtype == object or arr.dtype.kind in 'SU':
+            for sub_val in val:
+                _hashValue(h, sub_val)
+        else:
+            h.update(str(arr.shape))
+            h.update(np.ascontiguousarray(arr, dtype=float).tobytes())
+
+def hashValues(*values):
+    """Return a hex digest of a set of values (see _hashValue)."""
+    h = hashlib.sha1()
+    for val in values:
+        _hashValue(h, val)
+    return h.hexdigest()
+
+def quantize(y, decimals=6):
+    """Round y values so that curves equal up to the given decimals have the same key."""
+    # adding zero makes -0.0 and 0.0 the same
+    return np.round(np.asarray(y, dtype=float), decimals) + 0.
+
+def fitKey(x, y, func_name, fit_spec, weights=None, kwargs=None, min_kws=None, decimals=6):
+    """Return the key (a hex digest) of a single curve fit."""
+    h = hashlib.sha1()
+    _hashValue(h, func_name)
+    _hashValue(h, x)
+    _hashValue(h, quantize(y, decimals=decimals))
+    _hashValue(h, fit_spec.names)
+    for vals in [fit_spec.init, fit_spec.lb, fit_spec.ub, fit_spec.vary]:
+        _hashValue(h, vals)
+    _hashValue(h, weights)
+    _hashValue(h, kwargs)
+    _hashValue(h, min_kws)
+    return h.hexdigest()
+
+
+class FitCache(object):
+    """Least recently used cache of fit results, keyed by fitKey.
+
+    Values are the arrays of results saved by fitting.fitSingleCurve. At most
+    max_size fits are kept. If filename is given and exists, it is loaded, and
+    save() writes the cache back to it."""
+    def __init__(self, max_size=1000000, filename=None, decimals=6):
+        self.max_size = max_size
+        self.filename = filename
+        self.decimals = decimals
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def key(self, x, y, func_name, fit_spec, weights=None, kwargs=None, min_kws=None):
+        """Return the key of a single curve fit (see fitKey)."""
+        return fitKey(x, y, func_name, fit_spec, weights=weights, kwargs=kwargs, min_kws=min_kws,
+                      decimals=self.decimals)
+
+    def get(self, key):
+        """Return the cached results of a fit, or None if the fit is not in the cache."""
+        try:
+            values = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # most recently used entries are at the end
+        self.entries[key] = values
+        self.hits += 1
+        return values
+
+    def put(self, key, values):
+        """Add the results of a fit, evicting the least recently used fits if over max_size."""
+        self.entries.pop(key, None)
+        self.entries[key] = np.array(values, dtype=float)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self, filename):
+        """Add the fits saved in a file to the cache."""
+        with open(filename, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['decimals'] != self.decimals:
+            # keys depend on the rounding of the y values
+            return
+        for key, values in saved['entries']:
+            self.put(key, values)
+
+    def save(self, filename=None):
+        """Save the cache, by default to the file it was loaded from."""
+        if filename is None:
+            filename = self.filename
+        saved = {'decimals':self.decimals, 'entries':self.entries.items()}
+        # write to a temporary file first so an interrupted save doesn't lose the cache
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+
+    def report(self):
+        """Return a string summarizing cache use."""
+        num_lookups = self.hits + self.misses
+        return ('fit cache: %d hits, %d misses (%4.1f%% hit rate), %d fits stored'
+                %(self.hits, self.misses, 100*self.hits/float(max(num_lookups, 1)), len(self.entries)))
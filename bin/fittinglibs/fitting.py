@@ -1,4 +1,4 @@
-from lmfit import minimize, Parameters, report_fit, conf_interval
+from lmfit import minimize, Minimizer, Parameters, report_fit, conf_interval
 import numpy as np
 import pandas as pd
 import matplotlib
@@ -6,13 +6,16 @@ import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
 import sys
+import os
 from scikits.bootstrap import bootstrap
 from statsmodels.distributions.empirical_distribution import ECDF
 import warnings
 import itertools
+from math import factorial
 import scipy.stats as st
 import copy
 import datetime
+import hashlib
 from fittinglibs import variables
 from variables import fittingParameters
 
@@ -126,6 +129,111 @@ def convertFitParametersToParams(fitParameters):
                    vary= vary)
     return params
 
+class FitSpec(object):
+    """Compact, array-backed description of the fit parameters.
+
+    Holds the param names and arrays of initial values, bounds, and whether each param
+    varies. FitParams compiles its fit_parameters dict into one of these once, and
+    per-fit changes (i.e. the initial fmax of a cluster) are cheap writes to a copy."""
+    __slots__ = ['names', 'init', 'lb', 'ub', 'vary']
+    
+    def __init__(self, names, init, lb, ub, vary):
+        self.names = list(names)
+        self.init = np.array(init, dtype=float)
+        self.lb = np.array(lb, dtype=float)
+        self.ub = np.array(ub, dtype=float)
+        self.vary = np.array(vary, dtype=bool)
+        
+        # missing bounds are unbounded
+        self.lb[np.isnan(self.lb)] = -np.inf
+        self.ub[np.isnan(self.ub)] = np.inf
+
+    @classmethod
+    def from_dict(cls, fit_parameters):
+        """Compile a dict of {param_name:{'initial':val, 'lowerbound':val, ...}}.
+        
+        Params are sorted by name, as in the dataframe format of the fit parameters."""
+        names = sorted(fit_parameters.keys())
+        def get_vals(key, default):
+            vals = [fit_parameters[name].get(key, default) for name in names]
+            return [default if val is None else val for val in vals]
+        return cls(names, get_vals('initial', np.nan), get_vals('lowerbound', -np.inf),
+                   get_vals('upperbound', np.inf), get_vals('vary', True))
+
+    @classmethod
+    def from_dataframe(cls, fitParameters):
+        """Compile the dataframe format of the fit parameters (see convertFitParametersToParams)."""
+        names = fitParameters.columns.tolist()
+        def get_vals(key, default):
+            if key in fitParameters.index:
+                return fitParameters.loc[key].tolist()
+            return [default]*len(names)
+        return cls(names, get_vals('initial', np.nan), get_vals('lowerbound', -np.inf),
+                   get_vals('upperbound', np.inf), get_vals('vary', True))
+
+    def __getstate__(self):
+        return [getattr(self, key) for key in self.__slots__]
+    
+    def __setstate__(self, state):
+        for key, val in zip(self.__slots__, state):
+            setattr(self, key, val)
+
+    def copy(self):
+        """Return a copy that can be changed without affecting this one."""
+        return FitSpec(self.names, self.init, self.lb, self.ub, self.vary)
+
+    def index(self, name):
+        """Return the position of a param."""
+        return self.names.index(name)
+
+    def update(self, name, initial=None, lowerbound=None, upperbound=None, vary=None):
+        """Change the values of a param in place. Values that are None are not changed."""
+        i = self.index(name)
+        if initial is not None: self.init[i] = initial
+        if lowerbound is not None: self.lb[i] = lowerbound
+        if upperbound is not None: self.ub[i] = upperbound
+        if vary is not None: self.vary[i] = vary
+        return self
+
+    def to_params(self):
+        """Return lmfit params structure."""
+        params = Parameters()
+        for name, init, lb, ub, vary in itertools.izip(self.names, self.init, self.lb, self.ub, self.vary):
+            params.add(name, value=init, min=lb, max=ub, vary=vary)
+        return params
+
+    def to_dataframe(self):
+        """Return the fit parameters in dataframe format."""
+        return pd.DataFrame([self.lb, self.init, self.ub, self.vary], columns=self.names,
+                            index=['lowerbound', 'initial', 'upperbound', 'vary'], dtype=object)
+
+class ResultSink(object):
+    """Preallocated matrix of fit results, indexed by fit and result column.
+
+    Fit routines write each fit into a row (see fitSingleCurve), and the matrix is
+    converted to a DataFrame once at the end instead of concatenating one Series
+    per fit."""
+    def __init__(self, index, columns):
+        self.index = index
+        self.columns = list(columns)
+        self.values = np.ones((len(index), len(self.columns)))*np.nan
+        self.column_order = {col:i for i, col in enumerate(self.columns)}
+
+    def write(self, row, values, columns=None):
+        """Write the values of a single fit into a row, optionally for the given columns only."""
+        if columns is None:
+            self.values[row] = values
+        else:
+            self.values[row, [self.column_order[col] for col in columns]] = values
+
+    def write_block(self, start, values):
+        """Write a matrix of results for consecutive fits, starting at row start."""
+        self.values[start:start+len(values)] = values
+
+    def to_dataframe(self):
+        """Return the results as a DataFrame."""
+        return pd.DataFrame(self.values, index=self.index, columns=self.columns)
+
 def getWeightsFromError(errors):
     """Given errors=[eminus, eplus], find weights based on inverse."""
     eminus, eplus = errors
@@ -134,35 +242,92 @@ def getWeightsFromError(errors):
         weights = None
     return weights
 
-def getWeightsFromBindingSeries(ys, num_cutoff=5):
+def getWeightsFromBindingSeries(ys, num_cutoff=5, random_state=None):
     """Given binding series, find errors and then find weights."""
     if len(ys) >= num_cutoff:
-        eminus, eplus = findErrorBarsBindingCurve(ys)
+        eminus, eplus = findErrorBarsBindingCurve(ys, random_state=random_state)
         weights = getWeightsFromError([eminus, eplus])
     else:
         weights = None
     return weights
+
+def getWeightsFromBindingSeriesList(ys_list, num_cutoff=5):
+    """Given a list of binding series, find the weights of each (see getWeightsFromBindingSeries).
+
+    The errors of all binding series with at least num_cutoff clusters are
+    bootstrapped at once (see findErrorBarsBindingCurves)."""
+    weights = [None]*len(ys_list)
+    to_weight = [i for i, ys in enumerate(ys_list) if len(ys) >= num_cutoff]
+    if len(to_weight) > 0:
+        errors = findErrorBarsBindingCurves([ys_list[i] for i in to_weight])
+        for i, error in zip(to_weight, errors):
+            weights[i] = getWeightsFromError(error)
+    return weights
         
 
+def getJacobianFunction(func):
+    """Return the analytic jacobian registered with an objective function, or None."""
+    try:
+        return func(None, None, return_jacobian=True)
+    except TypeError:
+        return None
+
+def minimizeWithJacobian(func, jacfunc, params, args=(), kws={}, **min_kws):
+    """ Same as lmfit.minimize (leastsq), using an analytic jacobian.
+    
+    lmfit passes Dfun the bounded parameter values but MINPACK expects the derivative
+    with respect to the internal (unbounded) values, so keep track of the internal
+    values and scale the jacobian columns accordingly. """
+    fitter = Minimizer(func, params, fcn_args=args, fcn_kws=kws)
+    fitter.prepare_fit()
+    internal_vals = {}
+    for name in fitter.var_map:
+        param = fitter.params[name]
+        def from_internal(val, name=name, transform=param.from_internal):
+            internal_vals[name] = val
+            return transform(val)
+        param.from_internal = from_internal
+
+    def jacobian(params, *args, **kws):
+        scale = [params[name].scale_gradient(internal_vals[name]) for name in fitter.var_map]
+        return jacfunc(params, *args, **kws)*np.array(scale)
+
+    fitter.leastsq(Dfun=jacobian, **min_kws)
+    return fitter
+
 def fitSingleCurve(x, y, fitParameters, func,
-                          weights=None, do_not_fit=False, kwargs={}, min_kws={'maxfev':100}):
-    """ Fit an objective function to data, weighted by errors. """
+                          weights=None, do_not_fit=False, kwargs={}, min_kws={'maxfev':100}, use_jacobian=True,
+                          sink=None, row=None, cache=None, telemetry=False):
+    """ Fit an objective function to data, weighted by errors.
+    
+    fitParameters is either a FitSpec or a dataframe of fit parameters.
+    If the objective function has an analytic jacobian (and use_jacobian is True), it is
+    used instead of finite differences. If sink (a ResultSink) is given, the results are
+    written into its row instead of being returned as a Series. If cache (a
+    fitcache.FitCache) is given, a curve that was already fit is not fit again. If
+    telemetry is True, the number of function evaluations, the time of the fit,
+    and the process id of the worker are also saved (see telemetry_columns). """
+    t0 = datetime.datetime.now()
 
-    # fit parameters
-    params = convertFitParametersToParams(fitParameters)
-    param_names = fitParameters.columns.tolist()
+    # fit parameters, either compiled (FitSpec) or in dataframe format
+    if isinstance(fitParameters, FitSpec):
+        params = fitParameters.to_params()
+        param_names = list(fitParameters.names)
+    else:
+        params = convertFitParametersToParams(fitParameters)
+        param_names = fitParameters.columns.tolist()
     
     # initiate output structure  
-    final_params = pd.Series(index=(param_names +
-                                    ['%s_stde'%param for param in param_names] +
-                                    ['rsq', 'exit_flag', 'rmse']))
+    columns = getResultColumns(param_names, telemetry=telemetry)
+    final_params = np.ones(len(getResultColumns(param_names)))*np.nan
+    nfev = 0
     
     # make sure fluorescence doesn't have NaN terms
     index = np.array(np.isfinite(y))
     
     # find the number of free parameters
     num_free_parameters = len(param_names)
-    if 'vary' in fitParameters:
+    if isinstance(fitParameters, pd.DataFrame) and 'vary' in fitParameters:
         num_free_parameters = fitParameters['vary'].sum()
     
     # don't fit if there are not enough finite entries    
@@ -171,31 +336,71 @@ def fitSingleCurve(x, y, fitParameters, func,
 
     # return here if you don't want to actually fit
     if do_not_fit:
-        final_params.loc['exit_flag'] = -1
-        return final_params
+        final_params[-2] = -1
+        return _saveSingleResult(final_params, columns, sink, row, t0=(t0 if telemetry else None), nfev=nfev)
+    
+    # look for the same fit in the cache
+    if cache is not None:
+        fit_spec = fitParameters if isinstance(fitParameters, FitSpec) else FitSpec.from_dataframe(fitParameters)
+        key = cache.key(x, y, func.__name__, fit_spec, weights=weights, kwargs=kwargs,
+                        min_kws=dict(min_kws, use_jacobian=use_jacobian))
+        cached_params = cache.get(key)
+        if cached_params is not None:
+            return _saveSingleResult(cached_params.copy(), columns, sink, row, t0=(t0 if telemetry else None), nfev=nfev)
     
     # add the arguments to the kwargs dict
     kwargs = kwargs.copy()
     kwargs.update({'data':y, 'weights':weights, 'index':index}) 
 
     # do the fit
-    results = minimize(func, params,
-                       args=(x,),
-                       kws=kwargs, **min_kws)
+    jacfunc = getJacobianFunction(func) if use_jacobian else None
+    if jacfunc is None:
+        results = minimize(func, params,
+                           args=(x,),
+                           kws=kwargs, **min_kws)
+    else:
+        results = minimizeWithJacobian(func, jacfunc, params,
+                                       args=(x,),
+                                       kws=kwargs, **min_kws)
 
     
     # find rqs
     rsq, rmse = get_rsq_rmse(y, results.residual)
     
     # save params in structure
-    for param in param_names:
-        final_params.loc[param] = params[param].value
-        final_params.loc['%s_stde'%param] = params[param].stderr
-    final_params.loc['rsq'] = rsq
-    final_params.loc['exit_flag'] = results.ier
-    final_params.loc['rmse'] = rmse
+    num_params = len(param_names)
+    for i, param in enumerate(param_names):
+        final_params[i] = params[param].value
+        final_params[num_params + i] = params[param].stderr
+    final_params[-3:] = [rsq, results.ier, rmse]
+    nfev = results.nfev
+    if cache is not None:
+        cache.put(key, final_params)
     
-    return final_params
+    return _saveSingleResult(final_params, columns, sink, row, t0=(t0 if telemetry else None), nfev=nfev)
+
+def _saveSingleResult(values, columns, sink=None, row=None, t0=None, nfev=0):
+    """Write the results of a single fit into the sink, or return them as a Series if no sink.
+
+    If t0 (the start time of the fit) is given, the telemetry columns are added."""
+    if t0 is not None:
+        fit_time = (datetime.datetime.now() - t0).total_seconds()
+        values = np.append(values, [nfev, fit_time, os.getpid()])
+    if sink is None:
+        return pd.Series(values, index=columns)
+    sink.write(row, values, columns)
+
+# additional values saved for each fit when recording telemetry
+telemetry_columns = ['nfev', 'fit_time', 'worker']
+
+def getResultColumns(param_names, telemetry=False):
+    """Return the names of the values saved for each fit by fitSingleCurve."""
+    columns = (param_names +
+               ['%s_stde'%param for param in param_names] +
+               ['rsq', 'exit_flag', 'rmse'])
+    if telemetry:
+        columns = columns + telemetry_columns
+    return columns
 
 def get_rsq_rmse(y, residuals):
     """Return the rsq and the rmse given the y values and the residuals """
@@ -206,36 +411,139 @@ def get_rsq_rmse(y, residuals):
     
     return rsq, rmse
 
-def findErrorBarsBindingCurve(subSeries, min_error=0):
-    """ Return bootstrapped confidence intervals on columns of an input data matrix.
+def _bootstrapMedianIntervals(values, uniforms, alpha=0.05):
+    """Return bias-corrected and accelerated (BCa) bootstrapped confidence intervals on the median of each column.
+
+    values is a matrix with each column sorted and NaNs last (see np.sort).
+    uniforms is a (n_samples, >= number of rows) matrix of uniform random numbers,
+    each row of which is turned into one bootstrap sample of every column.
+    Returns lb and ub of each column, as scikits.bootstrap.ci(vec, np.median) on the
+    non-NaN values vec of the column, and NaN where this would fail."""
+    n_samples = len(uniforms)
+    num_rows, num_cols = values.shape
+    nums = (~np.isnan(values)).sum(axis=0)
+    cols = np.arange(num_cols)
+    lb = np.ones(num_cols)*np.nan
+    ub = np.ones(num_cols)*np.nan
+    for num in np.unique(nums[nums > 1]):
+        subcols = cols[nums == num]
+        subvalues = values[:num, subcols]
+        lo, hi = (num-1)//2, num//2
+        
+        # values are sorted, so the median of a sample is at the middle positions
+        # of the sorted sample. the first num uniforms give the positions of a sample
+        positions = np.floor(np.sort(uniforms[:, :num], axis=1)*num).astype(int)
+        stat = np.sort(0.5*(subvalues[positions[:, lo]] + subvalues[positions[:, hi]]), axis=0)
+        ostat = 0.5*(subvalues[lo] + subvalues[hi])
+        
+        # the median without value i: positions lo and hi of the remaining values
+        left_out = np.arange(num)
+        jlo, jhi = (num-2)//2, (num-1)//2
+        jstat = 0.5*(subvalues[jlo + (jlo >= left_out)] + subvalues[jhi + (jhi >= left_out)])
+        jmean = jstat.mean(axis=0)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z0 = st.norm.ppf((1.0*np.sum(stat < ostat, axis=0))/n_samples)
+            a = np.sum((jmean - jstat)**3, axis=0)/(6.0*np.sum((jmean - jstat)**2, axis=0)**1.5)
+            zs = z0 + st.norm.ppf([alpha/2., 1-alpha/2.])[:, np.newaxis]
+            avals = st.norm.cdf(z0 + zs/(1-a*zs))
+        
+        # where the percentiles are not defined, ci fails
+        success = np.all(np.isfinite(avals), axis=0)
+        nvals = np.round((n_samples-1)*np.where(np.isfinite(avals), avals, 0)).astype(int)
+        bounds = stat[nvals, np.arange(len(subcols))]
+        lb[subcols] = np.where(success, bounds[0], np.nan)
+        ub[subcols] = np.where(success, bounds[1], np.nan)
+    return lb, ub
+
+def findGroupedMedianIntervals(values, offsets, n_samples=1000, max_chunk_values=10000000, random_state=None):
+    """Return bootstrapped confidence intervals on the median of each column within each group of rows.
+
+    Rows offsets[i]:offsets[i+1] of values are the i-th group (i.e. the clusters
+    of a variant, see groupedseries.GroupedSeries). NaN values are left out.
+    Groups of about the same size are bootstrapped together, in chunks of about
+    max_chunk_values values, all from the same random samples (drawn from
+    random_state, or the global random state if None). Returns lb and ub,
+    each (number of groups, number of columns), as _bootstrapMedianIntervals."""
+    if random_state is None:
+        random_state = np.random
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    offsets = np.asarray(offsets, dtype=int)
+    counts = np.diff(offsets)
+    num_groups, num_cols = len(counts), values.shape[1]
+    lb = np.ones((num_groups, num_cols))*np.nan
+    ub = np.ones((num_groups, num_cols))*np.nan
+    if num_groups == 0:
+        return lb, ub
+    uniforms = random_state.random_sample((n_samples, max(counts.max(), 1)))
     
-    Assuming rows represent replicate measurments, i.e. clusters. """
+    # go through groups from smallest to largest, so that groups in a chunk have
+    # about the same number of rows. memory is bounded both by the padded values
+    # and by the bootstrapped medians of each column
+    order = np.argsort(counts, kind='mergesort')
+    sorted_counts = np.maximum(counts[order], 1)
+    max_groups = max(max_chunk_values//(max(n_samples, 1)*num_cols), 1)
+    start = 0
+    while start < num_groups:
+        # the largest (last) group of a chunk sets its number of rows
+        sizes = sorted_counts[start:]*np.arange(1, num_groups-start+1)*num_cols
+        num_in_chunk = max(min(np.searchsorted(sizes, max_chunk_values, side='right'), max_groups), 1)
+        groups = order[start:start+num_in_chunk]
+        start += len(groups)
+        
+        # pad each group to the same number of rows with NaNs, one column per group and column of values
+        chunk_counts = counts[groups]
+        num_rows = max(chunk_counts.max(), 1)
+        row_in_group = np.arange(chunk_counts.sum()) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        block = np.ones((num_rows, len(groups), num_cols))*np.nan
+        block[row_in_group, np.repeat(np.arange(len(groups)), chunk_counts)] = values[
+            np.repeat(offsets[groups], chunk_counts) + row_in_group]
+        block = np.sort(block.reshape(num_rows, -1), axis=0)
+        chunk_lb, chunk_ub = _bootstrapMedianIntervals(block, uniforms[:, :num_rows])
+        lb[groups] = chunk_lb.reshape(len(groups), num_cols)
+        ub[groups] = chunk_ub.reshape(len(groups), num_cols)
+    return lb, ub
+
+def findErrorBarsBindingCurves(subSeriesList, min_error=0, n_samples=1000, random_state=None):
+    """ Return bootstrapped confidence intervals on columns of a list of input data matrices.
+    
+    All matrices are bootstrapped at once, from the same random samples of rows
+    (drawn from random_state, or the global random state if None).
+    Returns a list of (eminus, eplus), one for each matrix (see findErrorBarsBindingCurve)."""
+    if random_state is None:
+        random_state = np.random
+    num_rows = max([len(subSeries) for subSeries in subSeriesList] + [1])
+    values = np.ones((num_rows, sum([subSeries.shape[1] for subSeries in subSeriesList])))*np.nan
+    start = 0
+    for subSeries in subSeriesList:
+        values[:len(subSeries), start:start+subSeries.shape[1]] = np.sort(subSeries.values.astype(float), axis=0)
+        start += subSeries.shape[1]
+    uniforms = random_state.random_sample((n_samples, num_rows))
+    lb, ub = _bootstrapMedianIntervals(values, uniforms)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        eminus=[]
-        eplus = [] 
-        for i in subSeries:
-            vec = subSeries.loc[:, i].dropna()
-            success = True
-            if len(vec) > 1:
-                try:
-                    bounds = bootstrap.ci(vec, np.median, n_samples=1000)
-                except IndexError:
-                    success = False
-            else:
-                success = False
-                
-            if success:
-                eminus.append(vec.median() - bounds[0])
-                eplus.append(bounds[1] - vec.median())
-            else:
-                eminus.append(np.nan)
-                eplus.append(np.nan)
-                
-        
-        eminus = pd.Series([max(min_error, e) for e in eminus], index=subSeries.columns)
-        eplus = pd.Series([max(min_error, e) for e in eplus], index=subSeries.columns)
-    return eminus, eplus
+        medians = np.nanmedian(values, axis=0)
+    
+    # like max(min_error, e), errors that are NaN are set to min_error
+    eminus = np.fmax(medians - lb, min_error)
+    eplus = np.fmax(ub - medians, min_error)
+    errors = []
+    start = 0
+    for subSeries in subSeriesList:
+        cols = slice(start, start+subSeries.shape[1])
+        errors.append((pd.Series(eminus[cols], index=subSeries.columns),
+                       pd.Series(eplus[cols], index=subSeries.columns)))
+        start += subSeries.shape[1]
+    return errors
+
+def findErrorBarsBindingCurve(subSeries, min_error=0, n_samples=1000, random_state=None):
+    """ Return bootstrapped confidence intervals on columns of an input data matrix.
+    
+    Assuming rows represent replicate measurments, i.e. clusters. """
+    return findErrorBarsBindingCurves([subSeries], min_error=min_error, n_samples=n_samples,
+                                      random_state=random_state)[0]
 
 def enforceFmaxDistribution(median_fluorescence, fmaxDist, verbose=None, cutoff=None):
     """ Decide whether to enforce fmax distribution (on binding curves) or let it float.
@@ -269,24 +577,132 @@ def enforceFmaxDistribution(median_fluorescence, fmaxDist, verbose=None, cutoff=
                   median_fluorescence[-1]*100/lowerbound))
     return redoFitFmax
 
-def getClusterIndices(subSeries, n_samples=100, enforce_fmax=False, verbose=False):
-    """Based on indices, find a list of sets of lcusters to do bootstrapping on."""
+def getClusterIndices(subSeries, n_samples=100, enforce_fmax=False, verbose=False, return_counts=False):
+    """Based on indices, find a list of sets of lcusters to do bootstrapping on.
+
+    If return_counts, return only the distinct sets of clusters and the number of
+    samples of each (see getClusterMultisets)."""
+    if return_counts:
+        positions, counts = getClusterMultisets(len(subSeries), n_samples, enforce_fmax, verbose=verbose)
+        return subSeries.index.values[positions], counts
+    positions = getClusterPositions(len(subSeries), n_samples, enforce_fmax, verbose=verbose)
+    return subSeries.index.values[positions]
+
+def getClusterPositions(numTests, n_samples=100, enforce_fmax=False, verbose=False, random_state=None):
+    """Return a matrix of the positions of the clusters in each bootstrap sample (one row per sample).
+
+    Same samples as getClusterIndices, as integer positions instead of cluster ids.
+    Random samples are drawn from random_state (a np.random.RandomState, see
+    getVariantRandomState), or from the global random state if None."""
+    if random_state is None:
+        random_state = np.random
     # find number of samples to bootstrap
-    numTests = len(subSeries)
-    if numTests <10 and np.power(numTests, numTests) <= n_samples and not enforce_fmax:
+    if _doAllSamples(numTests, n_samples, enforce_fmax):
         # then do all possible permutations
         if verbose:
             print ('Doing all possible %d product of indices'
                    %np.power(numTests, numTests))
-        indices = [list(i) for i in itertools.product(*[subSeries.index]*numTests)]
+        products = list(itertools.product(range(numTests), repeat=numTests))
+        positions = np.array(products, dtype=int).reshape(len(products), numTests)
     else:
         # do at most 'n_samples' number of iterations
         if verbose:
             print ('making %4.0f randomly selected (with replacement) '
                    'bootstrapped median binding curves')%n_samples
-        indices = np.random.choice(subSeries.index,
-                                   size=(n_samples, len(subSeries)), replace=True)
-    return indices
+        positions = random_state.choice(numTests, size=(n_samples, numTests), replace=True)
+    return positions
+
+def _variantKey(variant):
+    """Return a variant id as a string, the same for e.g. 5, 5.0 and np.int64(5)."""
+    if isinstance(variant, (int, long, float, np.number)) and float(variant).is_integer():
+        return '%d'%variant
+    return str(variant)
+
+def getVariantRandomState(seed, variant):
+    """Return a random state for a variant, derived from the seed of the run and the variant id.
+
+    Each variant has its own reproducible stream of random numbers, whatever order or
+    worker process it is fit in."""
+    digest = hashlib.sha1('%s:%s'%(seed, _variantKey(variant))).hexdigest()
+    return np.random.RandomState([int(digest[i:i+8], 16) for i in range(0, 40, 8)])
+
+def _doAllSamples(numTests, n_samples, enforce_fmax):
+    """Return whether to bootstrap with all possible samples of clusters, rather than random ones."""
+    return numTests <10 and np.power(numTests, numTests) <= n_samples and not enforce_fmax
+
+def getClusterMultisets(numTests, n_samples=100, enforce_fmax=False, verbose=False, return_inverse=False,
+                        random_state=None):
+    """Return the distinct multisets of cluster positions to bootstrap, and the number of samples of each.
+
+    Same samples as getClusterPositions, but samples with the same clusters in any
+    order (and so the same median curve) are returned once, with their count. If
+    enforce_fmax, each sample has its own fmax, so all counts are 1.
+
+    If return_inverse, also return the multiset of each random sample, in the order
+    they were drawn (None if all possible samples are used)."""
+    if _doAllSamples(numTests, n_samples, enforce_fmax):
+        # each multiset appears once for every distinct ordering of its clusters
+        if verbose:
+            print ('Doing all possible %d product of indices'
+                   %np.power(numTests, numTests))
+        multisets = list(itertools.combinations_with_replacement(range(numTests), numTests))
+        positions = np.array(multisets, dtype=int).reshape(len(multisets), numTests)
+        counts = np.array([factorial(numTests)/np.prod([factorial(m) for m in np.bincount(row)])
+                           for row in positions], dtype=int)
+        inverse = None
+    else:
+        positions = getClusterPositions(numTests, n_samples, enforce_fmax, verbose=verbose, random_state=random_state)
+        if enforce_fmax:
+            counts, inverse = np.ones(len(positions), dtype=int), np.arange(len(positions))
+        else:
+            positions, counts, inverse = getUniquePositions(positions, return_inverse=True)
+    if return_inverse:
+        return positions, counts, inverse
+    return positions, counts
+
+def getNumBootstrapFits(numTests, n_samples=100, enforce_fmax=False):
+    """Return the number of fits to bootstrap a variant with numTests clusters (see getClusterMultisets).
+
+    Random samples can repeat, so this is an upper bound unless enforce_fmax."""
+    if enforce_fmax:
+        return n_samples
+    # number of multisets of numTests clusters, C(2*numTests-1, numTests), found
+    # term by term to stop once it is more than the number of samples
+    num_multisets = 1
+    for k in range(1, numTests+1):
+        num_multisets = num_multisets*(numTests-1+k)/k
+        if num_multisets >= n_samples and not _doAllSamples(numTests, n_samples, enforce_fmax):
+            return n_samples
+    return num_multisets
+
+def getUniquePositions(positions, return_inverse=False):
+    """Return the distinct multisets of clusters in a matrix of bootstrap samples, and the count of each.
+
+    positions is a matrix of samples by clusters (see getClusterPositions). If
+    return_inverse, also return the multiset of each sample."""
+    # sort clusters within each sample, then sort samples so that equal ones are adjacent
+    sorted_positions = np.sort(positions, axis=1)
+    order = np.lexsort(sorted_positions.T[::-1])
+    sorted_positions = sorted_positions[order]
+    is_new = np.concatenate([[True], np.any(np.diff(sorted_positions, axis=0) != 0, axis=1)])
+    starts = np.where(is_new)[0]
+    counts = np.diff(np.append(starts, len(sorted_positions)))
+    if return_inverse:
+        inverse = np.empty(len(positions), dtype=int)
+        inverse[order] = np.cumsum(is_new) - 1
+        return sorted_positions[starts], counts, inverse
+    return sorted_positions[starts], counts
+
+def getBootstrappedMedians(values, positions):
+    """Return the median curve of each bootstrap sample.
+
+    values is a matrix of clusters by concentrations and positions a matrix of
+    samples by clusters (see getClusterPositions). Returns a matrix of samples
+    by concentrations."""
+    with warnings.catch_warnings():
+        # concentrations with no measurements in a sample are NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(np.take(values, positions, axis=0), axis=1)
 
 
 def bootstrapCurves(x, subSeries, fitParameters, fmaxDist, func,
@@ -373,20 +789,52 @@ def findRsq(x, y, params, func):
     return 1-ss_error/ss_total
 
 
-def findProcessedSingles(singles, param_names):
-    """Given the output of the singles, find the upper and lower bounds."""
+def weightedQuantile(values, counts, quantiles):
+    """Return quantiles of values that each occur counts times.
+
+    Same as the quantiles (linearly interpolated, ignoring NaN) of the values each
+    repeated by its count."""
+    values = np.asarray(values, dtype=float)
+    index = np.isfinite(values)
+    if not index.any():
+        return np.ones(len(quantiles))*np.nan
+    order = np.argsort(values[index], kind='mergesort')
+    values = values[index][order]
+    cum_counts = np.cumsum(np.asarray(counts)[index][order])
+    # positions in the repeated values, and the values there
+    positions = np.asarray(quantiles, dtype=float)*(cum_counts[-1] - 1)
+    below = np.floor(positions)
+    frac = positions - below
+    value_below = values[np.searchsorted(cum_counts, below, side='right')]
+    value_above = values[np.searchsorted(cum_counts, np.minimum(below + 1, cum_counts[-1] - 1), side='right')]
+    return value_below*(1 - frac) + value_above*frac
+
+def findProcessedSingles(singles, param_names, counts=None):
+    """Given the output of the singles, find the upper and lower bounds.
+
+    If counts is given, each fit in singles stands for that many bootstrap samples
+    (see getClusterMultisets)."""
     # save results
-    data = pd.concat({param:singles.loc[:, param].quantile([0.5, 0.025, 0.975]) for param in param_names}, axis=1)
+    quantiles = [0.5, 0.025, 0.975]
+    if counts is None:
+        data = pd.concat({param:singles.loc[:, param].quantile(quantiles) for param in param_names}, axis=1)
+    else:
+        data = pd.DataFrame({param:weightedQuantile(singles.loc[:, param], counts, quantiles) for param in param_names},
+                            index=quantiles, columns=param_names)
     data.index = ['', '_lb', '_ub']
     results = data.stack().swaplevel(0,1).sort_index()
     results.index = [''.join(s) for s in results.index.tolist()]
     return results
 
 
-def fitSetClusters(fitParams, ySeries, print_bool=True):
-    """ Fit a set of curves. """
-    singles = {}
-    times = {}
+def fitSetClusters(fitParams, ySeries, print_bool=True, telemetry=False, init=None):
+    """ Fit a set of curves.
+
+    If init (a DataFrame of params per curve, i.e. previous results) is given, each
+    curve is fit starting from its finite params in it."""
+    if init is not None:
+        init = init.reindex(ySeries.index)
+    sink = ResultSink(ySeries.index, sorted(getResultColumns(sorted(fitParams.param_names), telemetry=telemetry)))
     for i, idx in enumerate(ySeries.index.tolist()):
         # track progress
         if print_bool:
@@ -396,19 +844,10 @@ def fitSetClusters(fitParams, ySeries, print_bool=True):
                        %(i+1, len(ySeries), 100*(i+1)/
                          float(len(ySeries))))
                 sys.stdout.flush()
-        # fit single cluster
-        y = ySeries.loc[idx]
-        
-        # find init time
-        t0 = datetime.datetime.now()
-        
-        # fit
-        singles[idx] = perCluster(fitParams, y)
-        
-        # find time diff
-        t1 = datetime.datetime.now()
-        times[idx] = (t1 - t0).total_seconds()
-    return pd.concat(singles).unstack()
+        # fit single cluster into row i
+        fitParams.fit_curve(ySeries.iloc[i], sink=sink, row=i, telemetry=telemetry,
+                            init=(None if init is None else init.iloc[i]))
+    return sink.to_dataframe()
 
 def perCluster(fitParams, y, plot=False):
     """ Fit a single binding curve. """
@@ -427,7 +866,8 @@ def perVariant(variantParams, variant, n_samples=100, enforce_fmax=None, weighte
     time_diff = (t1 - t0).total_seconds()
     return variantParams.results
 
-def fitSetVariants(variantParams, variants=None,  n_samples=100, enforce_fmax=None, weighted_fit=True, min_error=0, func_kwargs={}, print_bool=True, return_time=False,bs_dGs_path=None):
+def fitSetVariants(variantParams, variants=None,  n_samples=100, enforce_fmax=None, weighted_fit=True, min_error=0, func_kwargs={}, print_bool=True, return_time=False,bs_dGs_path=None, engine='lmfit', block_size=None,
+                   tolerance=None, min_samples=20, seed=None):
     """Fit a set of variants to objective function by bootstrapping median fluorescence.
     05132022 edit (John Shin) - add option to save bs dGs (bs_dGs_path)"""
     t0 = datetime.datetime.now()
@@ -436,7 +876,12 @@ def fitSetVariants(variantParams, variants=None,  n_samples=100, enforce_fmax=No
                                                    enforce_fmax=enforce_fmax,
                                                     print_bool=print_bool,
                                          return_results=True,
-                                         bs_dGs_path=bs_dGs_path)
+                                         bs_dGs_path=bs_dGs_path,
+                                         engine=engine,
+                                         block_size=block_size,
+                                         tolerance=tolerance,
+                                         min_samples=min_samples,
+                                         seed=seed)
     t1 = datetime.datetime.now()
     time_diff = (t1 - t0).total_seconds()
     if return_time:
@@ -0,0 +1,174 @@
+"""Binding series of clusters grouped by variant.
+
+All clusters are kept in one contiguous float matrix, sorted so that the
+clusters of each variant are adjacent. offsets[i]:offsets[i+1] are the rows of
+the i-th variant, and slots maps each variant to i, so finding the clusters of
+a variant is a dict lookup and a slice of the matrix (a view, not a copy).
+
+A GroupedSeries can be saved to a directory of .npy files (save) and opened
+memory-mapped (load), e.g. by parallel workers, each opening only a range of
+slots without reading or copying the rest.
+"""
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+_array_names = ['values', 'cluster_ids', 'variants', 'offsets']
+
+def _asArray(values):
+    """Return values as an array, keeping the types of values of mixed types (e.g. ints and strings)."""
+    values = list(values) if not isinstance(values, np.ndarray) else values
+    if not isinstance(values, np.ndarray) and len(set([type(value) for value in values])) > 1:
+        return np.array(values, dtype=object)
+    return np.asarray(values)
+
+def _loadArray(filename, mmap_mode='r'):
+    """Memory map a saved array, or load it if it holds python objects (which can't be memory mapped)."""
+    try:
+        return np.load(filename, mmap_mode=mmap_mode)
+    except ValueError:
+        return np.load(filename, allow_pickle=True)
+
+def saveGroups(directory, cluster_ids, variants, offsets, columns):
+    """Save everything but the values of a GroupedSeries to a directory.
+
+    With the values saved to values.npy in the same directory (e.g. written in
+    pieces to a memory map), the directory can be opened by GroupedSeries.load."""
+    cluster_ids = np.asarray(cluster_ids)
+    if cluster_ids.dtype == object and all([isinstance(cluster_id, basestring) for cluster_id in cluster_ids]):
+        # fixed width strings can be memory mapped
+        cluster_ids = np.array(cluster_ids.tolist())
+    arrays = {'cluster_ids':cluster_ids, 'variants':_asArray(variants), 'offsets':np.asarray(offsets, dtype=int)}
+    for name in ['cluster_ids', 'variants', 'offsets']:
+        np.save(os.path.join(directory, name + '.npy'), arrays[name])
+    with open(os.path.join(directory, 'columns.p'), 'wb') as f:
+        pickle.dump(list(columns), f)
+
+
+class GroupedSeries(object):
+    """Matrix of cluster values (rows) grouped by variant.
+
+    Made from a table of clusters and their variants (from_dataframe) or from a
+    table indexed by (variant, cluster) (from_multiindex)."""
+    def __init__(self, values, cluster_ids, variants, offsets, columns):
+        self.values = np.ascontiguousarray(values, dtype=float)
+        self.cluster_ids = np.asarray(cluster_ids)
+        self.variants = _asArray(variants)
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.columns = pd.Index(columns)
+        self.slots = {variant:i for i, variant in enumerate(self.variants.tolist())}
+
+    @classmethod
+    def from_labels(cls, values, cluster_ids, labels, columns, sort=True):
+        """Group rows of values by their labels (the variant of each row).
+
+        Rows keep their order within each variant. Variants are sorted if sort,
+        otherwise they are in the order they first appear."""
+        codes, variants = pd.factorize(np.asarray(labels), sort=sort)
+        order = np.argsort(codes, kind='mergesort')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(variants)))])
+        return cls(np.asarray(values, dtype=float)[order], np.asarray(cluster_ids)[order], variants, offsets, columns)
+
+    @classmethod
+    def from_dataframe(cls, binding_series, annotated_clusters):
+        """Group the rows of a binding series by the variant_number of each cluster in annotated_clusters.
+
+        annotated_clusters is a DataFrame with a variant_number column or a Series
+        of variant numbers. Clusters without a variant are left out."""
+        if isinstance(annotated_clusters, pd.DataFrame):
+            annotated_clusters = annotated_clusters.variant_number
+        annotated_clusters = annotated_clusters.dropna()
+        ys = binding_series.reindex(annotated_clusters.index)
+        return cls.from_labels(ys.values, ys.index.values, annotated_clusters.values, ys.columns)
+
+    @classmethod
+    def from_multiindex(cls, binding_series_dict):
+        """Group a binding series indexed by (variant, cluster), i.e. the output of enforceFmax.makeGroupDict."""
+        return cls.from_labels(binding_series_dict.values, binding_series_dict.index.get_level_values(1).values,
+                               binding_series_dict.index.get_level_values(0).values, binding_series_dict.columns,
+                               sort=False)
+
+    def __len__(self):
+        return len(self.variants)
+
+    def __contains__(self, variant):
+        return variant in self.slots
+
+    def get_rows(self, variant):
+        """Return the (start, stop) rows of a variant, or (0, 0) if it has no clusters."""
+        try:
+            i = self.slots[variant]
+        except KeyError:
+            return 0, 0
+        return self.offsets[i], self.offsets[i+1]
+
+    def get_values(self, variant):
+        """Return the matrix of values of the clusters of a variant (a view, do not modify)."""
+        start, stop = self.get_rows(variant)
+        return self.values[start:stop]
+
+    def get_cluster_ids(self, variant):
+        """Return the ids of the clusters of a variant."""
+        start, stop = self.get_rows(variant)
+        return self.cluster_ids[start:stop]
+
+    def get_ys(self, variant):
+        """Return the values of the clusters of a variant as a DataFrame indexed by cluster id.
+
+        The DataFrame shares its values with this object, so do not modify it."""
+        start, stop = self.get_rows(variant)
+        return pd.DataFrame(self.values[start:stop], index=self.cluster_ids[start:stop], columns=self.columns,
+                            copy=False)
+
+    def num_tests(self):
+        """Return the number of clusters of each variant."""
+        return pd.Series(np.diff(self.offsets), index=self.variants)
+
+    def get_labels(self):
+        """Return the variant of each row."""
+        return np.repeat(self.variants, np.diff(self.offsets))
+
+    def medians(self):
+        """Return the median values of the clusters of each variant."""
+        medians = pd.DataFrame(self.values, columns=self.columns).groupby(np.repeat(np.arange(len(self)), np.diff(self.offsets))).median()
+        medians.index = self.variants[medians.index.values]
+        return medians
+
+    def subset(self, variants):
+        """Return a GroupedSeries with only the given variants (in the order given), with a copy of their values.
+
+        Variants without clusters are kept, with no rows."""
+        rows = [np.arange(*self.get_rows(variant)) for variant in variants]
+        counts = [len(row) for row in rows]
+        rows = np.concatenate(rows).astype(int) if len(rows) > 0 else np.array([], dtype=int)
+        return GroupedSeries(self.values[rows], self.cluster_ids[rows], variants, np.concatenate([[0], np.cumsum(counts)]),
+                             self.columns)
+
+    def to_dataframe(self):
+        """Return the values as a DataFrame indexed by (variant_number, clusterID)."""
+        index = pd.MultiIndex.from_arrays([self.get_labels(), self.cluster_ids], names=['variant_number', 'clusterID'])
+        return pd.DataFrame(self.values, index=index, columns=self.columns)
+
+    def save(self, directory):
+        """Save to .npy files in a directory, to be memory mapped by load."""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, 'values.npy'), self.values)
+        saveGroups(directory, self.cluster_ids, self.variants, self.offsets, self.columns)
+        return directory
+
+    @classmethod
+    def load(cls, directory, start=None, stop=None):
+        """Open a GroupedSeries saved in a directory, memory mapped read-only.
+
+        If start and stop are given, only slots start to stop are opened."""
+        arrays = {name:_loadArray(os.path.join(directory, name + '.npy')) for name in _array_names}
+        with open(os.path.join(directory, 'columns.p'), 'rb') as f:
+            columns = pickle.load(f)
+        if start is None:
+            start, stop = 0, len(arrays['variants'])
+        offsets = np.array(arrays['offsets'][start:stop+1])
+        rows = slice(offsets[0], offsets[-1])
+        return cls(arrays['values'][rows], arrays['cluster_ids'][rows], np.array(arrays['variants'][start:stop]),
+                   offsets - offsets[0], columns)
@@ -7,7 +7,7 @@ import itertools
 import scipy.stats as st
 import copy
 #from sklearn import metrics
-from fittinglibs import objfunctions, variables, fitting, plotting
+from fittinglibs import objfunctions, variables, fitting, plotting, batchfitting, groupedseries, singlesstore
 
 class FitParams():
     """Class with attributes objective function, initial params, upper/lowerbounds on params."""
@@ -37,7 +37,37 @@ class FitParams():
     def update_init_params(self, **init_kws):
         """Given kwargs, update the fit_parameter values."""
         self.fit_parameters = _update_init_params(self.fit_parameters, **init_kws)
+        self.fit_spec = fitting.FitSpec.from_dict(self.fit_parameters)
     
+    def get_fit_spec(self, fit_parameters=None):
+        """Return the compiled fit parameters (fitting.FitSpec).
+
+        fit_parameters may be None (use those of this instance), a dict formatted
+        like self.fit_parameters, or already a FitSpec."""
+        if fit_parameters is None:
+            if getattr(self, 'fit_spec', None) is None:
+                self.fit_spec = fitting.FitSpec.from_dict(self.fit_parameters)
+            return self.fit_spec
+        if isinstance(fit_parameters, fitting.FitSpec):
+            return fit_parameters
+        return fitting.FitSpec.from_dict(fit_parameters)
+
+    def predict(self, results, x=None):
+        """Return the model values (n_curves, n_x) of each set of params in results.
+
+        results is a DataFrame with a row per curve and a column per param, or a list of
+        Series keyed by param name (see objfunctions.getParamMatrix). All curves are
+        found at once with the batched form of the function, if it has one."""
+        if x is None:
+            x = self.x
+        batch = objfunctions.getBatchFunction(self.func_name)
+        if batch is None:
+            rows = [row for i, row in results.iterrows()] if isinstance(results, pd.DataFrame) else results
+            return np.array([self.func(_get_params_from_results(pd.Series(row), self.param_names), x, **self.fit_kws)
+                             for row in rows])
+        model_param_names, batch_func = batch
+        return batch_func(objfunctions.getParamMatrix(results, model_param_names), np.asarray(x, dtype=float),
+                          **self.fit_kws)
 
     
         
@@ -53,19 +83,61 @@ class FitParams():
                 fit_parameters = _update_init_params(fit_parameters, **{param_name:{key:operation(y)}})
         return _get_init_params(fit_parameters)
     
-    def fit_curve(self, y, fit_parameters=None, weights=None, min_kws={'xtol':1E-6, 'ftol':1E-6, 'maxfev':100}, return_results=False):
-        """fit a single curve to y values."""
-        if fit_parameters is None:
-            fit_parameters = self.fit_parameters
+    def get_curve_fit_spec(self, y, fit_parameters=None, init=None):
+        """Return the fitting.FitSpec used to fit y, after applying the before fit operations.
+
+        If init (a Series of params, i.e. a previous fit) is given, its finite values are the initial values."""
+        fit_spec = self.get_fit_spec(fit_parameters)
         
         # change fit parameters according to list of operations 
         if self.before_fit_ops:
+            fit_spec = fit_spec.copy()
             for (param_name, key, operation) in self.before_fit_ops:
-                if fit_parameters[param_name]['vary']:
-                    fit_parameters = _update_init_params(fit_parameters, **{param_name:{key:operation(y)}})
+                if fit_spec.vary[fit_spec.index(param_name)]:
+                    fit_spec.update(param_name, **{key:operation(y)})
+
+        # the fit can't start from NaN (i.e. the default initial fmax), so fmax starts
+        # from the max of y instead, as in batchfitting.getParamArrays
+        if 'fmax' in fit_spec.names and not np.isfinite(fit_spec.init[fit_spec.index('fmax')]):
+            i = fit_spec.index('fmax')
+            y_values = np.asarray(y, dtype=float)
+            if np.isfinite(y_values).any():
+                fit_spec = fit_spec.copy()
+                fit_spec.update('fmax', initial=np.clip(np.nanmax(y_values), fit_spec.lb[i], fit_spec.ub[i]))
+        if init is not None:
+            fit_spec = fit_spec.copy()
+            for param_name, val in init.iteritems():
+                if param_name in self.param_names and np.isfinite(val):
+                    fit_spec.update(param_name, initial=val)
+        return fit_spec
+    
+    def get_cache_key(self, cache, y, fit_parameters=None, weights=None, min_kws={'xtol':1E-6, 'ftol':1E-6, 'maxfev':100},
+                      engine='lmfit'):
+        """Return the key of the fit of y in a fitcache.FitCache, as used by fit_curve.
+
+        Fits by engines other than lmfit (see batchfitting) get different keys."""
+        min_kws = dict(min_kws, use_jacobian=True)
+        if engine != 'lmfit':
+            min_kws['engine'] = engine
+        return cache.key(self.x, y, self.func.__name__, self.get_curve_fit_spec(y, fit_parameters),
+                         weights=weights, kwargs=self.fit_kws, min_kws=min_kws)
+    
+    def fit_curve(self, y, fit_parameters=None, weights=None, min_kws={'xtol':1E-6, 'ftol':1E-6, 'maxfev':100}, return_results=False,
+                  sink=None, row=None, cache=None, telemetry=False, init=None):
+        """fit a single curve to y values.
+
+        fit_parameters may be a dict formatted like self.fit_parameters or a fitting.FitSpec.
+        If init (a Series of params) is given, the fit starts from its finite values.
+        If sink (a fitting.ResultSink) is given, results are written into its row instead.
+        If cache (a fitcache.FitCache) is given, curves that were already fit are looked up.
+        If telemetry is True, the time and number of function evaluations of the fit are saved too."""
+        fit_spec = self.get_curve_fit_spec(y, fit_parameters, init=init)
         
         # weight fit if weights are given
-        results = fitting.fitSingleCurve(self.x, y, _convert_to_expected_fit_parameters(fit_parameters), self.func, weights=weights, kwargs=self.fit_kws, min_kws=min_kws)
+        results = fitting.fitSingleCurve(self.x, y, fit_spec, self.func, weights=weights, kwargs=self.fit_kws, min_kws=min_kws,
+                                         sink=sink, row=row, cache=cache, telemetry=telemetry)
+        if sink is not None:
+            return
         
         if return_results:
             return results
@@ -99,8 +171,7 @@ class FitParams():
         line, = plotting.plt.plot(x, y, 'o', **kwargs)
         if plot_fit:
             if 'color' in kwargs.keys(): kwargs.pop('color')
-            params = _get_params_from_results(results, self.param_names)
-            plotting.plt.plot(more_x, self.func(params, more_x), color=line.get_color(), **kwargs)
+            plotting.plt.plot(more_x, self.predict([results], more_x)[0], color=line.get_color(), **kwargs)
 
 
     def plot_initfit(self, y=None, fit_parameters=None, **kwargs):
@@ -144,9 +215,11 @@ class FitParams():
 class MoreFitParams():
     """Add more attributes to enable fitting of curves with specific distribution for fmax in particular."""
     def __init__(self, fitParams, initial_points=None, binding_series_dict=None, binding_series=None, annotated_clusters=None, fmax_dist_obj=None, results=None):
-
         self.fitParams = fitParams 
         self.initial_points = initial_points
+        # binding_series_dict is a groupedseries.GroupedSeries, or a DataFrame indexed by (variant, cluster)
+        if isinstance(binding_series_dict, pd.DataFrame):
+            binding_series_dict = groupedseries.GroupedSeries.from_multiindex(binding_series_dict)
         self.binding_series_dict = binding_series_dict
         self.binding_series = binding_series
         self.annotated_clusters = annotated_clusters
@@ -154,34 +227,52 @@ class MoreFitParams():
         self.results_all = results
         #self.variants = 
         if initial_points is not None and binding_series_dict is not None:
-            self.variants = list(set(binding_series_dict.groupby(level=0).first().index.tolist()).union(initial_points.index.tolist()))     
+            self.variants = list(set(binding_series_dict.variants.tolist()).union(initial_points.index.tolist()))     
         # make sure there are values for initial points for all variants
 
-    def get_ys(self, idx):
-        """Find the set of y values associated with a variant."""
+    def get_grouped_series(self):
+        """Return the y values of all clusters grouped by variant (a groupedseries.GroupedSeries)."""
         if self.binding_series_dict is None:
             if self.binding_series is None or self.annotated_clusters is None:
                 raise IndexError('Need to define either binding_series_dict or binding series and annotated clusters')
-            index = self.annotated_clusters.loc[self.annotated_clusters.variant_number==idx].index
-            return self.binding_series.loc[index]
-        else:
-            try:
-                return self.binding_series_dict.loc[idx]
-            except KeyError:
-                return pd.DataFrame(columns=self.binding_series_dict.columns)
-                
+            self.binding_series_dict = groupedseries.GroupedSeries.from_dataframe(self.binding_series, self.annotated_clusters)
+        elif isinstance(self.binding_series_dict, pd.DataFrame):
+            # saved before binding series were grouped
+            self.binding_series_dict = groupedseries.GroupedSeries.from_multiindex(self.binding_series_dict)
+        return self.binding_series_dict
 
-    def fit_set_binding_curves(self, idx, enforce_fmax=None, weighted_fit=True, n_samples=100, return_results=False, use_initial=False, bs_dGs_path=False):
-        """Fit a set of y values to a curve.
-        05132022 edit (John Shin) - add option to save bs dGs (bs_dGs_path)
+    def get_ys(self, idx):
+        """Find the set of y values associated with a variant."""
+        return self.get_grouped_series().get_ys(idx)
+
+    def setup_set_binding_curves(self, idx, enforce_fmax=None, weighted_fit=True, n_samples=100, use_initial=False, weights=None,
+                                 seed=None, fmaxes=None):
+        """Find the bootstrapped median curves of a variant and how to fit them.
+
+        Returns a dict with the clusters of the variant (ys), their median (y), the fit
+        parameters, whether fmax is enforced, the fmax of each bootstrapped curve (fmaxes,
+        if enforced) or the bounds on fmax (fmax_bounds), the weights, and the bootstrapped
+        cluster ids (indices), the number of samples of each (counts), the set of each
+        random sample in the order drawn (sample_slots, see fitting.getClusterMultisets),
+        and their median curves (medians, None if there are no clusters).
+
+        If weighted_fit, weights already found for the variant can be given (see
+        fitting.getWeightsFromBindingSeriesList); otherwise they are found from its clusters.
+        Likewise, n_samples fmaxes already drawn for the variant can be given (see
+        distribution.fmaxSampler), to be used if fmax is enforced.
+
+        If seed is given, the fmaxes, weights and bootstrap samples are drawn from the
+        random state of the variant (see fitting.getVariantRandomState), so they don't
+        depend on which other variants were fit before it.
         """
-        x = self.fitParams.x
+        random_state = None
+        if seed is not None:
+            random_state = fitting.getVariantRandomState(seed, idx)
         ys = self.get_ys(idx)        
         y = ys.median()
         num = len(ys)
         fmax_dist = self.fmax_dist_obj.getDist(num)
         fit_parameters = copy.deepcopy(self.fitParams.fit_parameters)
-        param_names = self.fitParams.param_names
         initial_points = self.initial_points.loc[idx]
         
         # update parameters based on initial points
@@ -199,42 +290,192 @@ class MoreFitParams():
             enforce_fmax = (fitting.enforceFmaxDistribution(y, fmax_dist) )
             
         # if enforce fmax, find set of fmaxes to use
-        if enforce_fmax:
-            fmaxes = fmax_dist.rvs(n_samples)
+        if not enforce_fmax:
+            fmaxes = None
+        elif fmaxes is None:
+            fmaxes = fmax_dist.rvs(n_samples, random_state=random_state)
 
         # find error on ys and use this to weight if weighted fit option is given.
-        if weighted_fit:
-            weights = fitting.getWeightsFromBindingSeries(ys) # note here is a cutoff
-        else:
+        if not weighted_fit:
             weights = None
-
-        # get bootstrap indices
-        indices = fitting.getClusterIndices(ys, n_samples, enforce_fmax)
+        elif weights is None:
+            weights = fitting.getWeightsFromBindingSeries(ys, random_state=random_state) # note here is a cutoff
+
+        # get bootstrap indices, as positions in ys and as cluster ids. Samples with the
+        # same clusters have the same median curve, so each distinct set is fit once
+        # and counted as many times as it was sampled.
+        positions, counts, sample_slots = fitting.getClusterMultisets(len(ys), n_samples, enforce_fmax, return_inverse=True,
+                                                                      random_state=random_state)
+        indices = ys.index.values[positions]
         
-        # for each set of clusters, fit
-        singles = []
-        # if ys is empty, don't fit
-        if len(ys) == 0 :
-            if return_results:
-                return None, singles, ys, indices
-            else:
-                return
-            
-        for i, index in enumerate(indices):
-            if enforce_fmax:
-                fit_parameters_fmax = _update_init_params(fit_parameters, fmax={'initial':fmaxes[i], 'vary':False})
-            else:
-                fit_parameters_fmax = _update_init_params(fit_parameters, fmax={'lowerbound':lb, 'upperbound':ub})
-            #single = fitting.fitSingleCurve(x, ys.loc[index].median(), _convert_to_expected_fit_parameters(fit_parameters), func, weights=weights, kwargs=fit_kws, min_kws=min_kws)
-            #singles.append(single)
-            results = self.fitParams.fit_curve(ys.loc[index].median(), fit_parameters=fit_parameters_fmax, weights=weights, return_results=True)
-            singles.append(results)
-        singles = pd.concat(singles, axis=1).transpose()
+        # find all bootstrapped median curves at once. if ys is empty, there is nothing to fit
+        medians = None
+        if len(ys) > 0:
+            medians = pd.DataFrame(fitting.getBootstrappedMedians(ys.values.astype(float), positions), columns=ys.columns)
+
+        return {'idx':idx, 'ys':ys, 'y':y, 'fit_parameters':fit_parameters, 'initial_points':initial_points,
+                'enforce_fmax':enforce_fmax, 'fmaxes':fmaxes, 'fmax_bounds':(lb, ub), 'weights':weights,
+                'indices':indices, 'counts':counts, 'sample_slots':sample_slots, 'medians':medians}
+
+    def get_bootstrap_param_arrays(self, setup):
+        """Return init, lb, ub and vary arrays for the bootstrapped median curves of a variant.
+
+        Arrays are in the order of the batched model (see batchfitting.getParamArrays), with
+        fmax fixed to the sampled fmaxes if enforced, or bounded otherwise."""
+        medians = setup['medians']
+        init, lbs, ubs, vary = batchfitting.getParamArrays(self.fitParams, medians, fit_parameters=setup['fit_parameters'])
+        fmax_index = batchfitting.batch_funcs[self.fitParams.func_name][0].index('fmax')
+        if setup['enforce_fmax']:
+            init[:, fmax_index] = setup['fmaxes'][:len(medians)]
+            vary[fmax_index] = False
+        else:
+            lbs[:, fmax_index], ubs[:, fmax_index] = setup['fmax_bounds']
+        return init, lbs, ubs, vary
+
+    def fit_bootstrapped_curves(self, setup, engine='lmfit'):
+        """Fit the bootstrapped median curves of a variant and return the results of each fit.
+
+        engine is 'lmfit' to fit each bootstrapped curve separately, or 'batched' or
+        'varpro' to fit them all at once by batched Levenberg-Marquardt or variable
+        projection (see batchfitting.fitCurves).
+        """
+        medians = setup['medians']
+        if engine in ['batched', 'varpro']:
+            method = 'varpro' if engine == 'varpro' else 'leastsq'
+            init, lbs, ubs, vary = self.get_bootstrap_param_arrays(setup)
+            return batchfitting.fitCurves(self.fitParams, medians, init, lbs, ubs, vary, weights=setup['weights'],
+                                          method=method)
+        elif engine == 'lmfit':
+            fit_spec = fitting.FitSpec.from_dict(setup['fit_parameters'])
+            lb, ub = setup['fmax_bounds']
+            singles = fitting.ResultSink(range(len(medians)), fitting.getResultColumns(fit_spec.names))
+            for i in range(len(medians)):
+                fit_spec_fmax = fit_spec.copy()
+                if setup['enforce_fmax']:
+                    fit_spec_fmax.update('fmax', initial=setup['fmaxes'][i], vary=False)
+                else:
+                    fit_spec_fmax.update('fmax', lowerbound=lb, upperbound=ub)
+                self.fitParams.fit_curve(medians.iloc[i], fit_parameters=fit_spec_fmax, weights=setup['weights'], sink=singles, row=i)
+            return singles.to_dataframe()
+        else:
+            raise ValueError('engine %s not recognized. Options are "lmfit", "batched", or "varpro".'%engine)
 
+    def fit_bootstrapped_curves_block(self, setups, engine='batched'):
+        """Fit the bootstrapped median curves of a block of variants together.
+
+        Curves are grouped by which parameters vary (i.e. whether fmax is enforced), and
+        each group is fit in one call to batchfitting.fitCurves. Returns the results of
+        the fits of each variant, as in fit_bootstrapped_curves.
+        """
+        if engine not in ['batched', 'varpro']:
+            raise ValueError('engine %s can not fit blocks of variants. Options are "batched" or "varpro".'%engine)
+        method = 'varpro' if engine == 'varpro' else 'leastsq'
+        num_x = len(self.fitParams.x)
+        arrays = [self.get_bootstrap_param_arrays(setup) for setup in setups]
+        groups = {}
+        for i, vary in enumerate([vary for init, lbs, ubs, vary in arrays]):
+            groups.setdefault(tuple(vary), []).append(i)
+
+        singles = [None]*len(setups)
+        for vary, members in groups.items():
+            # stack curves of all variants in the group. Variants without weights get equal weights
+            num_curves = [len(setups[i]['medians']) for i in members]
+            medians = pd.concat([setups[i]['medians'] for i in members], ignore_index=True)
+            init, lbs, ubs = [np.vstack([arrays[i][j] for i in members]) for j in range(3)]
+            weights = np.vstack([np.ones((n, num_x))*(1 if setups[i]['weights'] is None else np.asarray(setups[i]['weights'], dtype=float))
+                                 for i, n in zip(members, num_curves)])
+            fits = batchfitting.fitCurves(self.fitParams, medians, init, lbs, ubs, np.array(vary), weights=weights,
+                                          method=method)
+            # split back into variants
+            for i, start, stop in zip(members, np.cumsum([0]+num_curves[:-1]), np.cumsum(num_curves)):
+                singles[i] = fits.iloc[start:stop].reset_index(drop=True)
+        return singles
+
+    def fit_bootstrapped_curves_adaptive(self, setups, engine='lmfit', tolerance=0.01, min_samples=20, block=False):
+        """Fit the bootstrapped median curves of variants in batches of samples until their bounds converge.
+
+        Samples are used in the order they were drawn, min_samples at a time. After each
+        batch, the median and 95% bounds of each varied parameter are found from the
+        samples so far (see fitting.findProcessedSingles), and a variant is done once
+        none of them changed by more than tolerance times the width of the 95% interval
+        of that parameter since the previous batch, or once all of its samples are used.
+        The tolerance is thus relative, and the same for parameters of any scale. If all possible samples are used (few clusters),
+        they are fit at once. If block and engine is 'batched' or 'varpro', the batches
+        of all variants are fit together (see fit_bootstrapped_curves_block).
+
+        Returns the singles and the counts of each variant, from the samples used.
+        """
+        states = []
+        for setup in setups:
+            sample_slots = setup['sample_slots']
+            batch = min_samples
+            if sample_slots is None:
+                sample_slots = np.repeat(np.arange(len(setup['counts'])), setup['counts'])
+                batch = len(sample_slots)
+            states.append({'sample_slots':sample_slots, 'batch':batch, 'num_samples':0, 'singles':None,
+                           'counts':None, 'bounds':None, 'done':False,
+                           'param_names':[key for key in self.fitParams.param_names if setup['fit_parameters'][key]['vary']]})
+        while True:
+            active = [i for i, state in enumerate(states) if not state['done']]
+            if len(active) == 0:
+                break
+            # find the new distinct sets of clusters in the next batch of each variant
+            sub_setups, rows = [], []
+            for i in active:
+                state = states[i]
+                state['num_samples'] = min(state['num_samples'] + state['batch'], len(state['sample_slots']))
+                counts = np.bincount(state['sample_slots'][:state['num_samples']], minlength=len(setups[i]['counts']))
+                new_rows = np.where(counts > 0)[0]
+                if state['singles'] is not None:
+                    new_rows = new_rows[np.logical_not(np.in1d(new_rows, state['singles'].index.values))]
+                state['counts'] = counts
+                if len(new_rows) > 0:
+                    sub_setups.append(_subset_setup(setups[i], new_rows))
+                    rows.append((i, new_rows))
+            if block and engine in ['batched', 'varpro'] and len(sub_setups) > 0:
+                fits = self.fit_bootstrapped_curves_block(sub_setups, engine=engine)
+            else:
+                fits = [self.fit_bootstrapped_curves(sub_setup, engine=engine) for sub_setup in sub_setups]
+            for (i, new_rows), fit in zip(rows, fits):
+                fit.index = new_rows
+                states[i]['singles'] = pd.concat([states[i]['singles'], fit]) if states[i]['singles'] is not None else fit
+
+            # check whether bounds converged. params without any successful fits have NaN
+            # bounds (findProcessedSingles leaves them out), and are not converged
+            for i in active:
+                state = states[i]
+                used = np.where(state['counts'] > 0)[0]
+                labels = [name + suffix for name in state['param_names'] for suffix in ['', '_lb', '_ub']]
+                bounds = fitting.findProcessedSingles(state['singles'].loc[used], state['param_names'],
+                                                      counts=state['counts'][used]).reindex(labels)
+                widths = pd.Series([bounds[name + '_ub'] - bounds[name + '_lb']
+                                    for name in state['param_names'] for suffix in ['', '_lb', '_ub']], index=labels)
+                converged = (state['bounds'] is not None and
+                             (np.abs(bounds - state['bounds']) <= tolerance*np.maximum(widths, 1E-12)).all())
+                state['done'] = converged or state['num_samples'] >= len(state['sample_slots'])
+                state['bounds'] = bounds
+
+        results = []
+        for state in states:
+            used = np.where(state['counts'] > 0)[0]
+            results.append((state['singles'].loc[used].reset_index(drop=True), state['counts'][used]))
+        return results
+
+    def process_set_binding_curves(self, setup, singles, bs_dGs_path=False, counts=None):
+        """Summarize the fits of the bootstrapped median curves of a variant.
+
+        counts is the number of samples of each row of singles (default setup['counts']).
+        If bs_dGs_path is given, the singles are saved to a store with that prefix (see singlesstore)."""
+        x = self.fitParams.x
+        idx, y, fit_parameters, initial_points = setup['idx'], setup['y'], setup['fit_parameters'], setup['initial_points']
+        if counts is None:
+            counts = setup['counts']
+        param_names = self.fitParams.param_names
 
         ## John edits
         if bs_dGs_path:
-            singles.to_csv(bs_dGs_path+str(idx)+"_singles.csv", sep="\t", index=False)
+            # appended to this process's file of singles, see singlesstore.mergeSingles
+            singlesstore.appendSingles(bs_dGs_path, idx, singles, counts=counts)
 
         # uncomment for debugging
         # else:
@@ -243,74 +484,130 @@ class MoreFitParams():
 
         # find upper and lower bounds from results
         sub_param_names = [key  for key in param_names if fit_parameters[key]['vary']] # because you want to include ub and lb of fmax
-        results = fitting.findProcessedSingles(singles, sub_param_names)
+        results = fitting.findProcessedSingles(singles, sub_param_names, counts=counts)
         for key in [param_name for param_name in param_names if param_name not in sub_param_names]:
-            results.loc[key] = singles.loc[:, key].median()
+            results.loc[key] = fitting.weightedQuantile(singles.loc[:, key], counts, [0.5])[0]
         for key in param_names:
             results.loc['%s_init'%key] = initial_points.loc[key]
         
 
-        ####### debug
-        # find rsq of median
-        try:
-            ypred = pd.Series(self.fitParams.func(_get_params_from_results(results, param_names), x), index=y.index)
-        except:
-            print idx
-            print results
-            print param_names
-            print initial_points
-
-        ####### debug
-
-
-        ypred_init = pd.Series(self.fitParams.func(_get_params_from_results(initial_points, param_names), x), index=y.index)
-
+        # find rsq of median, and of the initial points. params that were not fit are NaN
+        ypred, ypred_init = [pd.Series(vals, index=y.index)
+                             for vals in self.fitParams.predict([results, initial_points], x)]
 
         results.loc['rsq']      = get_r2_score(y, ypred)
         results.loc['rsq_init'] = get_r2_score(y, ypred_init)
         results.loc['rmse']     = get_rmse(y, ypred)
         results.loc['rmse_init'] = get_rmse(y, ypred_init)
-        results.loc['num_iter'] = (singles.exit_flag > 0).sum()
-        results.loc['num_tests'] = len(ys)
-        results.loc['fmax_enforced'] = enforce_fmax
+        results.loc['num_iter'] = counts[(singles.exit_flag > 0).values].sum()
+        results.loc['num_tests'] = len(setup['ys'])
+        results.loc['num_samples'] = counts.sum()
+        results.loc['fmax_enforced'] = setup['enforce_fmax']
         order = [s for s in results.index.tolist() if s.find('_init')>-1] + [s for s in results.index.tolist() if s.find('_init')==-1]
-        results = results.loc[order]
+        return results.loc[order]
+
+    def fit_set_binding_curves(self, idx, enforce_fmax=None, weighted_fit=True, n_samples=100, return_results=False, use_initial=False, bs_dGs_path=False, engine='lmfit',
+                               tolerance=None, min_samples=20, seed=None):
+        """Fit a set of y values to a curve.
+        05132022 edit (John Shin) - add option to save bs dGs (bs_dGs_path)
+
+        engine is 'lmfit', 'batched' or 'varpro' (see fit_bootstrapped_curves).
+        If tolerance is given, bootstrap adaptively with at least min_samples and at
+        most n_samples samples (see fit_bootstrapped_curves_adaptive). If seed is given,
+        random draws are reproducible for each variant (see setup_set_binding_curves).
+        """
+        setup = self.setup_set_binding_curves(idx, enforce_fmax=enforce_fmax, weighted_fit=weighted_fit,
+                                              n_samples=n_samples, use_initial=use_initial, seed=seed)
+        # if ys is empty, don't fit
+        if setup['medians'] is None:
+            if return_results:
+                return None, [], setup['ys'], setup['indices']
+            else:
+                return
+
+        if tolerance is None:
+            singles, counts = self.fit_bootstrapped_curves(setup, engine=engine), setup['counts']
+        else:
+            singles, counts = self.fit_bootstrapped_curves_adaptive([setup], engine=engine, tolerance=tolerance,
+                                                                    min_samples=min_samples)[0]
+        results = self.process_set_binding_curves(setup, singles, bs_dGs_path=bs_dGs_path, counts=counts)
         
         if return_results:
-            return results, singles, ys, indices
+            return results, singles, setup['ys'], setup['indices']
         
         self.results = results
-        self.ys = ys
+        self.ys = setup['ys']
     
-    def fit_binding_curves_all(self, variants=None, enforce_fmax=None, weighted_fit=True, n_samples=100, print_bool=True, return_results=False,bs_dGs_path=None):
+    def fit_binding_curves_all(self, variants=None, enforce_fmax=None, weighted_fit=True, n_samples=100, print_bool=True, return_results=False,bs_dGs_path=None, engine='lmfit', block_size=None,
+                               tolerance=None, min_samples=20, seed=None):
         """Fit a set of variants to curves with bootstrapping method.
 
-        05132022 edit (John Shin) - add option to save bs dGs (bs_dGs_path)"""
+        05132022 edit (John Shin) - add option to save bs dGs (bs_dGs_path)
+
+        With engine 'batched' or 'varpro' and a block_size, the bootstrapped median
+        curves of block_size variants at a time are fit together (see
+        fit_bootstrapped_curves_block); with engine 'lmfit' they are still fit one
+        variant at a time. If tolerance is given, bootstrap adaptively
+        (see fit_bootstrapped_curves_adaptive). If seed is given, each variant has its
+        own reproducible random draws (see setup_set_binding_curves)."""
         if variants is None:
             variants = self.variants
+        if block_size is None:
+            block_size = 1
+        # only the vectorized engines can fit the curves of many variants at once
+        fit_block = block_size > 1 and engine in ['batched', 'varpro']
         results = {}
-        for i, idx in enumerate(variants):
-
-            # track progress
-            if print_bool:
-                num_steps = max(min(100, (int(len(variants)/100.))), 1)
-                if (i+1)%num_steps == 0:
-                    print ('working on %d out of %d iterations (%d%%)'
-                           %(i+1, len(variants), 100*(i+1)/
-                             float(len(variants))))
-                    sys.stdout.flush() 
+        for block_start in range(0, len(variants), block_size):
+            setups = []
             
+            # find the weights and draw the fmaxes of a block of variants at once. fmaxes
+            # are only drawn for variants whose fmax is enforced. with a seed, those of
+            # each variant are found from its own random state instead
+            block_variants = variants[block_start:block_start+block_size]
+            block_weights = [None]*len(block_variants)
+            block_fmaxes = [None]*len(block_variants)
+            block_enforce = [enforce_fmax]*len(block_variants)
+            if block_size > 1 and seed is None:
+                block_ys = [self.get_ys(idx) for idx in block_variants]
+                if weighted_fit:
+                    block_weights = fitting.getWeightsFromBindingSeriesList(block_ys)
+                if enforce_fmax is None:
+                    # same as setup_set_binding_curves. variants without clusters are not fit
+                    block_enforce = [len(ys) > 0 and fitting.enforceFmaxDistribution(ys.median(), self.fmax_dist_obj.getDist(len(ys)))
+                                     for ys in block_ys]
+                enforced = [i for i, enforce in enumerate(block_enforce) if enforce]
+                if len(enforced) > 0:
+                    fmaxes = self.fmax_dist_obj.getSampler().rvs([max(len(block_ys[i]), 1) for i in enforced], n_samples)
+                    for i, variant_fmaxes in zip(enforced, fmaxes):
+                        block_fmaxes[i] = variant_fmaxes
+            for i, idx in enumerate(variants[block_start:block_start+block_size], block_start):
+
+                # track progress
+                if print_bool:
+                    num_steps = max(min(100, (int(len(variants)/100.))), 1)
+                    if (i+1)%num_steps == 0:
+                        print ('working on %d out of %d iterations (%d%%)'
+                               %(i+1, len(variants), 100*(i+1)/
+                                 float(len(variants))))
+                        sys.stdout.flush() 
+                
+                # find bootstrapped curves. don't fit variants without clusters
+                setup = self.setup_set_binding_curves(idx, enforce_fmax=block_enforce[i-block_start], weighted_fit=weighted_fit,
+                                                      n_samples=n_samples, weights=block_weights[i-block_start], seed=seed,
+                                                      fmaxes=block_fmaxes[i-block_start])
+                if setup['medians'] is not None:
+                    setups.append(setup)
+
             # fit individual curves
-            vec = self.fit_set_binding_curves(idx,
-                                                       enforce_fmax=enforce_fmax,
-                                                       weighted_fit=weighted_fit,
-                                                       n_samples=n_samples,
-                                                       return_results=True,
-                                                       bs_dGs_path = bs_dGs_path
-                                                       )[0]
-            if vec is not None:
-                # don't include None
-                results[idx] = vec
+            if tolerance is not None:
+                singles = self.fit_bootstrapped_curves_adaptive(setups, engine=engine, tolerance=tolerance,
+                                                                min_samples=min_samples, block=fit_block)
+            elif fit_block and len(setups) > 0:
+                singles = zip(self.fit_bootstrapped_curves_block(setups, engine=engine), [setup['counts'] for setup in setups])
+            else:
+                singles = [(self.fit_bootstrapped_curves(setup, engine=engine), setup['counts']) for setup in setups]
+            for setup, (single, counts) in zip(setups, singles):
+                results[setup['idx']] = self.process_set_binding_curves(setup, single, bs_dGs_path=bs_dGs_path, counts=counts)
 
         if len(results) > 0:
             results = pd.concat(results).unstack()
@@ -404,6 +701,15 @@ class MoreFitParams():
      
         
 
+def _subset_setup(setup, rows):
+    """Return the setup of a variant (see MoreFitParams.setup_set_binding_curves) with only some of its bootstrapped curves."""
+    sub_setup = dict(setup)
+    sub_setup['medians'] = setup['medians'].iloc[rows].reset_index(drop=True)
+    sub_setup['counts'] = setup['counts'][rows]
+    if setup['fmaxes'] is not None:
+        sub_setup['fmaxes'] = setup['fmaxes'][rows]
+    return sub_setup
+
 def _convert_to_expected_fit_parameters(fit_parameters):
     """Assuming fit parameters are in dict format, convert to old format (dataframe)."""
     return pd.concat({key:pd.Series(val) for key, val in fit_parameters.items()}).unstack(level=0)
@@ -0,0 +1,290 @@
+"""Fit on or off rates of single clusters, grouped by tile.
+
+Each tile is imaged at its own times, so the clusters of a tile share a design:
+the times and the fraction of fluorescence left after photobleaching at each
+image. The design is found once per tile, and all clusters of a tile are fit
+with it, in blocks with the batched forms of objfunctions.rates_off/rates_on
+(see batchfitting) or one at a time with lmfit.
+
+Fits can be updated as new time points arrive (fitRatesIncremental). The state
+of each cluster (the number, sum and sum of squares of its values, its last
+params, the number of values they were fit on, and whether they converged) is
+saved next to the results. In the next run, clusters with new values are refit
+starting from their last params, except those whose rate changed by less than a
+tolerance between their last two fits, until their number of values grows by
+more than a fraction since their last fit.
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from fittinglibs import fitting, objfunctions, batchfitting, initfits, checkpoint
+
+# functions to fit for each fittype
+rate_funcs = {'off':'rates_off', 'on':'rates_on'}
+
+
+def getTileDesigns(timeDict, imageNDict=None, bleach_fraction=1):
+    """Return a dict of {tile:{'times', 'bleach_factors'}}.
+
+    bleach_factors are np.power(bleach_fraction, image_ns), with the image_ns of
+    each tile in imageNDict (default is the sequential order of the images)."""
+    designs = {}
+    for tile, times in timeDict.items():
+        image_ns = None if imageNDict is None else np.asarray(imageNDict[tile])
+        designs[tile] = {'times':np.asarray(times, dtype=float),
+                         'bleach_factors':objfunctions._bleach_factors(len(times), bleach_fraction, image_ns)}
+    return designs
+
+def getTileFitParams(func_name, fitParameters, design, change_params=True):
+    """Return the initfits.FitParams to fit the clusters of a tile.
+
+    fitParameters is the dataframe format of the fit parameters. If change_params,
+    the initial fmax of each cluster is its maximum value."""
+    before_fit_ops = [('fmax', 'initial', np.nanmax)] if change_params else []
+    fitParams = initfits.FitParams(func_name, fit_kws={'bleach_factors':design['bleach_factors']},
+                                   before_fit_ops=before_fit_ops)
+    fitParams.x = design['times']
+    fitParams.fit_spec = fitting.FitSpec.from_dataframe(fitParameters)
+    fitParams.fit_parameters = fitParams.fit_spec.to_dataframe().to_dict()
+    return fitParams
+
+def getTileSeries(ys, times):
+    """Return the columns of ys for a tile imaged at times.
+
+    ys may have more columns than times (i.e. if other tiles were imaged more
+    times), as long as the extra columns are all NaN."""
+    if ys.shape[1] == len(times):
+        return ys
+    if ys.shape[1] < len(times) or ys.iloc[:, len(times):].notnull().any().any():
+        raise ValueError('%d values per cluster, but %d times for the tile'%(ys.shape[1], len(times)))
+    return ys.iloc[:, :len(times)]
+
+def fitTileClusters(fitParams, ys, engine='batched', batch_size=2000, print_bool=True, init=None):
+    """Fit the clusters (rows) of ys, all from one tile.
+
+    engine is 'batched' for the vectorized solver (batchfitting) or 'lmfit' to
+    fit each cluster with lmfit. If init (a DataFrame of params per cluster, i.e.
+    previous results) is given, clusters with finite params in init are fit
+    starting from those. Returns the results as from fitting.fitSetClusters."""
+    ys = getTileSeries(ys, fitParams.x)
+    if engine not in ['batched', 'lmfit']:
+        raise ValueError('engine %s not recognized. Options are "batched" or "lmfit".'%engine)
+    if init is not None:
+        init = init.loc[:, [param_name for param_name in fitParams.param_names if param_name in init]]
+    if engine == 'batched':
+        results = batchfitting.fitSetClusters(fitParams, ys, batch_size=batch_size, print_bool=print_bool, init=init)
+    else:
+        results = fitting.fitSetClusters(fitParams, ys, print_bool=print_bool, init=init)
+    return results.loc[:, fitting.getResultColumns(sorted(fitParams.param_names))]
+
+def findRsqRmse(fitParams, ys, results):
+    """Return the rsq and rmse of the clusters of ys (of one tile) given their params in results.
+
+    Same as found by the fits, for params that were kept from a previous fit."""
+    y = getTileSeries(ys, fitParams.x).values.astype(float)
+    with np.errstate(all='ignore'):
+        residuals = np.where(np.isfinite(y), fitParams.predict(results.loc[ys.index]) - y, 0)
+        ss_total = np.nansum((y - np.nanmean(y, axis=1)[:, np.newaxis])**2, axis=1)
+        ss_error = (residuals**2).sum(axis=1)
+        return 1 - ss_error/ss_total, np.sqrt(ss_error)
+
+def splitByTile(bindingSeries, tileSeries, num_chunks, index=None, thresh=5):
+    """Return a list of (tile, ys) chunks of clusters with at least thresh values.
+
+    Every chunk is from a single tile, and tiles are split so that no chunk has
+    more than about 1/num_chunks of all the clusters."""
+    if index is None:
+        index = bindingSeries.index
+    ys = bindingSeries.loc[index].dropna(axis=0, thresh=thresh)
+    tiles = tileSeries.loc[ys.index]
+    max_size = max(int(np.ceil(len(ys)/float(num_chunks))), 1)
+    chunks = []
+    for tile, tile_index in ys.groupby(tiles).groups.items():
+        tile_ys = ys.loc[tile_index]
+        for indices in np.array_split(np.arange(len(tile_ys)), int(np.ceil(len(tile_ys)/float(max_size)))):
+            chunks.append((tile, tile_ys.iloc[indices]))
+    return chunks
+
+def _fitChunk(func_name, fitParameters, design, ys, change_params=True, engine='batched', batch_size=2000,
+              print_bool=False, init=None):
+    """Fit a chunk of clusters of one tile (the task of each worker of fitRatesPerTile)."""
+    fitParams = getTileFitParams(func_name, fitParameters, design, change_params=change_params)
+    return fitTileClusters(fitParams, ys, engine=engine, batch_size=batch_size, print_bool=print_bool, init=init)
+
+def fitRatesPerTile(bindingSeries, tileSeries, timeDict, fitParameters, func_name, numCores=1, index=None,
+                    imageNDict=None, bleach_fraction=1, change_params=True, engine='batched', batch_size=2000,
+                    init=None):
+    """Fit the clusters of every tile to a rate function ('rates_off' or 'rates_on').
+
+    Clusters are fit in chunks of one tile on numCores workers. If init is given,
+    clusters are fit starting from their params in it (see fitTileClusters).
+    Returns the results of all clusters with at least 5 values, in the order of index."""
+    designs = getTileDesigns(timeDict, imageNDict=imageNDict, bleach_fraction=bleach_fraction)
+    chunks = splitByTile(bindingSeries, tileSeries, numCores, index=index)
+    missing = set([tile for tile, ys in chunks]).difference(designs.keys())
+    if missing:
+        raise ValueError('no times for tiles: %s'%', '.join([str(tile) for tile in sorted(missing)]))
+
+    print 'Fitting %d clusters on %d tiles in %d chunks:'%(sum([len(ys) for tile, ys in chunks]),
+                                                          len(set([tile for tile, ys in chunks])), len(chunks))
+    sys.stdout.flush()
+    printBools = [True] + [False]*(len(chunks)-1)
+    fits = (Parallel(n_jobs=numCores, verbose=10, batch_size=1)
+            (delayed(_fitChunk)(func_name, fitParameters, designs[tile], ys, change_params=change_params,
+                                engine=engine, batch_size=batch_size, print_bool=print_bool,
+                                init=(None if init is None else init.reindex(ys.index)))
+             for (tile, ys), print_bool in zip(chunks, printBools)))
+    if len(fits) == 0:
+        param_names = getattr(objfunctions, func_name)(None, None, return_param_names=True)
+        return pd.DataFrame(columns=fitting.getResultColumns(sorted(param_names)))
+    results = pd.concat(fits)
+    index = pd.Index(bindingSeries.index if index is None else index)
+    return results.loc[index[index.isin(results.index)]]
+
+def getStateFilename(fitted_filename):
+    """Return the file of the cluster states saved with a .CPfitted.pkl file."""
+    if fitted_filename.endswith('.CPfitted.pkl'):
+        fitted_filename = fitted_filename[:-len('.CPfitted.pkl')]
+    return fitted_filename + '.CPfitted.state.pkl'
+
+def getRunFingerprint(func_name, bleach_fraction=1, change_params=True):
+    """Return the fingerprint of the fit options, which must be the same to update the fits of a previous run.
+
+    The fit parameters are left out, since their bounds follow the time span imaged so far."""
+    return checkpoint.fingerprint(func_name, float(bleach_fraction), bool(change_params))
+
+def getDataStatistics(ys):
+    """Return the number, sum, and sum of squares of the values of each cluster."""
+    values = ys.values.astype(float)
+    return pd.DataFrame({'num_values':np.isfinite(values).sum(axis=1),
+                         'sum':np.nansum(values, axis=1),
+                         'sum_sq':np.nansum(values**2, axis=1)}, index=ys.index)
+
+def getClusterStates(ys, tileSeries, results, func_name, previous_state=None, tolerance=0.01):
+    """Return the state of each fit cluster, to be updated by the next run.
+
+    A cluster has converged if its rate and fmax both changed by less than
+    tolerance (relative) since its fit in previous_state, and both fits succeeded.
+    fit_num_values is the number of values its params were fit on."""
+    param_names = getattr(objfunctions, func_name)(None, None, return_param_names=True)
+    compare_names = [param_name for param_name in param_names if param_name != 'fmin']
+    state = getDataStatistics(ys.loc[results.index])
+    state.loc[:, 'fit_num_values'] = state.num_values
+    state.loc[:, 'tile'] = tileSeries.loc[results.index]
+    for param_name in param_names:
+        state.loc[:, param_name] = results.loc[:, param_name]
+    if previous_state is None:
+        previous = pd.DataFrame(index=results.index, columns=compare_names)
+    else:
+        previous = previous_state.reindex(results.index)
+    with np.errstate(all='ignore'):
+        before = previous.loc[:, compare_names].values.astype(float)
+        change = np.max(np.abs(results.loc[:, compare_names].values - before)/np.abs(before), axis=1)
+    state.loc[:, 'change'] = change
+    state.loc[:, 'converged'] = (change < tolerance) & (results.exit_flag > 0).values
+    return state
+
+def saveClusterStates(state, fingerprint, filename):
+    """Save the cluster states and the run fingerprint."""
+    pd.to_pickle({'fingerprint':fingerprint, 'clusters':state}, filename)
+
+def loadClusterStates(filename, fingerprint):
+    """Return the saved cluster states, or None if there are none or they are from a run with different options."""
+    if not os.path.exists(filename):
+        print 'Could not find previous cluster states %s'%filename
+        return None
+    saved = pd.read_pickle(filename)
+    if saved['fingerprint'] != fingerprint:
+        print 'Previous cluster states %s are from a run with different fit options'%filename
+        return None
+    return saved['clusters']
+
+def findClusterUpdates(ys, previous_state, previous_results, refit_fraction=0.5):
+    """Return how each cluster of ys is updated from a previous run.
+
+    'keep' if its values did not change, 'converged' if it has new values but its
+    fit already converged and it has at most refit_fraction more values than it was
+    last fit on, 'warm' if it has new values and is refit from its last params,
+    and 'cold' if it is new, its previous values changed, or it was not fit
+    successfully before."""
+    stats = getDataStatistics(ys)
+    previous = previous_state.reindex(ys.index)
+    has_previous = (previous.num_values.notnull() & pd.Series(ys.index.isin(previous_results.index), index=ys.index))
+    same = (has_previous & (stats.num_values == previous.num_values) &
+            np.isclose(stats.loc[:, 'sum'], previous.loc[:, 'sum'].astype(float)) &
+            np.isclose(stats.sum_sq, previous.sum_sq.astype(float)))
+    added = has_previous & (stats.num_values > previous.num_values)
+    fit_before = previous_results.reindex(ys.index).exit_flag > 0
+
+    updates = pd.Series('cold', index=ys.index)
+    updates.loc[added & fit_before] = 'warm'
+    grown = stats.num_values > previous.fit_num_values.astype(float)*(1 + refit_fraction)
+    updates.loc[added & fit_before & (previous.converged == True) & ~grown] = 'converged'
+    updates.loc[same] = 'keep'
+    return updates
+
+def fitRatesIncremental(bindingSeries, tileSeries, timeDict, fitParameters, func_name, previous_filename=None,
+                        tolerance=0.01, refit_fraction=0.5, numCores=1, index=None, imageNDict=None,
+                        bleach_fraction=1, change_params=True, engine='batched', batch_size=2000):
+    """Update the fits of a previous run (in previous_filename) given new time points.
+
+    Clusters whose values did not change keep their previous results. Clusters
+    with new values whose fit had converged keep their previous params (with
+    rsq and rmse found on the new values), until they have more than
+    refit_fraction more values than they were last fit on. Other clusters are
+    refit, starting from their previous params if they have any. If there is no
+    previous run with the same fit options, all clusters are fit.
+
+    Returns the results (as from fitRatesPerTile) and the new cluster states."""
+    if index is None:
+        index = bindingSeries.index
+    fingerprint = getRunFingerprint(func_name, bleach_fraction=bleach_fraction, change_params=change_params)
+    previous_state = None
+    if previous_filename is not None:
+        previous_state = loadClusterStates(getStateFilename(previous_filename), fingerprint)
+    if previous_state is not None and not os.path.exists(previous_filename):
+        print 'Could not find previous results %s'%previous_filename
+        previous_state = None
+    fit_kws = dict(numCores=numCores, imageNDict=imageNDict, bleach_fraction=bleach_fraction,
+                   change_params=change_params, engine=engine, batch_size=batch_size)
+    if previous_state is None:
+        print 'Fitting all clusters'
+        results = fitRatesPerTile(bindingSeries, tileSeries, timeDict, fitParameters, func_name, index=index, **fit_kws)
+        return results, getClusterStates(bindingSeries, tileSeries, results, func_name, tolerance=tolerance)
+
+    previous_results = pd.read_pickle(previous_filename)
+    ys = bindingSeries.loc[index].dropna(axis=0, thresh=5)
+    updates = findClusterUpdates(ys, previous_state, previous_results, refit_fraction=refit_fraction)
+    print 'Of %d clusters, %s'%(len(updates), ', '.join(['%d %s'%(updates.value_counts().get(update, 0), name)
+        for update, name in [('keep', 'are unchanged'), ('converged', 'have new values but converged'),
+                             ('warm', 'are refit from their previous fit'), ('cold', 'are fit from scratch')]]))
+
+    # refit the clusters that are not converged
+    to_fit = updates.index[updates.isin(['warm', 'cold'])]
+    results = previous_results.reindex(updates.index).loc[:, fitting.getResultColumns(
+        sorted(getattr(objfunctions, func_name)(None, None, return_param_names=True)))]
+    if len(to_fit) > 0:
+        init = previous_results.reindex(to_fit)
+        init.loc[(updates.loc[to_fit] == 'cold').values] = np.nan
+        fits = fitRatesPerTile(bindingSeries, tileSeries, timeDict, fitParameters, func_name, index=to_fit,
+                               init=init, **fit_kws)
+        results.loc[fits.index, fits.columns] = fits.values
+
+    # update the rsq and rmse of converged clusters on their new values
+    converged = updates.index[updates == 'converged']
+    designs = getTileDesigns(timeDict, imageNDict=imageNDict, bleach_fraction=bleach_fraction)
+    for tile, tile_index in ys.loc[converged].groupby(tileSeries.loc[converged]).groups.items():
+        fitParams = getTileFitParams(func_name, fitParameters, designs[tile], change_params=change_params)
+        rsq, rmse = findRsqRmse(fitParams, ys.loc[tile_index], results)
+        results.loc[tile_index, 'rsq'] = rsq
+        results.loc[tile_index, 'rmse'] = rmse
+
+    state = getClusterStates(ys, tileSeries, results, func_name, previous_state=previous_state, tolerance=tolerance)
+    # clusters that were not refit keep the number of values and the change of their last fit
+    not_fit = updates.index[updates.isin(['keep', 'converged'])]
+    state.loc[not_fit, 'fit_num_values'] = previous_state.loc[not_fit, 'fit_num_values'].values
+    state.loc[not_fit, 'change'] = previous_state.loc[not_fit, 'change'].values
+    state.loc[not_fit, 'converged'] = previous_state.loc[not_fit, 'converged'].values
+    return results, state
@@ -4,18 +4,35 @@ from fittinglibs import fitting
 from fittinglibs.variables import fittingParameters
 from math import factorial
 
-def rates_off(params, times, data=None, weights=None, index=None, bleach_fraction=1, image_ns=None, return_param_names=False):
+# constants of the binding curves, found once rather than on every evaluation
+RT = fittingParameters().RT
+concentration_units = fittingParameters().concentration_units
+
+def _bleach_factors(num_images, bleach_fraction=1, image_ns=None, bleach_factors=None):
+    """Return the fraction of fluorescence left after photobleaching at each image.
+
+    This is np.power(bleach_fraction, image_ns), with images in sequential order
+    if image_ns is None, unless bleach_factors were already found (e.g. once per tile)."""
+    if bleach_factors is not None:
+        return bleach_factors
+    if image_ns is None:
+        # assume every image is the sequential image order
+        image_ns = np.arange(num_images)
+    return np.power(bleach_fraction, image_ns)
+
+def rates_off(params, times, data=None, weights=None, index=None, bleach_fraction=1, image_ns=None, return_param_names=False, return_jacobian=False,
+              bleach_factors=None):
     """ Return fit value, residuals, or weighted residuals of off rate objective function. """
     if return_param_names:
         return ['fmax', 'koff', 'fmin']
+    if return_jacobian:
+        return rates_off_jacobian
     
     # process inputs
     if index is None:
         # use all values
         index = np.ones(len(times)).astype(bool)
-    if image_ns is None:
-        # assume every image is the sequential image order
-        image_ns = np.arange(len(times))
+    bleach_factors = _bleach_factors(len(times), bleach_fraction, image_ns, bleach_factors)
         
     parvals = params.valuesdict()
     fmax = parvals['fmax']
@@ -23,7 +40,7 @@ def rates_off(params, times, data=None, weights=None, index=None, bleach_fractio
     fmin = parvals['fmin']
     fracbound = (fmin +
                  (fmax - fmin)*np.exp(-koff*times)*
-                 np.power(bleach_fraction,image_ns))
+                 bleach_factors)
 
     # return fit value of data is not given
     if data is None:
@@ -36,22 +53,39 @@ def rates_off(params, times, data=None, weights=None, index=None, bleach_fractio
     # return weighted residuals if data is given
     else:
         return ((fracbound - data)*weights)[index]  
+
+def rates_off_jacobian(params, times, data=None, weights=None, index=None, bleach_fraction=1, image_ns=None, bleach_factors=None):
+    """ Return jacobian of (weighted) residuals of off rate objective function. """
+    bleach_factors = _bleach_factors(len(times), bleach_fraction, image_ns, bleach_factors)
+        
+    parvals = params.valuesdict()
+    fmax = parvals['fmax']
+    koff = parvals['koff']
+    fmin = parvals['fmin']
+    decay = np.exp(-koff*times)*bleach_factors
     
+    derivs = {'fmax':decay,
+              'koff':-(fmax - fmin)*times*decay,
+              'fmin':1 - decay}
+    return _jacobian_from_derivs(params, derivs, len(times), weights=weights, index=index)
     
-def rates_on(params, times, data=None, weights=None, index=None,  bleach_fraction=1, image_ns=None, return_param_names=False):
+    
+def rates_on(params, times, data=None, weights=None, index=None,  bleach_fraction=1, image_ns=None, return_param_names=False, return_jacobian=False,
+             bleach_factors=None):
     """ Return fit value, residuals, or weighted residuals of on rate objective function. """
     if return_param_names:
         return ['fmax', 'kobs', 'fmin']    
+    if return_jacobian:
+        return rates_on_jacobian
     if index is None:
         index = np.ones(len(times)).astype(bool)
-    if image_ns is None:
-        image_ns = np.arange(len(times))
+    bleach_factors = _bleach_factors(len(times), bleach_fraction, image_ns, bleach_factors)
         
     parvals = params.valuesdict()
     fmax = parvals['fmax']
     kobs = parvals['kobs']
     fmin = parvals['fmin']
-    fracbound = fmin + (fmax*(1 - np.exp(-kobs*times)*np.power(bleach_fraction,image_ns)));
+    fracbound = fmin + (fmax*(1 - np.exp(-kobs*times)*bleach_factors));
 
     # return fit value of data is not given
     if data is None:
@@ -64,27 +98,41 @@ def rates_on(params, times, data=None, weights=None, index=None,  bleach_fractio
     # return weighted residuals if data is given
     else:
         return ((fracbound - data)*weights)[index]  
+
+def rates_on_jacobian(params, times, data=None, weights=None, index=None,  bleach_fraction=1, image_ns=None, bleach_factors=None):
+    """ Return jacobian of (weighted) residuals of on rate objective function. """
+    bleach_factors = _bleach_factors(len(times), bleach_fraction, image_ns, bleach_factors)
         
-def binding_curve(params, concentrations, data=None, weights=None, index=None, return_param_names=False):
+    parvals = params.valuesdict()
+    fmax = parvals['fmax']
+    kobs = parvals['kobs']
+    decay = np.exp(-kobs*times)*bleach_factors
+
+    derivs = {'fmax':1 - decay,
+              'kobs':fmax*times*decay,
+              'fmin':1}
+    return _jacobian_from_derivs(params, derivs, len(times), weights=weights, index=index)
+        
+def binding_curve(params, concentrations, data=None, weights=None, index=None, return_param_names=False, return_jacobian=False):
     """  Return fit value, residuals, or weighted residuals of a binding curve.
     
     Hill coefficient 1. """
     if return_param_names:
         return ['fmax', 'dG', 'fmin']
+    if return_jacobian:
+        return binding_curve_jacobian
     
     if index is None:
         index = np.ones(len(concentrations)).astype(bool)
         
-    parameters = fittingParameters()
-    
     parvals = params.valuesdict()
     fmax = parvals['fmax']
     dG   = parvals['dG']
     fmin = parvals['fmin']
 
     fracbound = (fmin + fmax*concentrations/
-                 (concentrations + np.exp(dG/parameters.RT)/
-                  parameters.concentration_units))
+                 (concentrations + np.exp(dG/RT)/
+                  concentration_units))
     
     # return fit value of data is not given
     if data is None:
@@ -97,19 +145,33 @@ def binding_curve(params, concentrations, data=None, weights=None, index=None, r
     # return weighted residuals if data is given
     else:
         return ((fracbound - data)*weights)[index]
+
+def binding_curve_jacobian(params, concentrations, data=None, weights=None, index=None):
+    """  Return jacobian of (weighted) residuals of a binding curve. """
+    parvals = params.valuesdict()
+    fmax = parvals['fmax']
+    dG   = parvals['dG']
+
+    frac = concentrations/(concentrations + np.exp(dG/RT)/
+                           concentration_units)
     
-def binding_curve_linear(params, concentrations, data=None, weights=None, index=None, return_param_names=False):
+    derivs = {'fmax':frac,
+              'dG':-fmax*frac*(1 - frac)/RT,
+              'fmin':1}
+    return _jacobian_from_derivs(params, derivs, len(concentrations), weights=weights, index=index)
+    
+def binding_curve_linear(params, concentrations, data=None, weights=None, index=None, return_param_names=False, return_jacobian=False):
     """  Return fit value, residuals, or weighted residuals of a binding curve.
     
     Hill coefficient 1. """
     if return_param_names:
         return ['fmax', 'dG', 'fmin', 'slope']
+    if return_jacobian:
+        return binding_curve_linear_jacobian
     
     if index is None:
         index = np.ones(len(concentrations)).astype(bool)
         
-    parameters = fittingParameters()
-    
     parvals = params.valuesdict()
     fmax = parvals['fmax']
     dG   = parvals['dG']
@@ -117,8 +179,8 @@ def binding_curve_linear(params, concentrations, data=None, weights=None, index=
     slope = parvals['slope']
     
     fracbound = (fmin + fmax*concentrations/
-                 (concentrations + np.exp(dG/parameters.RT)/
-                  parameters.concentration_units)) + slope*concentrations
+                 (concentrations + np.exp(dG/RT)/
+                  concentration_units)) + slope*concentrations
     
     # return fit value of data is not given
     if data is None:
@@ -131,6 +193,21 @@ def binding_curve_linear(params, concentrations, data=None, weights=None, index=
     # return weighted residuals if data is given
     else:
         return ((fracbound - data)*weights)[index]
+
+def binding_curve_linear_jacobian(params, concentrations, data=None, weights=None, index=None):
+    """  Return jacobian of (weighted) residuals of a binding curve with linear term. """
+    parvals = params.valuesdict()
+    fmax = parvals['fmax']
+    dG   = parvals['dG']
+
+    frac = concentrations/(concentrations + np.exp(dG/RT)/
+                           concentration_units)
+    
+    derivs = {'fmax':frac,
+              'dG':-fmax*frac*(1 - frac)/RT,
+              'fmin':1,
+              'slope':concentrations}
+    return _jacobian_from_derivs(params, derivs, len(concentrations), weights=weights, index=index)
     
 def powerlaw(params, x, y=None, weights=None, index=None, return_param_names=False):
     """"""
@@ -201,25 +278,25 @@ def powerexp(params, x, y=None, weights=None, index=None):
         return ((y - y_pred)*weights)[index]
     
     
-def binding_curve_nonlinear(params, concentrations, data=None, weights=None, index=None, return_param_names=False):
+def binding_curve_nonlinear(params, concentrations, data=None, weights=None, index=None, return_param_names=False, return_jacobian=False):
     """  Return fit value, residuals, or weighted residuals of a binding curve with nonlinear, nonspecific term.
     
     Hill coefficient 1. """
     if return_param_names:
         return ['fmax', 'dG', 'fmin', 'dGns']
+    if return_jacobian:
+        return binding_curve_nonlinear_jacobian
     if index is None:
         index = np.ones(len(concentrations)).astype(bool)
         
-    parameters = fittingParameters()
-    
     parvals = params.valuesdict()
     fmax = parvals['fmax']
     dG   = parvals['dG']
     fmin = parvals['fmin']
     dG_ns = parvals['dGns']
 
-    kd = np.exp(dG/parameters.RT)/parameters.concentration_units
-    kd_ns = np.exp(dG_ns/parameters.RT)/parameters.concentration_units
+    kd = np.exp(dG/RT)/concentration_units
+    kd_ns = np.exp(dG_ns/RT)/concentration_units
     fracbound = fmin + fmax*(concentrations/(kd + concentrations))*(1 + concentrations/(kd_ns + concentrations))
 
     # return fit value of data is not given
@@ -234,7 +311,179 @@ def binding_curve_nonlinear(params, concentrations, data=None, weights=None, ind
     else:
         return ((fracbound - data)*weights)[index]
 
+def binding_curve_nonlinear_jacobian(params, concentrations, data=None, weights=None, index=None):
+    """  Return jacobian of (weighted) residuals of a binding curve with nonlinear, nonspecific term. """
+    parvals = params.valuesdict()
+    fmax = parvals['fmax']
+    dG   = parvals['dG']
+    dG_ns = parvals['dGns']
+
+    kd = np.exp(dG/RT)/concentration_units
+    kd_ns = np.exp(dG_ns/RT)/concentration_units
+    frac = concentrations/(kd + concentrations)
+    frac_ns = concentrations/(kd_ns + concentrations)
+
+    derivs = {'fmax':frac*(1 + frac_ns),
+              'dG':-fmax*frac*(1 - frac)*(1 + frac_ns)/RT,
+              'fmin':1,
+              'dGns':-fmax*frac*frac_ns*(1 - frac_ns)/RT}
+    return _jacobian_from_derivs(params, derivs, len(concentrations), weights=weights, index=index)
+
+def _jacobian_from_derivs(params, derivs, num_x, weights=None, index=None):
+    """Return jacobian with a column for each varying param, in the order of params.
+
+    derivs is a dict of the derivative of the model with respect to each param.
+    Weights and index are applied as in the objective functions."""
+    if index is None:
+        index = np.ones(num_x).astype(bool)
+    jac = np.column_stack([derivs[name]*np.ones(num_x) for name, param in params.items()
+                           if param.vary and param.expr is None])
+    if weights is not None:
+        jac = jac*np.asarray(weights, dtype=float)[:, np.newaxis]
+    return jac[index]
+
    
+### batched forms ###
+# Each model also has a batched form, <name>_batch, that evaluates a matrix of
+# params (n_curves, n_params), with columns in the order of batch_funcs, and returns
+# a (n_curves, n_x) matrix of fit values, or residuals or weighted residuals if data
+# is given (same conventions as the function of one curve). x is shared by all
+# curves, or is a (n_curves, n_x) matrix. If return_jacobian, the jacobian of the
+# output (n_curves, n_x, n_params) is returned as well.
+
+def _param_columns(params):
+    """Return each column of a params matrix as a (n_curves, 1) array."""
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    return [params[:, [i]] for i in range(params.shape[1])]
+
+def _batch_output(fit, derivs, data=None, weights=None, index=None, return_jacobian=False, sign=1):
+    """Return fit values, residuals, or weighted residuals (and their jacobian) of a batched model.
+
+    derivs is a list of the derivative of the fit values with respect to each param.
+    Residuals are sign*(fit - data)."""
+    if return_jacobian:
+        jac = np.empty(fit.shape + (len(derivs),))
+        for i, deriv in enumerate(derivs):
+            jac[:, :, i] = deriv
+    if data is not None:
+        fit = sign*(fit - data)
+        if return_jacobian and sign != 1:
+            jac = sign*jac
+        if weights is not None:
+            fit = fit*weights
+            if return_jacobian:
+                jac = jac*np.asarray(weights, dtype=float)[..., np.newaxis]
+    if index is not None:
+        fit = fit[:, index]
+        if return_jacobian:
+            jac = jac[:, index]
+    if return_jacobian:
+        return fit, jac
+    return fit
+
+def rates_off_batch(params, times, data=None, weights=None, index=None, bleach_fraction=1, image_ns=None, return_jacobian=False,
+                    bleach_factors=None):
+    """ Return fit values, residuals, or weighted residuals of off rate objective function for a matrix of params. """
+    bleach_factors = _bleach_factors(np.shape(times)[-1], bleach_fraction, image_ns, bleach_factors)
+    fmax, koff, fmin = _param_columns(params)
+    decay = np.exp(-koff*times)*bleach_factors
+    fracbound = fmin + (fmax - fmin)*decay
+    return _batch_output(fracbound, [decay, -(fmax - fmin)*times*decay, 1 - decay],
+                         data=data, weights=weights, index=index, return_jacobian=return_jacobian)
+
+def rates_on_batch(params, times, data=None, weights=None, index=None, bleach_fraction=1, image_ns=None, return_jacobian=False,
+                   bleach_factors=None):
+    """ Return fit values, residuals, or weighted residuals of on rate objective function for a matrix of params. """
+    bleach_factors = _bleach_factors(np.shape(times)[-1], bleach_fraction, image_ns, bleach_factors)
+    fmax, kobs, fmin = _param_columns(params)
+    decay = np.exp(-kobs*times)*bleach_factors
+    fracbound = fmin + fmax*(1 - decay)
+    return _batch_output(fracbound, [1 - decay, fmax*times*decay, 1],
+                         data=data, weights=weights, index=index, return_jacobian=return_jacobian)
+
+def binding_curve_batch(params, concentrations, data=None, weights=None, index=None, return_jacobian=False):
+    """ Return fit values, residuals, or weighted residuals of a binding curve for a matrix of params. """
+    fmax, dG, fmin = _param_columns(params)
+    frac = concentrations/(concentrations + np.exp(dG/RT)/concentration_units)
+    fracbound = fmin + fmax*frac
+    return _batch_output(fracbound, [frac, -fmax*frac*(1 - frac)/RT, 1],
+                         data=data, weights=weights, index=index, return_jacobian=return_jacobian)
+
+def binding_curve_linear_batch(params, concentrations, data=None, weights=None, index=None, return_jacobian=False):
+    """ Return fit values, residuals, or weighted residuals of a binding curve with linear term for a matrix of params. """
+    fmax, dG, fmin, slope = _param_columns(params)
+    frac = concentrations/(concentrations + np.exp(dG/RT)/concentration_units)
+    fracbound = fmin + fmax*frac + slope*concentrations
+    return _batch_output(fracbound, [frac, -fmax*frac*(1 - frac)/RT, 1, concentrations],
+                         data=data, weights=weights, index=index, return_jacobian=return_jacobian)
+
+def binding_curve_nonlinear_batch(params, concentrations, data=None, weights=None, index=None, return_jacobian=False):
+    """ Return fit values, residuals, or weighted residuals of a binding curve with nonlinear, nonspecific term for a matrix of params. """
+    fmax, dG, fmin, dG_ns = _param_columns(params)
+    frac = concentrations/(np.exp(dG/RT)/concentration_units + concentrations)
+    frac_ns = concentrations/(np.exp(dG_ns/RT)/concentration_units + concentrations)
+    fracbound = fmin + fmax*frac*(1 + frac_ns)
+    return _batch_output(fracbound, [frac*(1 + frac_ns), -fmax*frac*(1 - frac)*(1 + frac_ns)/RT, 1,
+                                     -fmax*frac*frac_ns*(1 - frac_ns)/RT],
+                         data=data, weights=weights, index=index, return_jacobian=return_jacobian)
+
+def powerlaw_batch(params, x, y=None, weights=None, index=None, return_jacobian=False):
+    """ Return fit values, or (weighted) residuals y - fit, of a power law for a matrix of params. """
+    c, k, A = _param_columns(params)
+    power = np.power(x, k)
+    return _batch_output(A*power + c, [1, A*power*np.log(x), power],
+                         data=y, weights=weights, index=index, return_jacobian=return_jacobian, sign=-1)
+
+def exponential_batch(params, x, y=None, weights=None, index=None, return_jacobian=False):
+    """ Return fit values, or (weighted) residuals y - fit, of an exponential for a matrix of params. """
+    c, k, A = _param_columns(params)
+    growth = np.exp(k*x)
+    return _batch_output(A*growth + c, [1, A*x*growth, growth],
+                         data=y, weights=weights, index=index, return_jacobian=return_jacobian, sign=-1)
+
+def poisson_batch(params, x, y=None, weights=None, index=None, return_jacobian=False):
+    """ Return fit values, or (weighted) residuals y - fit, of a poisson distribution for a matrix of params. """
+    lambda_param, = _param_columns(params)
+    y_pred = (np.power(lambda_param, x)*np.exp(-lambda_param)/np.array([factorial(i) for i in x])).astype(float)
+    return _batch_output(y_pred, [y_pred*(x/lambda_param - 1)],
+                         data=y, weights=weights, index=index, return_jacobian=return_jacobian, sign=-1)
+
+def powerexp_batch(params, x, y=None, weights=None, index=None, return_jacobian=False):
+    """ Return fit values, or (weighted) residuals y - fit, of A*base^x + c for a matrix of params. """
+    c, k, A = _param_columns(params)
+    power = np.power(k, x)
+    return _batch_output(A*power + c, [1, A*x*np.power(k, x - 1), power],
+                         data=y, weights=weights, index=index, return_jacobian=return_jacobian, sign=-1)
+
+# batched form of each model and the order of its params, keyed by the name of the model
+batch_funcs = {'rates_off':(['fmax', 'koff', 'fmin'], rates_off_batch),
+               'rates_on':(['fmax', 'kobs', 'fmin'], rates_on_batch),
+               'binding_curve':(['fmax', 'dG', 'fmin'], binding_curve_batch),
+               'binding_curve_linear':(['fmax', 'dG', 'fmin', 'slope'], binding_curve_linear_batch),
+               'binding_curve_nonlinear':(['fmax', 'dG', 'fmin', 'dGns'], binding_curve_nonlinear_batch),
+               'powerlaw':(['c', 'exponent', 'amplitude'], powerlaw_batch),
+               'exponential':(['c', 'exponent', 'amplitude'], exponential_batch),
+               'poisson':(['lambda_param'], poisson_batch),
+               'powerexp':(['c', 'base', 'amplitude'], powerexp_batch)}
+
+def getBatchFunction(func):
+    """Return the param names and batched form of a model, given its name or its function of one curve.
+
+    Returns None if the model has no batched form."""
+    if not isinstance(func, basestring):
+        func = getattr(func, '__name__', None)
+    return batch_funcs.get(func)
+
+def getParamMatrix(results, param_names):
+    """Return a (n_curves, n_params) matrix of params, with columns in the order of param_names.
+
+    results is a DataFrame with a row for each curve and a column for each param,
+    or a list of Series (or dicts) keyed by param name. Missing params are NaN."""
+    if isinstance(results, pd.DataFrame):
+        return results.reindex(columns=param_names).values.astype(float)
+    return np.array([[row[name] if name in row else np.nan for name in param_names] for row in results],
+                    dtype=float)
+
 def processFuncInputs(func_name, x, params_to_change=None, params_init=None, params_lb=None, params_ub=None, params_vary=None):
     """Return FitParameters structure given user input."""
     
@@ -0,0 +1,237 @@
+"""Parallel fitting of single clusters through shared, memory-mapped arrays.
+
+Instead of one joblib task per cluster (each pickling the FitParams object and
+doing a label lookup), the binding series is written once to a memory-mapped
+array. Each worker is given a contiguous range of rows and writes its fit
+results into a preallocated memory-mapped result array. The number of rows per
+task is tuned from the time it takes to fit a short warmup set.
+"""
+import os
+import shutil
+import collections
+import tempfile
+import datetime
+import logging
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from fittinglibs import fitting, batchfitting, checkpoint
+
+
+def saveSharedArray(filename, values):
+    """Save a 2D array of floats to a .npy file that can be memory mapped by workers."""
+    shared = np.lib.format.open_memmap(filename, mode='w+', dtype=float, shape=values.shape)
+    shared[:] = values
+    shared.flush()
+    del shared
+    return filename
+
+def createSharedArray(filename, shape, fill_value=np.nan):
+    """Create a .npy file of floats of a given shape that workers can write into."""
+    shared = np.lib.format.open_memmap(filename, mode='w+', dtype=float, shape=shape)
+    shared[:] = fill_value
+    shared.flush()
+    del shared
+    return filename
+
+def loadSharedArray(filename, mode='r'):
+    """Memory map a shared array. mode 'r' for read only and 'r+' to write."""
+    return np.load(filename, mmap_mode=mode)
+
+def getResultColumns(fitParams, telemetry=False):
+    """Return the columns of the fit results of a FitParams object."""
+    return fitting.getResultColumns(sorted(fitParams.param_names), telemetry=telemetry)
+
+def fitRows(fitParams, ys, engine='lmfit', batch_size=2000, telemetry=False):
+    """Fit the curves in the rows of ys with the given engine and return a matrix of results."""
+    columns = getResultColumns(fitParams, telemetry=telemetry)
+    if engine == 'lmfit':
+        sink = fitting.ResultSink(ys.index, columns)
+        for i in range(len(ys)):
+            fitParams.fit_curve(ys.iloc[i], sink=sink, row=i, telemetry=telemetry)
+        return sink.values
+    elif engine in ['batched', 'varpro']:
+        method = 'varpro' if engine == 'varpro' else 'leastsq'
+        return batchfitting.fitSetClusters(fitParams, ys, batch_size=batch_size, print_bool=False,
+                                           method=method, telemetry=telemetry).loc[:, columns].values
+    else:
+        raise ValueError('engine %s not recognized. Options are "lmfit", "batched", or "varpro".'%engine)
+
+def fitRange(fitParams, series_filename, result_filename, columns, start, stop, engine='lmfit', batch_size=2000,
+             checkpoint=None, telemetry=False):
+    """Fit rows start to stop of the shared binding series and write to the shared results.
+
+    If checkpoint (a checkpoint.Checkpoint) is given, the results are also saved to it."""
+    values = loadSharedArray(series_filename)
+    ys = pd.DataFrame(np.array(values[start:stop]), columns=columns)
+    results = loadSharedArray(result_filename, mode='r+')
+    results[start:stop] = fitRows(fitParams, ys, engine=engine, batch_size=batch_size, telemetry=telemetry)
+    results.flush()
+    if checkpoint is not None:
+        checkpoint.save_range(start, stop, pd.DataFrame(np.array(results[start:stop]),
+                                                        columns=getResultColumns(fitParams, telemetry=telemetry)))
+    return stop - start
+
+def findChunkSize(time_per_fit, num_fits, numCores, target_time=30, tasks_per_core=4):
+    """Return the number of rows per task.
+
+    Tasks should take about target_time seconds so scheduling overhead is
+    negligible, but there should be at least tasks_per_core tasks per core so
+    that work is balanced at the end of the run."""
+    chunk_size = int(target_time/max(time_per_fit, 1E-9))
+    chunk_size = min(chunk_size, int(np.ceil(num_fits/float(numCores*tasks_per_core))))
+    return max(chunk_size, 1)
+
+def getRanges(start, stop, chunk_size):
+    """Return a list of (start, stop) contiguous row ranges of at most chunk_size rows."""
+    return [(i, min(i + chunk_size, stop)) for i in range(start, stop, chunk_size)]
+
+def getBalancedRanges(costs, start, stop, num_chunks):
+    """Return contiguous (start, stop) ranges of rows start to stop with about equal total cost.
+
+    costs has the estimated cost of each row. Rows are not split, so a row that costs
+    more than the share of one chunk ends up in a chunk of its own."""
+    cum_costs = np.cumsum(np.asarray(costs[start:stop], dtype=float))
+    if len(cum_costs) == 0:
+        return []
+    # end each chunk at the row where the cumulative cost passes a multiple of the share
+    shares = cum_costs[-1]/float(num_chunks)*np.arange(1, num_chunks)
+    ends = np.searchsorted(cum_costs, shares, side='left') + 1
+    bounds = np.unique(np.concatenate([[0], np.clip(ends, 0, len(cum_costs)), [len(cum_costs)]]))
+    return [(start + i, start + j) for i, j in zip(bounds[:-1], bounds[1:])]
+
+def getFingerprint(fitParams, bindingSeries, index, engine='lmfit', telemetry=False):
+    """Return the fingerprint of a run, used to check that a checkpoint is from the same run."""
+    fit_spec = fitParams.get_fit_spec()
+    before_fit_ops = ['%s %s %s'%(param_name, key, getattr(operation, '__name__', repr(operation)))
+                      for param_name, key, operation in fitParams.before_fit_ops]
+    return checkpoint.fingerprint(fitParams.func_name, fitParams.x, fit_spec.names, fit_spec.init,
+                                  fit_spec.lb, fit_spec.ub, fit_spec.vary, before_fit_ops,
+                                  fitParams.fit_kws, engine, str(telemetry), '\n'.join([str(idx) for idx in index]),
+                                  bindingSeries.loc[index].values)
+
+def getCacheKeys(fitParams, ys, cache, engine='lmfit'):
+    """Return the fit cache keys of the curves in the rows of ys."""
+    return [fitParams.get_cache_key(cache, ys.iloc[i], engine=engine) for i in range(len(ys))]
+
+def splitAndFit(fitParams, bindingSeries, numCores, index=None, engine='lmfit', batch_size=2000,
+                num_warmup=None, target_time=30, tmp_dir=None, cache=None, checkpoint_dir=None, resume=False,
+                telemetry=False):
+    """Fit all clusters in index, in parallel through shared memory-mapped arrays.
+
+    If cache (a fitcache.FitCache) is given, curves found in the cache are not refit
+    and identical curves are only fit once. New fits are added to the cache, which
+    is saved if it has a filename.
+
+    If checkpoint_dir is given, finished chunks of clusters are saved there as they
+    are fit. With resume, chunks saved by a previous run on the same inputs are
+    loaded and only the remaining clusters are fit.
+
+    If telemetry is True, the number of function evaluations, fit time, and worker
+    of each fit are added as columns (clusters not refit have nfev and fit_time 0).
+
+    Returns a DataFrame of fit results indexed by cluster, with the same columns
+    as fitting.fitSingleCurve."""
+    if index is None:
+        index = bindingSeries.index
+    kwargs = dict(engine=engine, batch_size=batch_size, num_warmup=num_warmup,
+                  target_time=target_time, tmp_dir=tmp_dir, checkpoint_dir=checkpoint_dir, resume=resume,
+                  telemetry=telemetry)
+    if cache is None:
+        return _splitAndFit(fitParams, bindingSeries, numCores, index, **kwargs)
+
+    # find each distinct curve and look it up in the cache
+    keys = getCacheKeys(fitParams, bindingSeries.loc[index], cache, engine=engine)
+    first_index = collections.OrderedDict()
+    for idx, key in zip(index, keys):
+        first_index.setdefault(key, idx)
+    cached = {key:cache.get(key) for key in first_index}
+    missing = [key for key, values in cached.items() if values is None]
+    logging.info('%d distinct curves out of %d, %d of which need to be fit'
+                 %(len(first_index), len(keys), len(missing)))
+
+    # fit the new curves and add them to the cache
+    num_columns = len(getResultColumns(fitParams))
+    fit_telemetry = {}
+    if missing:
+        results = _splitAndFit(fitParams, bindingSeries, numCores,
+                               [first_index[key] for key in missing], **kwargs)
+        for key, values in zip(missing, results.values):
+            cache.put(key, values[:num_columns])
+            cached[key] = values[:num_columns]
+            fit_telemetry[first_index[key]] = values[num_columns:]
+    logging.info(cache.report())
+    if cache.filename is not None:
+        cache.save()
+    results = pd.DataFrame(np.array([cached[key] for key in keys]).reshape(len(keys), -1),
+                           index=index, columns=getResultColumns(fitParams))
+    if telemetry:
+        results = results.reindex(columns=getResultColumns(fitParams, telemetry=True))
+        results.loc[:, ['nfev', 'fit_time']] = 0
+        for idx, values in fit_telemetry.items():
+            results.loc[idx, fitting.telemetry_columns] = values
+    return results
+
+def _splitAndFit(fitParams, bindingSeries, numCores, index, engine='lmfit', batch_size=2000,
+                 num_warmup=None, target_time=30, tmp_dir=None, checkpoint_dir=None, resume=False,
+                 telemetry=False):
+    """Fit all clusters in index through shared memory-mapped arrays (see splitAndFit)."""
+    if num_warmup is None:
+        num_warmup = 100 if engine == 'lmfit' else batch_size
+    columns = bindingSeries.columns
+    result_columns = getResultColumns(fitParams, telemetry=telemetry)
+    num_fits = len(index)
+
+    # write binding series and result array once
+    tmp_dir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        series_filename = saveSharedArray(os.path.join(tmp_dir, 'binding_series.npy'),
+                                          bindingSeries.loc[index].values.astype(float))
+        result_filename = createSharedArray(os.path.join(tmp_dir, 'results.npy'),
+                                            (num_fits, len(result_columns)))
+
+        # load the chunks already fit in a previous run
+        run_checkpoint = None
+        missing_ranges = [(0, num_fits)] if num_fits > 0 else []
+        if checkpoint_dir is not None:
+            run_checkpoint = checkpoint.Checkpoint(checkpoint_dir, getFingerprint(fitParams, bindingSeries, index, engine, telemetry))
+            run_checkpoint.start(resume=resume)
+            finished_ranges = run_checkpoint.finished_ranges()
+            if finished_ranges:
+                results = loadSharedArray(result_filename, mode='r+')
+                for start, stop in finished_ranges:
+                    results[start:stop] = run_checkpoint.load_range(start, stop).loc[:, result_columns].values
+                results.flush()
+                del results
+            missing_ranges = run_checkpoint.missing_ranges(num_fits)
+            logging.info('Resuming from checkpoint: %d of %d clusters left to fit'
+                         %(sum([stop - start for start, stop in missing_ranges]), num_fits))
+
+        if missing_ranges:
+            # fit a warmup set in this process to find the time per fit
+            start, stop = missing_ranges[0]
+            warmup_stop = min(start + num_warmup, stop)
+            t0 = datetime.datetime.now()
+            fitRange(fitParams, series_filename, result_filename, columns, start, warmup_stop,
+                     engine=engine, batch_size=batch_size, checkpoint=run_checkpoint, telemetry=telemetry)
+            time_per_fit = (datetime.datetime.now() - t0).total_seconds()/max(warmup_stop - start, 1)
+            missing_ranges = [(warmup_stop, stop)] + missing_ranges[1:]
+            num_left = sum([stop - start for start, stop in missing_ranges])
+            chunk_size = findChunkSize(time_per_fit, num_left, numCores, target_time=target_time)
+            ranges = [chunk for start, stop in missing_ranges for chunk in getRanges(start, stop, chunk_size)]
+            logging.info('%4.2f ms per fit in warmup. Fitting remaining %d clusters in %d tasks of %d clusters'
+                         %(time_per_fit*1000, num_left, len(ranges), chunk_size))
+
+            # fit the remaining rows in parallel
+            (Parallel(n_jobs=numCores, verbose=10)
+             (delayed(fitRange)(fitParams, series_filename, result_filename, columns, start, stop,
+                                engine=engine, batch_size=batch_size, checkpoint=run_checkpoint, telemetry=telemetry)
+              for start, stop in ranges))
+        if run_checkpoint is not None:
+            run_checkpoint.write_manifest(num_rows=num_fits)
+
+        results = pd.DataFrame(np.array(loadSharedArray(result_filename)), index=index,
+                               columns=result_columns)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
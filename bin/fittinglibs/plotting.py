@@ -146,6 +146,23 @@ def plotFitBounds(x, params_lb, params_ub, func, ax=None, fit_kwargs=None):
                          label='95% conf int', alpha=0.5)
     return ax
 
+def findFitCurves(x, results, param_names, suffix_vecs, func, fit_kwargs=None):
+    """Return a matrix of fit curves, one for each vector of suffixes of the param names in results.
+
+    e.g. suffix_vecs=[['', '', ''], ['_ub', '_lb', '']] gives the fit and its upper
+    bound. All curves are found at once if func has a batched form (see
+    objfunctions.getBatchFunction)."""
+    if fit_kwargs is None:
+        fit_kwargs = {}
+    batch = objfunctions.getBatchFunction(func)
+    if batch is None or sorted(batch[0]) != sorted(param_names):
+        return np.array([func(fitting.returnParamsFromResultsBounds(results, param_names, vec), x, **fit_kwargs)
+                         for vec in suffix_vecs])
+    model_param_names, batch_func = batch
+    rows = [{param:results.loc['%s%s'%(param, suffix)] for param, suffix in itertools.izip(param_names, vec)}
+            for vec in suffix_vecs]
+    return batch_func(objfunctions.getParamMatrix(rows, model_param_names), x, **fit_kwargs)
+
 def plotFitCurve(x, subSeries, results, param_names=None, ax=None, log_axis=True, capsize = 2,
                  func=objfunctions.binding_curve, fittype='binding', kwargs=None, errors=None):
     if kwargs is None:
@@ -188,9 +205,6 @@ def plotFitCurve(x, subSeries, results, param_names=None, ax=None, log_axis=True
     if param_names is None:
         param_names = param_names_tmp
     
-    # get params for fit function
-    params = fitting.returnParamsFromResults(results, param_names)
-    
     # gerenate x values for fit function
     if ax is None:
         fig = plt.figure(figsize=(3, 3))
@@ -206,17 +220,21 @@ def plotFitCurve(x, subSeries, results, param_names=None, ax=None, log_axis=True
     # plot the data
     plotDataErrorbars(x, subSeries, ax, capsize=capsize, errors=errors)
 
-    # plot fit
-    plotFit(more_x, params, func, ax=ax, fit_kwargs=kwargs)
-    
+    # find the fit, and its upper and lower bounds if they are in the results
+    suffix_vecs = [['']*len(param_names)]
     if further_process:
-        # plot upper and lower bounds
         all_param_names = [['%s%s'%(param, s) for param, s in itertools.izip(param_names, vec)]
                            for vec in [ub_vec, lb_vec]]
         if np.all(np.in1d(all_param_names, results.index.tolist())):
-            params_ub = fitting.returnParamsFromResultsBounds(results, param_names, ub_vec)
-            params_lb = fitting.returnParamsFromResultsBounds(results, param_names, lb_vec)
-            plotFitBounds(more_x, params_lb, params_ub, func, ax=ax, fit_kwargs=kwargs)
+            suffix_vecs += [ub_vec, lb_vec]
+    fits = findFitCurves(more_x, results, param_names, suffix_vecs, func, fit_kwargs=kwargs)
+
+    # plot fit
+    ax.plot(more_x, fits[0], 'r')
+    if len(fits) > 1:
+        # plot upper and lower bounds
+        ax.fill_between(more_x, fits[2], fits[1], color='0.5',
+                        label='95% conf int', alpha=0.5)
 
     # format
     ylim = ax.get_ylim()
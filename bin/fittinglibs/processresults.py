@@ -13,7 +13,7 @@ import scipy.stats as st
 import matplotlib as mpl
 import matplotlib
 matplotlib.use('Agg')
-from fittinglibs import plotting, fitting, distribution
+from fittinglibs import plotting, fitting, distribution, groupedseries
 from plotting import fix_axes
 import ipdb
 
@@ -138,15 +138,19 @@ class perVariant():
         self.tiles = tiles
         self.fmaxdist = fmaxdist
 
+    def getGroupedSeries(self):
+        """Return the binding series grouped by variant (a groupedseries.GroupedSeries), grouping it the first time."""
+        if getattr(self, 'grouped_series', None) is None:
+            self.grouped_series = groupedseries.GroupedSeries.from_dataframe(self.binding_series, self.annotated_clusters)
+        return self.grouped_series
+
     def getVariantBindingSeries(self,variant ):
         """Return binding series for clusters of a particular variant."""
-        index = self.annotated_clusters == variant
-        return self.binding_series.loc[self.annotated_clusters.index.tolist()].loc[index]
+        return self.getGroupedSeries().get_ys(variant)
     
     def getVariantTiles(self, variant):
         """Return tile numbers for clusters of a particular variant."""
-        index = self.annotated_clusters == variant 
-        return self.tiles.loc[self.annotated_clusters.index.tolist()].loc[index]
+        return self.tiles.loc[self.getGroupedSeries().get_cluster_ids(variant)]
     
     
     def plotBindingCurve(self, variant, annotate=True, func_kwargs={}, plot_init=False):
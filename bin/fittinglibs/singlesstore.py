@@ -0,0 +1,157 @@
+"""Store of the bootstrapped fits (singles) of variants.
+
+While fitting, the singles of each variant are appended to a binary file of the
+worker process (<prefix>singles.<pid>.bin, float64 rows), and a record of the
+variant, the position of its rows and the time it was written is appended to an
+index file next to it (.idx). Appending never rewrites a file, so workers don't
+need to coordinate, and an interrupted run leaves only complete records in the
+index.
+
+mergeSingles then combines the files of all workers into one memory-mappable
+groupedseries.GroupedSeries in the directory <prefix>singles, so that the
+singles of one variant can be read without loading the others (getSingles), or
+all of them at once (GroupedSeries.to_dataframe).
+
+Each row of the singles is a distinct fit, and its count column is the number of
+bootstrap samples it stands for (see fitting.getClusterMultisets).
+"""
+import os
+import time
+import glob
+import shutil
+import pickle
+import numpy as np
+import pandas as pd
+from fittinglibs import groupedseries
+
+
+def getWorkerFilename(prefix, pid=None):
+    """Return the file of singles of a worker process (this one by default)."""
+    if pid is None:
+        pid = os.getpid()
+    return '%ssingles.%d.bin'%(prefix, pid)
+
+def appendSingles(prefix, variant, singles, counts=None):
+    """Append the singles of a variant (a DataFrame) to the file of this worker.
+
+    counts is the number of bootstrap samples of each row of singles (default 1)."""
+    if counts is None:
+        counts = np.ones(len(singles))
+    filename = getWorkerFilename(prefix)
+    index_filename = filename[:-len('.bin')] + '.idx'
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    columns = singles.columns.tolist() + ['count']
+    values = np.column_stack([singles.values.astype(float), counts])
+    if not os.path.exists(index_filename):
+        with open(index_filename, 'wb') as f:
+            pickle.dump(columns, f)
+    # rows are only indexed once they are written. offsets are in bytes, so rows written
+    # after an incomplete write (e.g. if a run was killed) are still found
+    offset = os.path.getsize(filename) if os.path.exists(filename) else 0
+    with open(filename, 'ab') as f:
+        f.write(np.ascontiguousarray(values, dtype='<f8').tobytes())
+    with open(index_filename, 'ab') as f:
+        pickle.dump((variant, offset, len(values), time.time()), f)
+
+def readIndex(index_filename):
+    """Return the columns and the (variant, byte offset, number of rows, write time) records of an index file."""
+    records = []
+    with open(index_filename, 'rb') as f:
+        columns = pickle.load(f)
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                # the end of the file, or a record cut off by an interrupted run
+                break
+    return columns, records
+
+def findWorkerFilenames(prefix):
+    """Return the files of singles of all workers with a given prefix."""
+    return sorted(glob.glob(prefix + 'singles.*.bin'))
+
+def clearSingles(prefix):
+    """Remove the worker files of singles with a given prefix."""
+    for filename in findWorkerFilenames(prefix):
+        for sub_filename in [filename, filename[:-len('.bin')] + '.idx']:
+            if os.path.exists(sub_filename):
+                os.remove(sub_filename)
+
+def mergeSingles(prefix, remove=True, keep=None):
+    """Combine the worker files of singles into one GroupedSeries in the directory <prefix>singles.
+
+    If a variant was fit more than once (i.e. in a resumed run), the singles written
+    last are kept, by the write time of their records (not the order of the worker
+    files, which is by pid). The singles of the variants in keep that were not fit
+    again are kept from the GroupedSeries already in <prefix>singles, i.e. from a
+    previous run. Returns the directory."""
+    filenames = findWorkerFilenames(prefix)
+    directory = prefix + 'singles'
+    sources = {}
+    write_times = {}
+    columns = None
+    previous = None
+    if keep is not None and os.path.exists(os.path.join(directory, 'values.npy')):
+        previous = loadSingles(prefix)
+        columns = previous.columns.tolist()
+        for variant in keep:
+            if variant in previous:
+                start, stop = previous.get_rows(variant)
+                sources[variant] = (None, start, stop - start)
+    for filename in filenames:
+        index_filename = filename[:-len('.bin')] + '.idx'
+        if not os.path.exists(index_filename):
+            continue
+        columns, records = readIndex(index_filename)
+        for variant, offset, length, write_time in records:
+            # later records of the same file win ties
+            if write_time >= write_times.get(variant, -np.inf):
+                write_times[variant] = write_time
+                sources[variant] = (filename, offset, length)
+    # write to a new directory, as the previous singles may be read from the old one
+    new_directory = directory + '.tmp'
+    if os.path.exists(new_directory):
+        shutil.rmtree(new_directory)
+    os.makedirs(new_directory)
+    if columns is None:
+        columns = []
+    variants = sorted(sources.keys())
+    lengths = np.array([sources[variant][2] for variant in variants], dtype=int)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+
+    # copy the rows of each variant into one memory mapped matrix
+    values = np.lib.format.open_memmap(os.path.join(new_directory, 'values.npy'), mode='w+', dtype=float,
+                                       shape=(offsets[-1], len(columns)))
+    for variant, start, stop in zip(variants, offsets[:-1], offsets[1:]):
+        filename, offset, length = sources[variant]
+        if length == 0:
+            continue
+        if filename is None:
+            values[start:stop] = previous.values[offset:offset+length]
+        else:
+            values[start:stop] = np.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(length, len(columns)))
+    values.flush()
+    del values, previous
+    sample_ids = np.concatenate([np.arange(length) for length in lengths]) if len(lengths) > 0 else []
+    groupedseries.saveGroups(new_directory, sample_ids, variants, offsets, columns)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(new_directory, directory)
+    if remove:
+        clearSingles(prefix)
+    return directory
+
+def loadSingles(prefix):
+    """Open the merged singles (see mergeSingles), memory mapped read-only."""
+    return groupedseries.GroupedSeries.load(prefix + 'singles')
+
+def getSingles(store, variant, expand=False):
+    """Return the singles of a variant from an opened store (see loadSingles).
+
+    If expand, each row is repeated by its count, giving one row per bootstrap sample."""
+    singles = store.get_ys(variant)
+    if expand:
+        singles = singles.iloc[np.repeat(np.arange(len(singles)), singles.loc[:, 'count'].astype(int).values)]
+    return singles
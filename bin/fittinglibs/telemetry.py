@@ -0,0 +1,84 @@
+"""Reports on the performance of single cluster fits and of parallel runs.
+
+Fits run with telemetry (see fitting.telemetry_columns) have, for each fit, the
+number of function evaluations (nfev), the time of the fit in seconds
+(fit_time), and the process id of the worker that fit it (worker).
+"""
+import numpy as np
+import pandas as pd
+
+def textHistogram(values, bins, width=40, fmt='%8.3g'):
+    """Return lines of a text histogram of values."""
+    counts, edges = np.histogram(values, bins=bins)
+    lines = []
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        bar = '#'*int(np.ceil(width*count/float(max(counts.max(), 1))))
+        lines.append('%s - %s %8d %s'%(fmt%low, fmt%high, count, bar))
+    return lines
+
+def findWorkerThroughput(fitResults):
+    """Return the number of fits, total fit time, and fits per second of each worker."""
+    grouped = fitResults.groupby('worker')
+    throughput = pd.concat({'num_fits':grouped.size(), 'fit_time':grouped.fit_time.sum()}, axis=1)
+    throughput.loc[:, 'fits_per_s'] = throughput.num_fits/throughput.fit_time
+    throughput.index = throughput.index.astype(int)
+    return throughput
+
+def getReport(fitResults, num_slowest=20, num_bins=10):
+    """Return a text report of the fit times and function evaluations of a set of fits."""
+    fitted = fitResults.loc[fitResults.nfev > 0]
+    lines = ['%d clusters, %d fit (others were not fit or were found in the fit cache)'
+             %(len(fitResults), len(fitted))]
+    if len(fitted) == 0:
+        return '\n'.join(lines) + '\n'
+    lines += ['total fit time %4.1f s, median %4.2f ms per fit'
+              %(fitted.fit_time.sum(), fitted.fit_time.median()*1000),
+              '%4.2f%% of fits stopped at the maximum number of function evaluations (exit_flag 5)'
+              %(100*(fitted.exit_flag == 5).mean()),
+              '',
+              'exit flags:',
+              fitResults.exit_flag.value_counts().sort_index().to_string(),
+              '',
+              'throughput per worker:',
+              findWorkerThroughput(fitted).to_string(),
+              '',
+              'fit time (s):']
+    fit_times = fitted.fit_time.clip(lower=1E-6)
+    lines += textHistogram(fit_times, np.logspace(np.log10(fit_times.min()), np.log10(fit_times.max()), num_bins+1))
+    lines += ['', 'function evaluations:']
+    lines += textHistogram(fitted.nfev, np.linspace(0, max(fitted.nfev.max(), 1), num_bins+1), fmt='%8d')
+    lines += ['', 'slowest clusters:',
+              fitted.sort_values('fit_time', ascending=False).iloc[:num_slowest].loc[
+                  :, [col for col in ['fit_time', 'nfev', 'exit_flag', 'rsq', 'dG', 'fmax'] if col in fitted]].to_string()]
+    return '\n'.join(lines) + '\n'
+
+def saveReport(fitResults, filename, **kwargs):
+    """Write the report of a set of fits to a text file (see getReport)."""
+    with open(filename, 'w') as f:
+        f.write(getReport(fitResults, **kwargs))
+
+def getUtilizationReport(chunk_times):
+    """Return a text report of how busy each worker was during a parallel run.
+
+    chunk_times has a row for each chunk of work, with the worker that did it, its
+    start and stop times (datetimes), and its estimated cost (cost) and number of
+    rows (num_rows)."""
+    start = chunk_times.start.min()
+    wall_time = (chunk_times.stop.max() - start).total_seconds()
+    chunk_times = chunk_times.assign(busy_time=[(stop - chunk_start).total_seconds() for chunk_start, stop
+                                                in zip(chunk_times.start, chunk_times.stop)],
+                                     finished=[(stop - start).total_seconds() for stop in chunk_times.stop])
+    grouped = chunk_times.groupby('worker')
+    workers = pd.concat({'num_chunks':grouped.size(), 'num_rows':grouped.num_rows.sum(), 'cost':grouped.cost.sum(),
+                         'busy_time':grouped.busy_time.sum(), 'finished':grouped.finished.max()}, axis=1)
+    workers.loc[:, 'utilization'] = workers.busy_time/max(wall_time, 1E-9)
+    workers.index = workers.index.astype(int)
+    costs = chunk_times.loc[chunk_times.cost > 0]
+    lines = ['%d chunks on %d workers in %4.1f s, mean utilization %4.1f%%'
+             %(len(chunk_times), len(workers), wall_time, 100*workers.utilization.mean()),
+             'first worker to finish was idle for the last %4.1f s'%(wall_time - workers.finished.min())]
+    if len(costs) > 1:
+        lines.append('correlation of estimated cost and time of chunks: %4.2f'
+                     %np.corrcoef(costs.cost, costs.busy_time)[0, 1])
+    lines += ['', workers.loc[:, ['num_chunks', 'num_rows', 'cost', 'busy_time', 'finished', 'utilization']].to_string()]
+    return '\n'.join(lines) + '\n'
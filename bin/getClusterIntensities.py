@@ -43,25 +43,14 @@ if __name__ == '__main__':
         # load only the variant params if given
         variantParams = fileio.loadFile(args.variantparams)
         variants = variantParams.variants
-        F = {}
-        Variants = []
-        for i in range(NPoints):
-            F[i] = []
-        clusterIDs = []
-        for variant in variants:
-            print "Processing variant %d / %d : "%(variant, variants[-1])
-            FL = variantParams.get_ys(variant)
-            Indices = FL.index.values.tolist()
-            clusterIDs += Indices
-            for i in range(NPoints):
-                F[i] += FL[str(i)].tolist()
-            Variants += [variant] * FL.shape[0]
+        print "Processing %d variants"%len(variants)
+        ys = variantParams.get_grouped_series().subset(variants)
 
         # Create Data Frame containing all info:
         DF = pd.DataFrame()
-        DF['clusterID'] = clusterIDs
-        DF['variant'] = Variants
+        DF['clusterID'] = ys.cluster_ids
+        DF['variant'] = ys.get_labels()
         for i in range(NPoints):
-            DF[str(i)] = F[i]
+            DF[str(i)] = ys.values[:, ys.columns.get_loc(str(i))]
         print DF.head(10)
         DF.to_csv(args.out_dir, sep="\t", index=False, compression="gzip")
@@ -16,6 +16,7 @@ Sarah Denny
 """
 
 import os
+import gzip
 import numpy as np
 import pandas as pd
 import argparse
@@ -25,7 +26,7 @@ import scipy.stats as st
 from joblib import Parallel, delayed
 import lmfit
 import logging
-from fittinglibs import (fitting, fileio, seqfun, distribution, objfunctions, initfits, processing)
+from fittinglibs import (fitting, fileio, seqfun, distribution, objfunctions, initfits, processing, parallelfits, fitcache, checkpoint, telemetry)
 
 ### MAIN ###
 
@@ -40,6 +41,38 @@ group.add_argument('--subset',action="store_true", default=False,
                     help='if flagged, will only do a subset of the data for test purposes')
 group.add_argument('--subset_num', default=5000, type=int,
                     help='do at most this many single clusters when the subset flag is true. default=5000')
+group.add_argument('--engine', default='lmfit', choices=['lmfit', 'batched', 'varpro'],
+                    help='fitting engine. "lmfit" fits each cluster separately; "batched" fits '
+                    'blocks of clusters at once with a vectorized solver; "varpro" fits blocks '
+                    'by variable projection (binding_curve only). default="lmfit"')
+group.add_argument('--batch_size', default=2000, type=int,
+                    help='number of clusters per block with the "batched" or "varpro" engines. default=2000')
+group.add_argument('--tmp_dir',
+                    help='directory in which to put the memory-mapped arrays shared with the workers. '
+                    'default is the system temporary directory')
+group.add_argument('--stream', action="store_true", default=False,
+                    help='if flagged, read, fit, and save the binding series in chunks of clusters. '
+                    'For tab separated binding series (i.e. .CPseries or .CPseries.gz), memory use then does '
+                    'not grow with the number of clusters; other formats (i.e. .pkl) are still loaded whole')
+group.add_argument('--chunk_size', default=200000, type=int,
+                    help='number of clusters per chunk with the --stream flag. default=200000')
+group.add_argument('--checkpoint_dir',
+                    help='directory in which to save chunks of fits as they finish. '
+                    'default is the out file name with extension ".checkpoint"')
+group.add_argument('--resume', action="store_true", default=False,
+                    help='if flagged, only fit the clusters not already saved in the checkpoint '
+                    'directory by a previous, interrupted run with the same inputs')
+group.add_argument('--telemetry', action="store_true", default=False,
+                    help='if flagged, save the number of function evaluations, time, and worker of each '
+                    'fit as extra columns, and write a report of fit performance to a ".fitReport.txt" file')
+group.add_argument('--cache', action="store_true", default=False,
+                    help='if flagged, fit each distinct binding curve only once')
+group.add_argument('--cache_file',
+                    help='pickle file of previous fits. Curves fit before (with the same fitting '
+                    'function and parameters) are not refit, and new fits are added to this file. '
+                    'Implies --cache')
+group.add_argument('--cache_size', default=10000000, type=int,
+                    help='maximum number of fits to keep in the cache. default=1E7')
 
 group = parser.add_argument_group('arguments about fitting function')
 group.add_argument('--func', default = 'binding_curve',
@@ -54,31 +87,83 @@ group.add_argument('--params_ub', nargs='+', type=float, help='new upperbound va
 #                    help='if flagged, do not fit, but save the fit parameters')
 
 
-def splitAndFit(fitParams, bindingSeries, numCores, index=None):
-    """ Given a table of binding curves, parallelize fit. """
-    if index is None:
-        index = bindingSeries.index    
+def splitAndFit(fitParams, bindingSeries, numCores, index=None, engine='lmfit', batch_size=2000, tmp_dir=None, cache=None,
+                checkpoint_dir=None, resume=False, telemetry=False):
+    """ Given a table of binding curves, parallelize fit.
+
+    The binding series is shared with the workers through a memory-mapped array,
+    and each worker fits contiguous chunks of clusters (see parallelfits). """
     logging.info('Fitting binding curves:')
-    fits = (Parallel(n_jobs=numCores, verbose=10)
-            (delayed(fitting.perCluster)(fitParams, bindingSeries.loc[idx])
-             for idx in index))
-    
-    return pd.concat({idx:val for idx, val in zip(index, fits)}).unstack()
+    return parallelfits.splitAndFit(fitParams, bindingSeries, numCores, index=index,
+                                    engine=engine, batch_size=batch_size, tmp_dir=tmp_dir, cache=cache,
+                                    checkpoint_dir=checkpoint_dir, resume=resume, telemetry=telemetry)
 # define functions
 
     
-def checkFitResults(fitResults):
-    # did any of the stde work?
+def streamAndFit(fitParams, filename, out_file, numCores, chunk_size=200000, subset_num=None,
+                 checkpoint_dir=None, resume=False, **kwargs):
+    """ Read the binding series in chunks of clusters, fit each chunk, and append the fits to out_file.
+
+    Only clusters with at least 4 measurements are fit, and at most subset_num
+    of them if given. Each chunk is checkpointed in its own subdirectory of
+    checkpoint_dir. Returns the counts of checkFitResults over all chunks. """
+    counts = None
+    num_fit = 0
+    chunk_checkpoint_dirs = []
+    with gzip.open(out_file, 'wb') as f:
+        for i, bindingSeries in enumerate(fileio.iterFile(filename, chunksize=chunk_size)):
+            # only fit clusters with at least 4 entries (with three free params)
+            index = bindingSeries.dropna(axis=0, thresh=4).index.tolist()
+            if subset_num is not None:
+                index = index[:subset_num - num_fit]
+            if len(index) == 0:
+                if subset_num is not None and num_fit >= subset_num:
+                    break
+                continue
+            logging.info('Fitting chunk %d (%d clusters)'%(i, len(index)))
+
+            # fit and append
+            chunk_checkpoint_dir = None
+            if checkpoint_dir is not None:
+                chunk_checkpoint_dir = os.path.join(checkpoint_dir, 'chunk_%d'%i)
+                chunk_checkpoint_dirs.append(chunk_checkpoint_dir)
+            fitResults = splitAndFit(fitParams, bindingSeries, numCores, index=index,
+                                     checkpoint_dir=chunk_checkpoint_dir, resume=resume, **kwargs)
+            fitResults.to_csv(f, sep='\t', header=(num_fit == 0))
+            num_fit += len(index)
+
+            # keep track of fit quality
+            chunk_counts = countFitResults(fitResults)
+            counts = chunk_counts if counts is None else counts + chunk_counts
+
+    # the checkpoints are not needed once the results are saved
+    for chunk_checkpoint_dir in chunk_checkpoint_dirs:
+        checkpoint.Checkpoint(chunk_checkpoint_dir, None).remove()
+    return counts
+
+def countFitResults(fitResults):
+    """ Return the number of clusters passing each of the checks of checkFitResults. """
     param_names = ['fmax', 'dG', 'fmin']
-    numClusters = fitResults.dropna(subset=param_names).shape[0]
+    fitResults = fitResults.dropna(subset=param_names)
+    return pd.Series({'num_clusters':len(fitResults),
+                      'rsq':(fitResults.rsq > 0.5).sum(),
+                      'dG_stde':(fitResults.dG_stde < 1).sum(),
+                      'fmax_stde':(fitResults.fmax_stde < fitResults.fmax).sum(),
+                      'all_stde_zero':(fitResults.loc[:, ['%s_stde'%param for param in param_names]]==0).all(axis=1).sum()})
+    
+def checkFitResults(fitResults=None, counts=None):
+    # did any of the stde work?
+    if counts is None:
+        counts = countFitResults(fitResults)
+    numClusters = counts['num_clusters']
     logging.info('%4.2f%% clusters have rsq>50%%'
-           %(100*(fitResults.rsq > 0.5).sum()/float(numClusters)))
+           %(100*counts['rsq']/float(numClusters)))
     logging.info('%4.2f%% clusters have stde in dG < 1'
-           %(100*(fitResults.dG_stde < 1).sum()/float(numClusters)))
+           %(100*counts['dG_stde']/float(numClusters)))
     logging.info('%4.2f%% clusters have stde in fmax < fmax'
-           %(100*(fitResults.fmax_stde < fitResults.fmax).sum()/float(numClusters)))
+           %(100*counts['fmax_stde']/float(numClusters)))
     logging.info('%4.2f%% clusters have stde != 0 for at least one fit parameters'
-           %(100 -100*(fitResults.loc[:, ['%s_stde'%param for param in param_names]]==0).all(axis=1).sum()/float(numClusters)))
+           %(100 -100*counts['all_stde_zero']/float(numClusters)))
 
 
 if __name__=="__main__":    
@@ -91,6 +176,8 @@ if __name__=="__main__":
             args.out_file = basename + '_subset.CPfitted.gz'
         else:
             args.out_file = basename + '.CPfitted.gz'
+    if args.checkpoint_dir is None:
+        args.checkpoint_dir = fileio.stripExtension(args.out_file) + '.checkpoint'
 
     # Begin John edits 9/20/2021
     logger = logging.getLogger()
@@ -102,16 +189,8 @@ if __name__=="__main__":
     logger.addHandler(file_handler)
     # End John edits
 
-    # load files
-    logging.info("Loading binding series...")
+    # load x values
     xvalues = np.loadtxt(args.xvalues)
-    bindingSeries = fileio.loadFile(args.binding_series)  
-
-    # John edits 5/9/2023
-    bindginSeries = bindingSeries.drop_duplicates()
-    # end edits
-
-    min_xval_col = pd.Series(xvalues, index=bindingSeries.columns).idxmin()
     
     # Initialize the fit parameters class.
     # This includes defining the fitting function, defining the xvalues,
@@ -126,18 +205,52 @@ if __name__=="__main__":
         if param_name:
             fitParams.update_init_params(**{param_name:{'initial':param_init, 'lowerbound':param_lb, 'upperbound':param_ub, 'vary':bool(param_vary)}})
         
-    # only table with at least 4 entries (with three free params)
-    index_all = bindingSeries.dropna(axis=0, thresh=4).index.tolist()
-    if args.subset:
-        # take a subset of indices
-        if len(index_all) > args.subset_num:
-            index_all = index_all[:args.subset_num]
-
-    # fit
-    fitResults = splitAndFit(fitParams, bindingSeries, args.numCores, index=index_all)
-    # save
-    fitResults.to_csv(args.out_file, sep='\t', compression='gzip')
+    # duplicate curves are only fit once if using the fit cache
+    cache = None
+    if args.cache or args.cache_file:
+        cache = fitcache.FitCache(max_size=args.cache_size, filename=args.cache_file)
+    fit_kwargs = dict(engine=args.engine, batch_size=args.batch_size, tmp_dir=args.tmp_dir, cache=cache,
+                      checkpoint_dir=args.checkpoint_dir, resume=args.resume, telemetry=args.telemetry)
+
+    if args.stream:
+        # fit and save chunk by chunk
+        logging.info("Streaming binding series...")
+        if not fileio.isStreamable(args.binding_series):
+            logging.warning('%s can not be read in chunks, so all of it is loaded before fitting. '
+                            'Save it as a .CPseries file to stream it.'%args.binding_series)
+        fitCounts = streamAndFit(fitParams, args.binding_series, args.out_file, args.numCores,
+                                 chunk_size=args.chunk_size,
+                                 subset_num=(args.subset_num if args.subset else None),
+                                 **fit_kwargs)
+    else:
+        # load files
+        logging.info("Loading binding series...")
+        bindingSeries = fileio.loadFile(args.binding_series)  
+        
+        # only table with at least 4 entries (with three free params)
+        index_all = bindingSeries.dropna(axis=0, thresh=4).index.tolist()
+        if args.subset:
+            # take a subset of indices
+            if len(index_all) > args.subset_num:
+                index_all = index_all[:args.subset_num]
+
+        # fit
+        fitResults = splitAndFit(fitParams, bindingSeries, args.numCores, index=index_all, **fit_kwargs)
+        # save
+        fitResults.to_csv(args.out_file, sep='\t', compression='gzip')
+        fitCounts = countFitResults(fitResults)
+
+    # the checkpoint is not needed once the results are saved
+    checkpoint.Checkpoint(args.checkpoint_dir, None).remove()
 
     fileio.saveFile(fileio.stripExtension(args.out_file)+'.fitParameters.p', fitParams)
     
-    checkFitResults(fitResults)
+    if fitCounts is not None:
+        checkFitResults(counts=fitCounts)
+
+    # report fit times and function evaluations
+    if args.telemetry:
+        if args.stream:
+            fitResults = pd.concat([chunk.loc[:, ['exit_flag', 'rsq', 'dG', 'fmax'] + fitting.telemetry_columns]
+                                    for chunk in fileio.iterFile(args.out_file)])
+        telemetry.saveReport(fitResults, fileio.stripExtension(args.out_file) + '.fitReport.txt')